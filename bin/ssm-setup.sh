@@ -81,7 +81,40 @@
 #?     Set the Memcached server's host and port which are used by Django cache.
 #?     The default value depends on the .ssm-env file and Django's settings.
 #?     These two KEYs are used only if SSM_CACHES_BACKEND is set to 'memcached.PyMemcacheCache'.
-#? 
+#?
+#?   - SSM_EMAIL_BACKEND
+#?
+#?     Set the Django's Email backend for the notification Email.
+#?     The default value 'notification.backends.SendmailBackend' sends each Email with the local `sendmail` command.
+#?     The value 'django.core.mail.backends.smtp.EmailBackend' sends the Emails in bulk over one SMTP connection.
+#?     The default value depends on the .ssm-env file and Django's settings.
+#?
+#?   - SSM_EMAIL_HOST, SSM_EMAIL_PORT, SSM_EMAIL_HOST_USER, SSM_EMAIL_HOST_PASSWORD, SSM_EMAIL_USE_TLS
+#?
+#?     Set the SMTP server which is used by the Email backend 'django.core.mail.backends.smtp.EmailBackend'.
+#?     The default value depends on the .ssm-env file and Django's settings.
+#?
+#?   - SSM_SHADOWSOCKS_PORT_SYNC_ASYNC
+#?
+#?     Reconcile the port changes made in a request with the celery worker, it's 'True' by default.
+#?     Set to 'False' to reconcile in the request instead, bounded by the global network timeout and
+#?     without the port accessibility scan.
+#?     The default value depends on the .ssm-env file and Django's settings.
+#?
+#?   - SSM_METRICS_ALLOWED_IPS
+#?
+#?     Set the client IPs allowed to scrape the Prometheus metrics at /metrics, separated by comma.
+#?     The staff users are always allowed.
+#?     The metrics of the web processes and the celery workers are summed up only with a shared cache,
+#?     e.g. SSM_CACHES_BACKEND='memcached.PyMemcacheCache', otherwise each process has its own metrics.
+#?     The default value depends on the .ssm-env file and Django's settings.
+#?
+#?   - SSM_STATISTIC_SAMPLE_RETENTION
+#?
+#?     Set the retention (in days) of the traffic samples, for the resolutions: raw, 5-minute, hourly and daily.
+#?     The value is 4 numbers separated by comma, such as '1,7,90,730'.
+#?     The default value depends on the .ssm-env file and Django's settings.
+#?
 #?   - SSM_RABBITMQ_HOST, SSM_RABBITMQ_PORT
 #?
 #?     Set the RabbitMQ server's host and port which are used by Celery.
@@ -7,7 +7,9 @@ import json
 from django.contrib import admin, messages
 from admin_lazy_load import LazyLoadAdminMixin
 
-from .models import NameServer, Domain, Record
+from utils.admin import BatchLazyLoadAdminMixin
+
+from .models import NameServer, Domain, Record, ZoneSnapshot
 
 
 # Register your models here.
@@ -43,7 +45,7 @@ class DomainAdmin(LazyLoadAdminMixin, admin.ModelAdmin):
 
 
 @admin.register(Record)
-class RecordAdmin(LazyLoadAdminMixin, admin.ModelAdmin):
+class RecordAdmin(BatchLazyLoadAdminMixin, admin.ModelAdmin):
     fields = ('host', 'domain', 'type', 'answer', 'site',
                   'dt_created', 'dt_updated')
 
@@ -56,6 +58,16 @@ class RecordAdmin(LazyLoadAdminMixin, admin.ModelAdmin):
     lazy_loaded_fields = ('answer_from_dns_api', 'answer_from_dns_query',
                           'is_matching_dns_api', 'is_matching_dns_query')
 
+    def get_queryset(self, request):
+        return super(RecordAdmin, self).get_queryset(request).select_related('domain__nameserver')
+
+    def lazy_batch(self, objs):
+        results = Record.verify_many(objs)
+        for values in results.values():
+            for field in ('answer_from_dns_api', 'answer_from_dns_query'):
+                values[field] = list(values[field] or [])
+        return results
+
     def answer_from_dns_api(self, obj):
         return list(obj.answer_from_dns_api or [])
 
@@ -75,8 +87,7 @@ class RecordAdmin(LazyLoadAdminMixin, admin.ModelAdmin):
     is_matching_dns_query.short_description = 'DNS Query'
 
     def dns_sync(self, request, queryset):
-        for obj in queryset:
-            result = obj.dns_sync()
+        for (obj, result) in ZoneSnapshot.sync(queryset.select_related('domain__nameserver')):
             messages.info(request, '{0}: {1}'.format(obj.fqdn, json.dumps(result)))
 
     dns_sync.short_description = 'Synchronize DNS records to DNS server for Selected Domain'
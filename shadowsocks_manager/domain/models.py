@@ -4,12 +4,13 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 
-import os
 import re
-import copy
+import time
 import logging
-from contextlib import contextmanager
-import dns.resolver, tldextract
+import threading
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
+import dns.resolver, dns.rdatatype, dns.rdataclass, tldextract
 from lexicon import config, client
 from collections import defaultdict
 from django.db import models
@@ -17,8 +18,11 @@ from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.sites.models import Site
 from django.conf import settings
+from django.core.cache import cache
 from allowedsites import CachedAllowedSites
 
+from metrics import metrics
+
 
 logger = logging.getLogger(__name__)
 
@@ -49,74 +53,278 @@ def get_zone_name(domain):
         zone2.zone1.example.co.uk       -> zone2.zone1.example.co.uk
     """
     if domain:
-        extract = tldextract.TLDExtract()
-        # deal with py2 and py3 compatibility
-        compat_method = extract.extract if hasattr(extract, 'extract') else extract
-        result = compat_method(domain)
+        return ZoneResolver.get_zone_name(domain)
+
+
+class ZoneResolver(object):
+    """
+    Resolve the zone names of the domain names, shared in the process:
+    * one TLDExtract for all the domain names, the public suffix list is loaded once.
+    * the zone of a domain name is remembered until the TTL of the zone's SOA record expires,
+      but no longer than `timeout` seconds.
+    * a domain name without a delegated zone is remembered for `negative_timeout` seconds.
+    """
+    timeout = 3600
+    negative_timeout = 300
+    max_size = 10000
+
+    _lock = threading.Lock()
+    _extractor = None
+    _resolver = None
+    # {<domain>: (<zone>, <expiration>)}
+    _zones = {}
+
+    @classmethod
+    def extract(cls, domain):
+        with cls._lock:
+            if cls._extractor is None:
+                extractor = tldextract.TLDExtract()
+                # deal with py2 and py3 compatibility
+                extractor = extractor.extract if hasattr(extractor, 'extract') else extractor
+                # load the public suffix list before sharing the extractor with other threads
+                extractor('example.com')
+                cls._extractor = extractor
+        return cls._extractor(domain)
+
+    @classmethod
+    def get_resolver(cls):
+        """
+        The resolver caches the answers of the zone lookups by their TTLs.
+        """
+        with cls._lock:
+            if cls._resolver is None:
+                resolver = dns.resolver.Resolver()
+                resolver.cache = dns.resolver.LRUCache()
+                cls._resolver = resolver
+        return cls._resolver
+
+    @classmethod
+    def resolve(cls, domain):
+        """
+        Return the zone name of the domain and the time its resolution expires.
+        """
+        now = time.time()
+        result = cls.extract(domain)
 
         # get the root domain name
         root = result.registered_domain
         if domain == root:
             # no need to resolve the domain
-            return domain
+            return (domain, now + cls.timeout)
 
-        zone = dns.resolver.zone_for_name(domain).to_text(omit_final_dot=True)
+        resolver = cls.get_resolver()
+        name = dns.resolver.zone_for_name(domain, resolver=resolver)
+        zone = name.to_text(omit_final_dot=True)
         # get the tld from the domain
         tld = result.suffix
         if zone == tld:
             # the domain is not resolvable, fallback to use the root domain
-            zone = root
+            return (root, now + cls.negative_timeout)
+
+        answer = resolver.cache.get((name, dns.rdatatype.SOA, dns.rdataclass.IN))
+        return (zone, min(answer.expiration, now + cls.timeout) if answer else now + cls.timeout)
+
+    @classmethod
+    def get_zone_name(cls, domain):
+        now = time.time()
+        cached = cls._zones.get(domain)
+        if cached and cached[1] > now:
+            metrics.inc('ssm_cache_requests_total', method='get_zone_name', result='hit')
+            return cached[0]
+
+        metrics.inc('ssm_cache_requests_total', method='get_zone_name', result='miss')
+        (zone, expiration) = cls.resolve(domain)
+        with cls._lock:
+            if len(cls._zones) >= cls.max_size:
+                cls._zones = dict((key, value) for (key, value) in cls._zones.items() if value[1] > now)
+                if len(cls._zones) >= cls.max_size:
+                    cls._zones = {}
+            cls._zones[domain] = (zone, expiration)
         return zone
 
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._zones = {}
+
 
-@contextmanager
-def temporary_environment(variables):
+class DnsQuery(object):
+    """
+    The answers of the DNS queries, shared by the processes in the cache:
+    * resolve_many() queries the (fqdn, type) pairs missing in the cache concurrently, in one sweep.
+    * an answer is cached for its TTL, but no longer than `timeout` seconds.
+    * no answer (NXDOMAIN or NoAnswer) is cached for `negative_timeout` seconds.
+    * a failed query (e.g. timed out) is answered with None, and is not cached.
+    """
+    timeout = 3600
+    negative_timeout = 60
+    max_workers = 32
+
+    @staticmethod
+    def get_cache_key(fqdn, rdtype):
+        return 'dns-query-{}-{}'.format(rdtype, fqdn).lower()
 
-    def clear_env():
+    @classmethod
+    def query(cls, fqdn, rdtype):
+        """
+        Return the answers in lowercase and as Set, and the seconds to cache them.
+        """
         try:
-            os.environ.clear()
-        except OSError:
-            # python 3.7, 3.8 allow empty key but fail to clear the environment
-            os.environ = {}
-
-    original = os.environ.copy()
-    try:
-        clear_env()
-        os.environ.update(variables)
-        yield
-    finally:
-        clear_env()
-        os.environ.update(original)
-        
-        
+            # deal with py2 and py3 compatibility
+            compat_method = dns.resolver.query if hasattr(dns.resolver, 'query') else dns.resolver.resolve
+            answers = compat_method(fqdn, rdtype)
+
+            return ({item.to_text().lower() for item in answers}, min(answers.rrset.ttl, cls.timeout))
+        except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+            # no answer for the host
+            return (set(), cls.negative_timeout)
+        except Exception as e:
+            logger.error('{} {}: {}: {}: {}'.format(fqdn, rdtype, getattr(e, '__module__', 'query'), type(e).__name__, e))
+            return (None, 0)
+
+    @classmethod
+    def resolve_many(cls, pairs, from_cache=True):
+        """
+        Return the answers of the (fqdn, type) pairs: {(<fqdn>, <type>): {<answer>, ...} or None, ...}
+        """
+        keys = dict((pair, cls.get_cache_key(*pair)) for pair in set(pairs))
+        cached = cache.get_many(list(keys.values())) if from_cache else {}
+        results = dict((pair, cached[key]) for (pair, key) in keys.items() if key in cached)
+        missing = [pair for pair in keys if pair not in results]
+        if results:
+            metrics.inc('ssm_cache_requests_total', len(results), method='dns_query', result='hit')
+        if not missing:
+            return results
+
+        metrics.inc('ssm_cache_requests_total', len(missing), method='dns_query', result='miss' if from_cache else 'bypass')
+        with ThreadPoolExecutor(max_workers=min(cls.max_workers, len(missing))) as executor:
+            answers = list(executor.map(lambda pair: cls.query(*pair), missing))
+
+        # {<timeout>: {<key>: <answers>}}
+        timeouts = defaultdict(dict)
+        for (pair, (value, timeout)) in zip(missing, answers):
+            results[pair] = value
+            if value is not None and timeout > 0:
+                timeouts[timeout][keys[pair]] = value
+        for (timeout, values) in timeouts.items():
+            cache.set_many(values, timeout=timeout)
+        return results
+
+    @classmethod
+    def resolve(cls, fqdn, rdtype, from_cache=True):
+        return cls.resolve_many([(fqdn, rdtype)], from_cache=from_cache)[(fqdn, rdtype)]
+
+
+class EnvConfigSource(config.EnvironmentConfigSource):
+    """
+    The lexicon config source of the environment variables in a mapping, instead of the process's os.environ.
+    """
+    def __init__(self, envs):
+        # skip EnvironmentConfigSource.__init__(), which reads os.environ
+        config.ConfigSource.__init__(self)
+        self._parameters = dict((key, value) for (key, value) in envs.items() if key.startswith('LEXICON_'))
+
+
 class DnsApi(object):
     """
     https://dns-lexicon.readthedocs.io/en/latest/provider_conventions.html
+
+    The instances are shared by the threads of the process, get them from the pool with DnsApi.get():
+    * the lexicon config is built from the env string directly, the process's environment is not touched.
+    * one lexicon client is built for each thread, a client is used only by its building thread in lexicon.
     """
+    # {(<nameserver pk>, <domain>): <DnsApi>}, shared in the process
+    _pool = {}
+    _pool_lock = threading.Lock()
+
     def __init__(self, env, domain):
         self.env = env
         self.domain = domain
         self.envs = {}
-        self.config = config.ConfigResolver()
 
         for item in env.split(','):
             # split with only the first '=', ignore the rest
             key, value = item.split('=', 1)
             self.envs[key] = value
 
-        with temporary_environment(self.envs):
-            self.config.with_env().with_dict({
-                'domain': domain,
-            })
+        self.config = self.build_config()
+        # the client, and the provider opened by session() of each thread
+        self._local = threading.local()
+
+    def build_config(self):
+        return config.ConfigResolver().with_config_source(EnvConfigSource(self.envs)).with_dict({
+            'domain': self.domain,
+        })
+
+    @classmethod
+    def get(cls, nameserver, domain):
+        """
+        Return the pooled instance for the nameserver and the domain, rebuilt if the nameserver's env is changed.
+        """
+        key = (nameserver.pk, domain)
+        api = cls._pool.get(key)
+        if api is None or api.env != nameserver.env:
+            api = cls(nameserver.env, domain)
+            with cls._pool_lock:
+                cls._pool[key] = api
+        return api
+
+    @classmethod
+    def invalidate(cls, nameserver_pk):
+        """
+        Drop the pooled instances of the nameserver.
+        """
+        with cls._pool_lock:
+            for key in [key for key in cls._pool if key[0] == nameserver_pk]:
+                del cls._pool[key]
+
+    @property
+    def client(self):
+        """
+        The lexicon client of the thread, with its own config since the client changes the config on building.
+        """
+        if getattr(self._local, 'client', None) is None:
+            self._local.client = client.Client(self.build_config())
+        return self._local.client
+
+    @contextmanager
+    def session(self):
+        """
+        Make the calls of the thread in the block through one provider, instead of a new provider per call.
+        """
+        if getattr(self._local, 'operations', None) is not None:
+            yield self
+            return
+
+        with ExitStack() as stack:
+            try:
+                self._local.operations = stack.enter_context(self.client)
+            except Exception as e:
+                # each call will try its own provider, and log the error
+                self._local.client = None
+                logger.error('{}: {}: {}: {}'.format(self.domain, getattr(e, '__module__', 'session'), type(e).__name__, e))
+            try:
+                yield self
+            finally:
+                self._local.operations = None
 
     def call(self, method, *args):
         logger.info('{domain}: {method}({args})'.format(domain=self.domain, method=method, args=args))
+        start = time.time()
         try:
-            with client.Client(self.config) as operations:
+            operations = getattr(self._local, 'operations', None)
+            if operations is not None:
+                return getattr(operations, method)(*args)
+            with self.client as operations:
                 return getattr(operations, method)(*args)
         except Exception as e:
+            # a failed client is rebuilt by the next call
+            self._local.client = None
             logger.error('{}: {}: {}: {}'.format(self.domain, getattr(e, '__module__', 'call'), type(e).__name__, e))
+            metrics.inc('ssm_dns_call_failures_total', method=method, domain=self.domain)
             return None
+        finally:
+            metrics.observe('ssm_dns_call_seconds', time.time() - start, method=method, domain=self.domain)
     
     def list_records(self, type, name=None, content=None):
         """
@@ -162,6 +370,89 @@ class DnsApi(object):
         return self.list_records('A', 'whatever') is not None
 
 
+class ZoneSnapshot(object):
+    """
+    The records of a zone listed from the DNS API once, for syncing many records of the zone:
+    * the records of a type are listed by the first lookup of the type, the later lookups are in memory.
+    * the changes made through the snapshot are applied to it, a failed change makes the type listed again.
+    * the DNS API calls are made through one lexicon client in session().
+
+    Usage:
+        for (record, result) in ZoneSnapshot.sync(Record.objects.all()):
+            ...
+    """
+    def __init__(self, domain, *args, **kwargs):
+        super(ZoneSnapshot, self).__init__(*args, **kwargs)
+        self.domain = domain
+        self.api = domain.api if domain else None
+        # {<type>: {<fqdn>: {<answer>, ...}}}
+        self._answers = {}
+
+    def get_fqdn(self, name):
+        """
+        Return the fully qualified name in lowercase, from the full or the relative name of the zone.
+        """
+        zone = self.domain.name.lower()
+        name = (name or '').rstrip('.').lower()
+        if name in ('', '@'):
+            return zone
+        return name if name == zone or name.endswith('.' + zone) else '.'.join([name, zone])
+
+    def get_answers(self, type, host):
+        """
+        Return the answers of the host from the DNS API, in lowercase and as Set.
+        """
+        if type not in self._answers:
+            answers = defaultdict(set)
+            for record in self.api.list_records(type) or []:
+                answers[self.get_fqdn(record.get('name'))].add(record.get('content').lower())
+            self._answers[type] = answers
+        return set(self._answers[type].get(self.get_fqdn(host), set()))
+
+    def create(self, type, host, answer):
+        created = self.api.create_record(type, host, answer)
+        if created and type in self._answers:
+            self._answers[type][self.get_fqdn(host)].add(answer.lower())
+        else:
+            self._answers.pop(type, None)
+        return created
+
+    def delete(self, type, host):
+        deleted = self.api.delete_record(type, host)
+        if deleted and type in self._answers:
+            self._answers[type].pop(self.get_fqdn(host), None)
+        else:
+            self._answers.pop(type, None)
+        return deleted
+
+    @contextmanager
+    def session(self):
+        with self.api.session():
+            yield self
+
+    @classmethod
+    def sync(cls, records):
+        """
+        Sync the records to DNS server, each zone is listed once for all its records.
+        Return [(<record>, <result of record.dns_sync()>), ...] in the order of the records.
+        """
+        records = list(records)
+        results = [None] * len(records)
+
+        # {<domain id>: (<zone>, [<index of the record>, ...])}
+        zones = {}
+        for (index, record) in enumerate(records):
+            if record.domain_id not in zones:
+                zones[record.domain_id] = (cls(record.domain), [])
+            zones[record.domain_id][1].append(index)
+
+        for (zone, indexes) in zones.values():
+            with zone.session() if zone.api else ExitStack():
+                for index in indexes:
+                    results[index] = (records[index], records[index].dns_sync(zone))
+        return results
+
+
 class NameServer(models.Model):
     name = models.CharField(unique=True, max_length=64,
         help_text='The name for the Nameserver, name it as your wish. Example: `name.com`.')
@@ -219,7 +510,7 @@ class Domain(models.Model):
     def api(self):
         if self.nameserver and self.nameserver.env:
             try:
-                return DnsApi(self.nameserver.env, self.name)
+                return DnsApi.get(self.nameserver, self.name)
             except Exception as e:
                 logger.error('DnsApi: domain ({0}), env ({1}): {2}: {3}'.format(self.name, self.nameserver.env, type(e).__name__, e))
         else:
@@ -272,11 +563,23 @@ class Record(models.Model):
     class Meta:
         unique_together = ('host', 'domain')
 
+    # the fields compared with the original values by on_update()
+    tracked_fields = ('host', 'domain_id', 'type', 'answer')
+
     def __init__(self, *args, **kwargs):
         super(Record, self).__init__(*args, **kwargs)
-        self.auto_resolve()
-        # take a snapshot of the original record
-        self.origin = copy.deepcopy(self)
+        if not self.is_resolved:
+            self.auto_resolve()
+        self._snapshot_original()
+
+    def _snapshot_original(self):
+        """
+        Capture the values of the tracked fields as the original state, the origin record is built from them
+        only when it is needed. Called at __init__ time and after every save().
+        """
+        # the deferred fields are not loaded for the snapshot
+        self._original = dict((name, self.__dict__.get(name)) for name in self.tracked_fields)
+        self._origin = None
 
     def __str__(self):
         return self.fqdn
@@ -284,6 +587,32 @@ class Record(models.Model):
     def save(self, *args, **kwargs):
         self.auto_resolve()
         super(Record, self).save(*args, **kwargs)
+        self._snapshot_original()
+
+    @property
+    def is_resolved(self):
+        """
+        Test if the fqdn, host and domain are all set without a given domain instance, as the records
+        loaded from the database, which were resolved on saving.
+        """
+        values = self.__dict__
+        return bool(values.get('fqdn') and values.get('host') and values.get('domain_id')) and \
+            not self._meta.get_field('domain').is_cached(self)
+
+    @property
+    def origin(self):
+        """
+        The record of the original values, built on the first access.
+        """
+        if self._origin is None:
+            self._origin = Record(**self._original)
+        return self._origin
+
+    def has_changed(self, *fields):
+        """
+        Test if any of the tracked fields is changed from the original values, all of them by default.
+        """
+        return any(self._original[name] != getattr(self, name) for name in fields or self.tracked_fields)
 
     def auto_resolve(self):
         """
@@ -318,6 +647,14 @@ class Record(models.Model):
     def dnsapi(self):
         return self.domain.api if self.domain else None
 
+    def get_zone(self, zone=None):
+        """
+        Return the zone snapshot if it is of the record's domain, or a new one.
+        """
+        if zone is not None and zone.domain == self.domain:
+            return zone
+        return ZoneSnapshot(self.domain)
+
     @property
     def answer_from_dns_api(self):
         """
@@ -332,19 +669,9 @@ class Record(models.Model):
     @property
     def answer_from_dns_query(self):
         """
-        Return the answers from DNS query, in lowercase and as Set.
+        Return the answers from DNS query, in lowercase and as Set, cached by their TTL, see DnsQuery.
         """
-        try:
-            # deal with py2 and py3 compatibility
-            compat_method = dns.resolver.query if hasattr(dns.resolver, 'query') else dns.resolver.resolve
-            answers = compat_method(self.fqdn, self.type)
-
-            return {item.to_text().lower() for item in answers}
-        except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
-            # no answer for the host
-            return {}
-        except Exception as e:
-            logger.error('{} {}: {}: {}: {}'.format(self.fqdn, self.type, getattr(e, '__module__', 'answer_from_dns_query'), type(e).__name__, e))
+        return DnsQuery.resolve(self.fqdn, self.type)
 
     @property
     def is_matching_dns_api(self):
@@ -360,6 +687,41 @@ class Record(models.Model):
         """
         return self.answers == self.answer_from_dns_query
 
+    @classmethod
+    def verify_many(cls, records, from_cache=True, api=True):
+        """
+        Resolve the DNS answers of many records at once:
+        * answer_from_dns_query, is_matching_dns_query: one concurrent sweep for all, see DnsQuery.
+        * answer_from_dns_api, is_matching_dns_api:     one listing of each zone, see ZoneSnapshot,
+                                                        skipped if api is False.
+        The records should come with the domain and its nameserver loaded.
+        Return the values by record pk: {<pk>: {'answer_from_dns_api': <value>, ...}, ...}
+        """
+        records = list(records)
+        queried = DnsQuery.resolve_many([(record.fqdn, record.type) for record in records], from_cache=from_cache)
+
+        # {<domain id>: <zone>}
+        zones = {}
+        results = {}
+        for record in records:
+            answer_from_dns_query = queried[(record.fqdn, record.type)]
+            results[record.pk] = {
+                'answer_from_dns_query': answer_from_dns_query,
+                'is_matching_dns_query': record.answers == answer_from_dns_query,
+            }
+            if not api:
+                continue
+
+            if record.domain_id not in zones:
+                zones[record.domain_id] = ZoneSnapshot(record.domain)
+            zone = zones[record.domain_id]
+            answer_from_dns_api = zone.get_answers(record.type, record.host) if zone.api else None
+            results[record.pk].update({
+                'answer_from_dns_api': answer_from_dns_api,
+                'is_matching_dns_api': record.answers == answer_from_dns_api,
+            })
+        return results
+
     def on_update(self):
         """
         The matrix of rules for the update event:
@@ -379,41 +741,45 @@ class Record(models.Model):
         """
         self.update_site_domain()
 
+        zone = self.get_zone()
         deleted_origin = None
         try:
-            if self.domain != self.origin.domain or self.host != self.origin.host or self.type != self.origin.type:
+            if self._original['domain_id'] and self.has_changed('domain_id', 'host', 'type'):
                 # clean up the old record
-                deleted_origin = self.origin.dns_delete()
+                deleted_origin = self.origin.dns_delete(zone)
         except models.ObjectDoesNotExist:
             # ignore an empty record without domain
             pass
 
-        ret = self.dns_sync()
+        ret = self.dns_sync(zone)
         ret['deleted']['origin'] = deleted_origin
         return ret
 
     def on_delete(self):
         return self.dns_delete()
 
-    def dns_sync(self):
+    def dns_sync(self, zone=None):
         """
         Sync the record to DNS server through DNS API.
+        The zone snapshot of the record's domain can be shared by the records, see ZoneSnapshot.sync().
         """
         ret = defaultdict(dict)
-        
-        if self.dnsapi:
-            if self.is_matching_dns_api:
-                ret['message'] = 'No need to synchronize.'
-                return ret
+        zone = self.get_zone(zone)
+
+        if zone.api:
+            with zone.session():
+                if self.answers == zone.get_answers(self.type, self.host):
+                    ret['message'] = 'No need to synchronize.'
+                    return ret
 
-            ret['deleted'] = self.dns_delete()
-            ret['created'] = self.dns_create()
+                ret['deleted'] = self.dns_delete(zone)
+                ret['created'] = self.dns_create(zone)
         else:
             ret['message'] = 'Please configure Nameserver properly for the domain first.'
 
         return ret
 
-    def dns_create(self):
+    def dns_create(self, zone=None):
         """
         Create the recordset to DNS server through DNS API.
         Return:
@@ -423,13 +789,14 @@ class Record(models.Model):
             {'true': [<answer>, ...], 'null': [<answer>, ...]}
         """
         ret = defaultdict(list)
-        if self.dnsapi and not self.is_matching_dns_api:
+        zone = self.get_zone(zone)
+        if zone.api and self.answers != zone.get_answers(self.type, self.host):
             for answer in self.answers:
-                created = self.dnsapi.create_record(self.type, self.host, answer)
+                created = zone.create(self.type, self.host, answer)
                 ret[created].append(answer)
         return ret
 
-    def dns_delete(self):
+    def dns_delete(self, zone=None):
         """
         Delete the recordset from DNS server through DNS API.
         Return:
@@ -438,8 +805,9 @@ class Record(models.Model):
             {'null': <type>}
         """
         ret = defaultdict(str)
-        if self.dnsapi and self.dnsapi.list_records(self.type, self.host):
-            deleted = self.dnsapi.delete_record(self.type, self.host)
+        zone = self.get_zone(zone)
+        if zone.api and zone.get_answers(self.type, self.host):
+            deleted = zone.delete(self.type, self.host)
             ret[deleted] = self.type
         return ret
 
@@ -450,6 +818,11 @@ def allowedsites_update_cache(sender, instance, **kwargs):
     if isinstance(settings.ALLOWED_HOSTS, CachedAllowedSites):
         settings.ALLOWED_HOSTS.update_cache()
 
+@receiver(post_save, sender=NameServer)
+@receiver(post_delete, sender=NameServer)
+def nameserver_invalidate_dnsapi(sender, instance, **kwargs):
+    DnsApi.invalidate(instance.pk)
+
 @receiver(post_save, sender=Record)
 def record_on_update(sender, instance, **kwargs):
     instance.on_update()
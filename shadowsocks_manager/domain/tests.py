@@ -6,9 +6,14 @@ from __future__ import absolute_import
 
 import json
 import os
+import threading
 from abc import abstractmethod
 from django.test import TestCase
 from django.core.management import call_command
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from unittest.mock import patch, MagicMock
+import dns.name
 
 from domain import models, serializers
 
@@ -133,6 +138,63 @@ class DnsApiTestCase(AppTestCase):
         self.assertFalse(obj.is_accessible)
 
 
+
+class DnsApiPoolTestCase(AppTestCase):
+
+    def setUp(self):
+        self.ns = models.NameServer.objects.create(name='mocknameserver-pool', env='LEXICON_PROVIDER_NAME=mockprovider')
+        self.client = MagicMock()
+        patcher = patch.object(models.client, 'Client', self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_config_without_process_env(self):
+        with patch.dict(os.environ, {'LEXICON_PROVIDER_NAME': 'fromprocess', 'LEXICON_MOCKPROVIDER_TOKEN': 'token'}):
+            origin = os.environ.copy()
+            obj = models.DnsApi('LEXICON_PROVIDER_NAME=mockprovider', 'example.com')
+            self.assertEqual(os.environ.copy(), origin)
+        self.assertEqual(obj.config.resolve('lexicon:provider_name'), 'mockprovider')
+        self.assertIsNone(obj.config.resolve('lexicon:mockprovider:token'))
+
+    def test_pool(self):
+        obj = models.DnsApi.get(self.ns, 'example.com')
+        self.assertIs(models.DnsApi.get(self.ns, 'example.com'), obj)
+        self.assertIsNot(models.DnsApi.get(self.ns, 'example.org'), obj)
+
+    def test_pool_invalidated_on_nameserver_change(self):
+        obj = models.DnsApi.get(self.ns, 'example.com')
+        self.ns.env = 'LEXICON_PROVIDER_NAME=otherprovider'
+        self.ns.save()
+        self.assertNotIn((self.ns.pk, 'example.com'), models.DnsApi._pool)
+        other = models.DnsApi.get(self.ns, 'example.com')
+        self.assertIsNot(other, obj)
+        self.assertEqual(other.config.resolve('lexicon:provider_name'), 'otherprovider')
+
+    def test_pool_rebuilt_on_stale_env(self):
+        obj = models.DnsApi.get(self.ns, 'example.com')
+        # changed by other process
+        self.ns.env = 'LEXICON_PROVIDER_NAME=otherprovider'
+        self.assertIsNot(models.DnsApi.get(self.ns, 'example.com'), obj)
+
+    def test_client_per_thread(self):
+        obj = models.DnsApi.get(self.ns, 'example.com')
+        obj.list_records('A')
+        obj.list_records('A')
+        self.assertEqual(self.client.call_count, 1)
+
+        thread = threading.Thread(target=obj.list_records, args=('A',))
+        thread.start()
+        thread.join()
+        self.assertEqual(self.client.call_count, 2)
+
+    def test_client_rebuilt_on_error(self):
+        self.client.return_value.__enter__.side_effect = Exception('unauthorized')
+        obj = models.DnsApi.get(self.ns, 'example.com')
+        self.assertIsNone(obj.list_records('A'))
+        self.assertIsNone(obj.list_records('A'))
+        self.assertEqual(self.client.call_count, 2)
+
+
 class NameServerTestCase(AppTestCase):
     @classmethod
     def up(cls):
@@ -228,6 +290,58 @@ class DomainTestCase(AppTestCase):
         json.loads(json.dumps(obj.to_representation(models.Domain.objects.first())))
 
 
+
+class ZoneResolverTestCase(AppTestCase):
+
+    def setUp(self):
+        models.ZoneResolver.clear()
+
+    def tearDown(self):
+        models.ZoneResolver.clear()
+
+    def test_root_domain_not_resolved(self):
+        with patch.object(models.dns.resolver, 'zone_for_name') as zone_for_name:
+            self.assertEqual(models.get_zone_name('example.co.uk'), 'example.co.uk')
+            self.assertEqual(models.get_host_name('example.co.uk'), '')
+        zone_for_name.assert_not_called()
+
+    def test_zone_cached(self):
+        with patch.object(models.dns.resolver, 'zone_for_name',
+                return_value=dns.name.from_text('zone1.example.co.uk')) as zone_for_name:
+            for i in range(3):
+                self.assertEqual(models.get_zone_name('foo.zone1.example.co.uk'), 'zone1.example.co.uk')
+                self.assertEqual(models.get_host_name('foo.zone1.example.co.uk'), 'foo')
+        zone_for_name.assert_called_once()
+
+    def test_zone_negative_cached(self):
+        with patch.object(models.dns.resolver, 'zone_for_name',
+                return_value=dns.name.from_text('co.uk')) as zone_for_name:
+            self.assertEqual(models.get_zone_name('foo.bar.example.co.uk'), 'example.co.uk')
+            self.assertEqual(models.get_zone_name('foo.bar.example.co.uk'), 'example.co.uk')
+        zone_for_name.assert_called_once()
+        (zone, expiration) = models.ZoneResolver._zones['foo.bar.example.co.uk']
+        self.assertLessEqual(expiration, models.time.time() + models.ZoneResolver.negative_timeout)
+
+    def test_zone_expired(self):
+        with patch.object(models.dns.resolver, 'zone_for_name',
+                return_value=dns.name.from_text('example.co.uk')) as zone_for_name:
+            models.get_zone_name('foo.example.co.uk')
+            with patch.object(models.time, 'time', return_value=models.time.time() + models.ZoneResolver.timeout + 1):
+                models.get_zone_name('foo.example.co.uk')
+        self.assertEqual(zone_for_name.call_count, 2)
+
+    def test_zone_resolution_error_not_cached(self):
+        with patch.object(models.dns.resolver, 'zone_for_name', side_effect=dns.resolver.NoNameservers):
+            self.assertRaises(dns.resolver.NoNameservers, models.get_zone_name, 'foo.example.co.uk')
+        self.assertNotIn('foo.example.co.uk', models.ZoneResolver._zones)
+
+    def test_extractor_shared(self):
+        models.get_zone_name('example.com')
+        with patch.object(models.tldextract, 'TLDExtract') as extractor:
+            models.get_zone_name('example.org')
+        extractor.assert_not_called()
+
+
 class RecordTestCase(AppTestCase):
     @classmethod
     def up(cls):
@@ -292,11 +406,250 @@ class RecordTestCase(AppTestCase):
         self.assertEqual(result['deleted'], {'origin': {}})
         self.assertEqual(result['created'], {'null': ['new.example.com']})
 
+    def test_record_load_without_queries(self):
+        count = models.Record.objects.count()
+        with self.assertNumQueries(1), patch.object(models.ZoneResolver, 'get_zone_name') as get_zone_name:
+            records = list(models.Record.objects.all())
+            self.assertEqual([obj.fqdn for obj in records], ['vpn.example.com'] * count)
+        get_zone_name.assert_not_called()
+        for obj in records:
+            self.assertIsNone(obj._origin)
+
+    def test_record_origin_lazy(self):
+        obj = models.Record.objects.first()
+        self.assertFalse(obj.has_changed())
+        obj.host = 'new'
+        obj.answer = '2.2.2.2'
+        self.assertTrue(obj.has_changed())
+        self.assertTrue(obj.has_changed('host'))
+        self.assertFalse(obj.has_changed('type'))
+        self.assertEqual(obj.origin.host, 'vpn')
+        self.assertEqual(obj.origin.fqdn, 'vpn.example.com')
+        self.assertEqual(obj.origin.answer, '1.1.1.1')
+
+    def test_record_origin_after_save(self):
+        obj = models.Record.objects.first()
+        obj.host = 'new'
+        obj.save()
+        self.assertFalse(obj.has_changed())
+        self.assertEqual(obj.origin.host, 'new')
+        self.assertEqual(obj.on_update()['deleted']['origin'], None)
+
     def test_record_serializer(self):
         obj = serializers.RecordSerializer()
         json.loads(json.dumps(obj.to_representation(models.Record.objects.first())))
 
 
+
+class MockProvider(object):
+    """
+    A lexicon provider keeping the records in memory, and counting the calls.
+    """
+    def __init__(self, zone, records=None):
+        self.zone = zone
+        self.records = list(records or [])
+        self.calls = []
+
+    def get_fqdn(self, name):
+        return name if not name or name.endswith(self.zone) else '.'.join([name, self.zone])
+
+    def list_records(self, type=None, name=None, content=None):
+        self.calls.append('list_records')
+        return [record for record in self.records
+            if record['type'] == type and (not name or record['name'] == self.get_fqdn(name))]
+
+    def create_record(self, type, name, content):
+        self.calls.append('create_record')
+        self.records.append({'type': type, 'name': self.get_fqdn(name), 'content': content})
+        return True
+
+    def delete_record(self, identifier, type, name, content=None):
+        self.calls.append('delete_record')
+        self.records = [record for record in self.records
+            if not (record['type'] == type and record['name'] == self.get_fqdn(name))]
+        return True
+
+
+class ZoneSnapshotTestCase(AppTestCase):
+
+    def setUp(self):
+        self.provider = MockProvider('example.net', [
+            {'type': 'A', 'name': 'a.example.net', 'content': '1.1.1.1'},
+            {'type': 'A', 'name': 'b.example.net', 'content': '9.9.9.9'},
+        ])
+        self.client = MagicMock()
+        self.client.return_value.__enter__.return_value = self.provider
+        patcher = patch.object(models.client, 'Client', self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        ns = models.NameServer.objects.create(name='mocknameserver-zone', env='LEXICON_PROVIDER_NAME=mockprovider')
+        self.domain = models.Domain.objects.create(name='example.net', nameserver=ns)
+        for host in ['a', 'b', 'c']:
+            models.Record.objects.create(host=host, domain=self.domain, type='A', answer='1.1.1.1')
+        self.provider.calls = []
+        self.client.reset_mock()
+
+    def test_sync_lists_zone_once(self):
+        self.provider.records = [{'type': 'A', 'name': 'a.example.net', 'content': '1.1.1.1'}]
+        results = models.ZoneSnapshot.sync(models.Record.objects.order_by('host'))
+        self.assertEqual([record.host for (record, result) in results], ['a', 'b', 'c'])
+        self.assertEqual(results[0][1]['message'], 'No need to synchronize.')
+        self.assertEqual(dict(results[1][1]['created']), {True: ['1.1.1.1']})
+        self.assertEqual(self.provider.calls, ['list_records', 'create_record', 'create_record'])
+        # one provider session for the zone
+        self.client.return_value.__enter__.assert_called_once()
+
+    def test_sync_replaces_answers(self):
+        self.provider.records.append({'type': 'A', 'name': 'c.example.net', 'content': '8.8.8.8'})
+        results = dict((record.host, result) for (record, result) in models.ZoneSnapshot.sync(models.Record.objects.all()))
+        self.assertEqual(dict(results['c']['deleted']), {True: 'A'})
+        self.assertEqual(self.provider.calls.count('list_records'), 1)
+        self.assertEqual(sorted(record['content'] for record in self.provider.records if record['name'] == 'c.example.net'),
+            ['1.1.1.1'])
+        # synced in memory, nothing to do in the next run
+        self.provider.calls = []
+        models.ZoneSnapshot.sync(models.Record.objects.all())
+        self.assertEqual(self.provider.calls, ['list_records'])
+
+    def test_dns_sync_lists_once(self):
+        self.provider.records = [{'type': 'A', 'name': 'b.example.net', 'content': '9.9.9.9'}]
+        record = models.Record.objects.get(host='b')
+        record.dns_sync()
+        self.assertEqual(self.provider.calls, ['list_records', 'delete_record', 'create_record'])
+
+    def test_on_update_host_shares_zone(self):
+        record = models.Record.objects.get(host='a')
+        record.host = 'd'
+        record.save()
+        self.assertEqual(self.provider.calls, ['list_records', 'delete_record', 'create_record'])
+        self.assertEqual(self.provider.list_records('A', 'a'), [])
+        self.assertEqual(len(self.provider.list_records('A', 'd')), 1)
+
+    def test_sync_without_api(self):
+        self.domain.nameserver = None
+        self.domain.save()
+        for (record, result) in models.ZoneSnapshot.sync(models.Record.objects.all()):
+            self.assertEqual(result['message'], 'Please configure Nameserver properly for the domain first.')
+        self.assertEqual(self.provider.calls, [])
+
+
+
+class MockAnswer(list):
+    """
+    A resolver answer of the contents, with the TTL.
+    """
+    def __init__(self, contents, ttl=300):
+        super(MockAnswer, self).__init__(MagicMock(**{'to_text.return_value': content}) for content in contents)
+        self.rrset = MagicMock(ttl=ttl)
+
+
+class DnsQueryTestCase(AppTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.answers = {
+            ('vpn.example.net', 'A'): MockAnswer(['1.1.1.1', '2.2.2.2'], ttl=300),
+            ('www.example.net', 'A'): MockAnswer(['3.3.3.3'], ttl=86400),
+        }
+        patcher = patch.object(models.dns.resolver, 'query', side_effect=self.query)
+        self.query_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        cache.clear()
+
+    def query(self, fqdn, rdtype):
+        if fqdn == 'timeout.example.net':
+            raise dns.resolver.LifetimeTimeout(timeout=1, errors=[])
+        if (fqdn, rdtype) not in self.answers:
+            raise dns.resolver.NXDOMAIN()
+        return self.answers[(fqdn, rdtype)]
+
+    def test_resolve_many(self):
+        pairs = [('vpn.example.net', 'A'), ('www.example.net', 'A'), ('none.example.net', 'A')]
+        results = models.DnsQuery.resolve_many(pairs)
+        self.assertEqual(results, {
+            ('vpn.example.net', 'A'): {'1.1.1.1', '2.2.2.2'},
+            ('www.example.net', 'A'): {'3.3.3.3'},
+            ('none.example.net', 'A'): set(),
+        })
+        self.assertEqual(self.query_mock.call_count, 3)
+
+        # answered from the cache
+        self.assertEqual(models.DnsQuery.resolve_many(pairs), results)
+        self.assertEqual(self.query_mock.call_count, 3)
+
+        # bypass the cache
+        models.DnsQuery.resolve_many(pairs, from_cache=False)
+        self.assertEqual(self.query_mock.call_count, 6)
+
+    def test_cache_timeouts(self):
+        with patch.object(cache, 'set_many') as set_many:
+            models.DnsQuery.resolve_many([('vpn.example.net', 'A'), ('www.example.net', 'A'), ('none.example.net', 'A')])
+        timeouts = dict((list(call[0][0])[0], call[1]['timeout']) for call in set_many.call_args_list)
+        self.assertEqual(timeouts, {
+            models.DnsQuery.get_cache_key('vpn.example.net', 'A'): 300,
+            models.DnsQuery.get_cache_key('www.example.net', 'A'): models.DnsQuery.timeout,
+            models.DnsQuery.get_cache_key('none.example.net', 'A'): models.DnsQuery.negative_timeout,
+        })
+
+    def test_failure_not_cached(self):
+        self.assertIsNone(models.DnsQuery.resolve('timeout.example.net', 'A'))
+        self.assertIsNone(models.DnsQuery.resolve('timeout.example.net', 'A'))
+        self.assertEqual(self.query_mock.call_count, 2)
+
+    def test_record_verify_many(self):
+        domain = models.Domain.objects.create(name='example.net')
+        records = [models.Record.objects.create(host=host, domain=domain, type='A', answer='1.1.1.1,2.2.2.2')
+            for host in ['vpn', 'www', 'none']]
+        results = models.Record.verify_many(models.Record.objects.filter(domain=domain).select_related('domain__nameserver'))
+        self.assertEqual(results[records[0].pk], {
+            'answer_from_dns_query': {'1.1.1.1', '2.2.2.2'},
+            'is_matching_dns_query': True,
+            'answer_from_dns_api': None,
+            'is_matching_dns_api': False,
+        })
+        self.assertFalse(results[records[1].pk]['is_matching_dns_query'])
+        self.assertEqual(results[records[2].pk]['answer_from_dns_query'], set())
+        self.assertEqual(self.query_mock.call_count, 3)
+        # the single record is answered from the cache
+        self.assertTrue(records[0].is_matching_dns_query)
+        self.assertEqual(self.query_mock.call_count, 3)
+
+    def test_admin_lazy_batch(self):
+        self.client.force_login(User.objects.create_superuser('mock-admin', 'admin@mock-example.com', 'mock-password'))
+        domain = models.Domain.objects.create(name='example.net')
+        records = [models.Record.objects.create(host=host, domain=domain, type='A', answer='3.3.3.3')
+            for host in ['vpn', 'www']]
+        ids = [record.pk for record in records]
+        response = self.client.get('/admin/domain/record/')
+        self.assertContains(response, 'lazy_batch="yes"', count=8)
+
+        response = self.client.get('/admin/domain/record/easy/lazy_batch/', {'ids': ','.join(str(pk) for pk in ids)})
+        data = response.json()
+        self.assertIn('icon-no.svg', data[str(ids[0])]['is_matching_dns_query'])
+        self.assertIn('icon-yes.svg', data[str(ids[1])]['is_matching_dns_query'])
+        self.assertEqual(data[str(ids[1])]['answer_from_dns_query'], "['3.3.3.3']")
+        self.assertEqual(self.query_mock.call_count, 2)
+
+    def test_api_verify(self):
+        self.client.force_login(User.objects.create_user('mock-user', 'user@mock-example.com', 'mock-password'))
+        domain = models.Domain.objects.create(name='example.net')
+        for host in ['vpn', 'www']:
+            models.Record.objects.create(host=host, domain=domain, type='A', answer='3.3.3.3')
+        response = self.client.get('/domain/record/verify/', {'domain': domain.pk})
+        self.assertEqual(response.status_code, 200)
+        data = dict((item['fqdn'], item) for item in response.json())
+        self.assertEqual(data['www.example.net']['answer_from_dns_query'], ['3.3.3.3'])
+        self.assertTrue(data['www.example.net']['is_matching_dns_query'])
+        self.assertFalse(data['vpn.example.net']['is_matching_dns_query'])
+        self.assertNotIn('is_matching_dns_api', data['vpn.example.net'])
+
+        self.client.get('/domain/record/verify/', {'domain': domain.pk, 'refresh': 'true'})
+        self.assertEqual(self.query_mock.call_count, 4)
+
+
 class ManagementCommandTestCase(AppTestCase):
 
     @classmethod
@@ -5,6 +5,8 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 
 import django_filters
+from rest_framework.decorators import action
+from rest_framework.response import Response
 
 from utils.viewsets import CompatModelViewSet
 
@@ -44,8 +46,29 @@ class DomainViewSet(CompatModelViewSet):
 
 class RecordViewSet(CompatModelViewSet):
     """
-    This viewset automatically provides `list` and `detail` actions.
+    This viewset automatically provides `list` and `detail` actions, and the `verify` action:
+    * the records filtered as the `list` action, verified against the DNS queries in one concurrent sweep.
+    * refresh: set to `true` to query the DNS instead of using the answers cached by their TTLs.
+    * api: set to `true` to verify against the DNS API too, with one listing of each zone.
     """
     queryset = models.Record.objects.all()
     serializer_class = serializers.RecordSerializer
     filter_fields = ['fqdn', 'host', 'domain', 'domain__name', 'type', 'answer', 'site', 'site__name', 'site__domain']
+
+    @staticmethod
+    def is_true(value):
+        return (value or '').lower() in ('1', 'true', 'yes')
+
+    @action(detail=False)
+    def verify(self, request):
+        records = list(self.filter_queryset(self.get_queryset()).select_related('domain__nameserver'))
+        results = models.Record.verify_many(records, from_cache=not self.is_true(request.query_params.get('refresh')),
+            api=self.is_true(request.query_params.get('api')))
+
+        data = []
+        for record in records:
+            item = {'id': record.pk, 'fqdn': record.fqdn, 'type': record.type, 'answers': sorted(record.answers)}
+            for (field, value) in results[record.pk].items():
+                item[field] = sorted(value) if isinstance(value, set) else value
+            data.append(item)
+        return Response(data)
@@ -17,6 +17,7 @@ class DynamicMethodModel(object):
       Inherit this class and set `dynamic_methods` in the subclass.
       Methods will be created with `dynamic_methods.template` and be available
       under the name of `dynamic_methods.method`.keys() at class level.
+      The methods are created once when the subclass is created, not on every instance.
       Each '%s' within `dynamic_methods.template` will be replaced with the value
       of `variables`.
       Set `property` True if want a @property decorator on the dynamic method.
@@ -71,10 +72,19 @@ class DynamicMethodModel(object):
     class Meta:
         abstract = True
 
-    def __init__(self, *args, **kwargs):
-        super(DynamicMethodModel, self).__init__(*args, **kwargs)
-
-        for dm in self.__class__.dynamic_methods:
+    def __init_subclass__(cls, **kwargs):
+        super(DynamicMethodModel, cls).__init_subclass__(**kwargs)
+        # the subclasses without their own dynamic_methods inherit the methods
+        if 'dynamic_methods' in cls.__dict__:
+            cls.create_methods()
+
+    @classmethod
+    def create_methods(cls):
+        """
+        Create the methods defined in `dynamic_methods` on the class.
+        This is done once at class creation, call it again if `dynamic_methods` is changed later.
+        """
+        for dm in cls.dynamic_methods:
             template = dm['template']
             method = dm['method']
 
@@ -89,13 +99,14 @@ class DynamicMethodModel(object):
                     logger.error('{}: {}: {}'.format(key, type(e).__name__, e))
                     continue
 
-                self.create_method(
+                cls.create_method(
                     data=data,
                     name=key,
                     decorator={'property': prop}
                 )
 
-    def create_method(self, data, name, decorator=None):
+    @classmethod
+    def create_method(cls, data, name, decorator=None):
         if isinstance(data, str):
             data = textwrap.dedent(data).strip()
             try:
@@ -115,4 +126,4 @@ class DynamicMethodModel(object):
         if decorator and decorator.get('property', None):
             func = property(func)
 
-        setattr(self.__class__, name, func)
+        setattr(cls, name, func)
@@ -3,7 +3,9 @@
 # py2.7 and py3 compatibility imports
 from __future__ import unicode_literals
 
+import copy
 from django.test import TestCase
+from unittest.mock import patch
 
 from dynamicmethod.models import DynamicMethodModel
 
@@ -64,8 +66,30 @@ class DynamicMethodModelTestCase(TestCase):
         self.assertEqual(obj.pet_dog(), 'woof')
         self.assertEqual(obj.pet_cat(), 'meow')
 
+    def test_dynamicmethodmodel_created_once(self):
+        self.assertIn('dog', PetStore.__dict__)
+        with patch.object(PetStore, 'create_method') as create_method:
+            obj = PetStore()
+            self.assertEqual(obj.dog, 'one black dog')
+        create_method.assert_not_called()
+
+    def test_dynamicmethodmodel_create_methods(self):
+        class FishStore(DynamicMethodModel):
+            dynamic_methods = [{'template': 'def fish(self): return "%s"', 'method': {}}]
+
+        FishStore.dynamic_methods[0]['method']['pet_fish'] = {'variables': ['blub']}
+        self.assertFalse(hasattr(FishStore(), 'pet_fish'))
+        FishStore.create_methods()
+        self.assertEqual(FishStore().pet_fish(), 'blub')
+
     def test_dynamicmethodmodel_negative(self):
+        dynamic_methods = copy.deepcopy(PetStore.dynamic_methods)
+        self.addCleanup(setattr, PetStore, 'dynamic_methods', dynamic_methods)
         PetStore.dynamic_methods[1]['method']['pet_duck'] = {'variables': ['quack', 'quack']}
+        # compile the changed definitions, the invalid one is skipped
+        with self.assertLogs('dynamicmethod.models', 'ERROR') as logs:
+            PetStore.create_methods()
+        self.assertIn('pet_duck: TypeError', logs.output[0])
         obj = PetStore()
         self.assertFalse(hasattr(obj, 'pet_duck'))
         self.assertEqual(obj.pet_dog(), 'woof')
@@ -83,7 +107,6 @@ class DynamicMethodModelTestCase(TestCase):
 
     def test_create_method_precompiled_code(self):
         import textwrap
-        import types
         code = compile(textwrap.dedent('def pet_fish(self): return "blub"').strip(), '<stdin>', 'exec')
         obj = PetStore()
         obj.create_method(data=code, name='pet_fish')
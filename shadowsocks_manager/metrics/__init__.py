@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# py2.7 and py3 compatibility imports
+from __future__ import unicode_literals
+from builtins import object
+
+import time
+import hashlib
+import threading
+import logging
+from contextlib import contextmanager
+from functools import wraps
+
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    """
+    The counters and latency histograms of the hot paths, exposed in the Prometheus text format by /metrics.
+
+    The values are recorded in the memory of the process, and added to the cache at most once per
+    `flush_interval` seconds:
+    * every series is an integer in the cache, added with cache.incr(), the seconds are kept in microseconds.
+    * every series is registered once in an append-only index: the `index_key` in the cache counts the
+      series, and the slot '<index_key>-<n>' keeps the cache key of the n-th series with its
+      (type, name, labels, part). The series are only added with cache.add() and cache.incr(), so the
+      processes flushing at the same time never overwrite the series of each other.
+
+    The web processes and the celery workers are summed up in one exposition only if they share the cache,
+    e.g. SSM_CACHES_BACKEND=memcached.PyMemcacheCache. With the default local-memory cache, each process
+    has its own series, and /metrics only shows the ones of the web process serving the request.
+
+    Usage:
+        metrics.inc('ssm_manager_call_failures_total', command='ping', node='node-1', reason='timeout')
+        metrics.observe('ssm_manager_call_seconds', 0.01, command='ping', node='node-1')
+        with metrics.timer('ssm_dns_call_seconds', method='list_records', domain='example.com'):
+            ...
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    flush_interval = 10
+    index_key = 'metrics-index'
+    key_prefix = 'metrics-'
+
+    def __init__(self, *args, **kwargs):
+        super(Metrics, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._values = {}
+        self._flushed = time.time()
+
+    @staticmethod
+    def labels(labels):
+        return tuple(sorted((key, '{}'.format(value)) for (key, value) in labels.items()))
+
+    def _add(self, series, value):
+        with self._lock:
+            self._values[series] = self._values.get(series, 0) + value
+
+    def inc(self, metric, value=1, **labels):
+        self._add(('counter', metric, self.labels(labels), ''), value)
+        self.flush(force=False)
+
+    def observe(self, metric, seconds, **labels):
+        labels = self.labels(labels)
+        le = '+Inf'
+        for bucket in self.buckets:
+            if seconds <= bucket:
+                le = '{}'.format(bucket)
+                break
+        self._add(('histogram', metric, labels, le), 1)
+        self._add(('histogram', metric, labels, 'count'), 1)
+        self._add(('histogram', metric, labels, 'sum'), int(round(seconds * 1000000)))
+        self.flush(force=False)
+
+    @contextmanager
+    def timer(self, metric, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(metric, time.time() - start, **labels)
+
+    def timed(self, metric, **labels):
+        """
+        The decorator version of timer().
+        """
+        def decorator(func):
+            @wraps(func)
+            def _timed(*args, **kwargs):
+                with self.timer(metric, **labels):
+                    return func(*args, **kwargs)
+            return _timed
+        return decorator
+
+    def get_cache_key(self, series):
+        return '{}{}'.format(self.key_prefix, hashlib.md5(repr(series).encode('utf-8')).hexdigest())
+
+    def flush(self, force=True):
+        """
+        Add the values recorded since the last flush to the cache.
+        The values are dropped if the cache is unavailable, the metrics never break the callers.
+        """
+        with self._lock:
+            if not self._values or not force and time.time() - self._flushed < self.flush_interval:
+                return
+            values = self._values
+            self._values = {}
+            self._flushed = time.time()
+
+        try:
+            keys = dict((self.get_cache_key(series), series) for series in values)
+            self.register(keys)
+            for (key, series) in keys.items():
+                try:
+                    cache.incr(key, values[series])
+                except ValueError:
+                    # the key doesn't exist, or it is added by other process in the meantime
+                    if not cache.add(key, values[series], None):
+                        cache.incr(key, values[series])
+        except Exception as e:
+            logger.warning('%s: failed to flush the metrics: %s' % (self.__class__.__name__, e))
+
+    def register(self, keys):
+        """
+        Add the series not registered yet to the index, see the class docstring.
+        """
+        for (key, series) in keys.items():
+            # only the first process adding the mark registers the series
+            if not cache.add('%s-registered' % key, 1, None):
+                continue
+            cache.add(self.index_key, 0, None)
+            n = cache.incr(self.index_key)
+            cache.set('%s-%s' % (self.index_key, n), (key, series), None)
+
+    def get_index(self):
+        """
+        Return the index of all the series: {<cache key>: (type, name, labels, part), ...}
+        """
+        count = cache.get(self.index_key) or 0
+        slots = cache.get_many(['%s-%s' % (self.index_key, n) for n in range(1, count + 1)])
+        return dict(slots.values())
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+        count = cache.get(self.index_key) or 0
+        keys = list(self.get_index())
+        cache.delete_many(keys + ['%s-registered' % key for key in keys] +
+            ['%s-%s' % (self.index_key, n) for n in range(1, count + 1)] + [self.index_key])
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        escape = lambda value: value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{%s}' % ','.join('%s="%s"' % (key, escape(value)) for (key, value) in labels)
+
+    def render(self):
+        """
+        Return the series of all the processes in the Prometheus text exposition format.
+        """
+        self.flush()
+        index = self.get_index()
+        values = cache.get_many(list(index))
+
+        families = {}
+        for (key, (kind, name, labels, part)) in index.items():
+            series = families.setdefault(name, (kind, {}))[1].setdefault(labels, {})
+            series[part] = values.get(key, 0)
+
+        lines = []
+        for name in sorted(families):
+            (kind, family) = families[name]
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels in sorted(family):
+                parts = family[labels]
+                if kind == 'counter':
+                    lines.append('%s%s %s' % (name, self.format_labels(labels), parts.get('', 0)))
+                    continue
+                cumulative = 0
+                for le in ['{}'.format(bucket) for bucket in self.buckets] + ['+Inf']:
+                    cumulative += parts.get(le, 0)
+                    lines.append('%s_bucket%s %s' % (name, self.format_labels(labels + (('le', le),)), cumulative))
+                lines.append('%s_sum%s %.6f' % (name, self.format_labels(labels), parts.get('sum', 0) / 1000000.0))
+                lines.append('%s_count%s %s' % (name, self.format_labels(labels), parts.get('count', 0)))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+# py2.7 and py3 compatibility imports
+from __future__ import unicode_literals
+
+import time
+
+from django.apps import AppConfig
+
+
+class MetricsConfig(AppConfig):
+    name = 'metrics'
+
+    def ready(self):
+        from celery import signals
+
+        signals.task_prerun.connect(task_prerun, weak=False)
+        signals.task_postrun.connect(task_postrun, weak=False)
+        signals.task_failure.connect(task_failure, weak=False)
+
+
+# the start time of the running celery tasks, by task id
+_task_starts = {}
+
+
+def task_prerun(task_id=None, task=None, **kwargs):
+    _task_starts[task_id] = time.time()
+
+
+def task_postrun(task_id=None, task=None, state=None, **kwargs):
+    from . import metrics
+
+    start = _task_starts.pop(task_id, None)
+    if start is not None:
+        metrics.observe('ssm_celery_task_seconds', time.time() - start, task=task.name, state=state)
+    # the workers may be idle for long, publish the values of the task now
+    metrics.flush()
+
+
+def task_failure(sender=None, **kwargs):
+    from . import metrics
+
+    metrics.inc('ssm_celery_task_failures_total', task=sender.name)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# py2.7 and py3 compatibility imports
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from unittest.mock import patch, MagicMock
+
+from metrics import Metrics, metrics, apps
+
+
+import logging
+# Get a logger for this django app
+logger = logging.getLogger(__name__.split('.')[-2])
+# Set the logging level to make the output clean
+logger.setLevel(logging.CRITICAL)
+
+
+# Create your tests here.
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        metrics.clear()
+
+    def tearDown(self):
+        metrics.clear()
+
+    def test_counter(self):
+        metrics.inc('test_total', node='node-1')
+        metrics.inc('test_total', 2, node='node-1')
+        metrics.inc('test_total', node='node-2')
+        text = metrics.render()
+        self.assertIn('# TYPE test_total counter\n', text)
+        self.assertIn('test_total{node="node-1"} 3\n', text)
+        self.assertIn('test_total{node="node-2"} 1\n', text)
+
+    def test_histogram(self):
+        metrics.observe('test_seconds', 0.003, command='ping')
+        metrics.observe('test_seconds', 0.2, command='ping')
+        metrics.observe('test_seconds', 30, command='ping')
+        text = metrics.render()
+        self.assertIn('# TYPE test_seconds histogram\n', text)
+        self.assertIn('test_seconds_bucket{command="ping",le="0.005"} 1\n', text)
+        self.assertIn('test_seconds_bucket{command="ping",le="0.1"} 1\n', text)
+        self.assertIn('test_seconds_bucket{command="ping",le="0.25"} 2\n', text)
+        self.assertIn('test_seconds_bucket{command="ping",le="10"} 2\n', text)
+        self.assertIn('test_seconds_bucket{command="ping",le="+Inf"} 3\n', text)
+        self.assertIn('test_seconds_sum{command="ping"} 30.203000\n', text)
+        self.assertIn('test_seconds_count{command="ping"} 3\n', text)
+
+    def test_timer(self):
+        with metrics.timer('test_seconds', method='list'):
+            pass
+        self.assertIn('test_seconds_count{method="list"} 1\n', metrics.render())
+
+    def test_label_escaping(self):
+        metrics.inc('test_total', name='a "quoted"\\name')
+        self.assertIn('test_total{name="a \\"quoted\\"\\\\name"} 1\n', metrics.render())
+
+    def test_flush_interval(self):
+        other = Metrics()
+        other.inc('test_total')
+        # not flushed within the interval
+        self.assertNotIn('test_total', metrics.render())
+        other.flush()
+        self.assertIn('test_total 1\n', metrics.render())
+
+    def test_processes_summed(self):
+        # the instances stand for the processes sharing the cache
+        (process1, process2) = (Metrics(), Metrics())
+        process1.inc('test_total', node='node-1')
+        process2.inc('test_total', node='node-1')
+        process2.inc('test_total', node='node-2')
+        process1.flush()
+        process2.flush()
+        text = metrics.render()
+        self.assertIn('test_total{node="node-1"} 2\n', text)
+        self.assertIn('test_total{node="node-2"} 1\n', text)
+
+    def test_index_not_overwritten(self):
+        (process1, process2) = (Metrics(), Metrics())
+        process1.inc('test_total', node='node-1')
+        process2.inc('test_total', node='node-2')
+        incr = cache.incr
+
+        def side_effect(key, *args, **kwargs):
+            # process2 flushes its new series while process1 is in the middle of registering its own
+            if key == Metrics.index_key and process2._values:
+                process2.flush()
+            return incr(key, *args, **kwargs)
+
+        with patch.object(cache, 'incr', side_effect=side_effect):
+            process1.flush()
+        text = metrics.render()
+        self.assertIn('test_total{node="node-1"} 1\n', text)
+        self.assertIn('test_total{node="node-2"} 1\n', text)
+
+    def test_cache_unavailable(self):
+        metrics.inc('test_total')
+        with patch.object(cache, 'add', side_effect=Exception('unavailable')):
+            metrics.flush()
+        self.assertNotIn('test_total', metrics.render())
+
+    def test_celery_signals(self):
+        task = MagicMock()
+        task.name = 'shadowsocks.tasks.heartbeat'
+        apps.task_prerun(task_id='task-1', task=task)
+        apps.task_postrun(task_id='task-1', task=task, state='SUCCESS')
+        apps.task_failure(sender=task)
+        text = metrics.render()
+        self.assertIn('ssm_celery_task_seconds_count{state="SUCCESS",task="shadowsocks.tasks.heartbeat"} 1\n', text)
+        self.assertIn('ssm_celery_task_failures_total{task="shadowsocks.tasks.heartbeat"} 1\n', text)
+
+
+class MetricsViewTestCase(TestCase):
+
+    def setUp(self):
+        metrics.clear()
+
+    def test_allowed_ip(self):
+        metrics.inc('test_total')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn(b'test_total 1\n', response.content)
+
+    @override_settings(METRICS_ALLOWED_IPS=[])
+    def test_forbidden(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+    @override_settings(METRICS_ALLOWED_IPS=[])
+    def test_staff(self):
+        self.client.force_login(User.objects.create(username='staff', is_staff=True))
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
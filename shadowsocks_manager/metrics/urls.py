@@ -0,0 +1,12 @@
+# py2.7 and py3 compatibility imports
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from django.urls import re_path
+
+from . import views
+
+
+urlpatterns = [
+    re_path(r'^metrics/?$', views.metrics_view, name='metrics'),
+]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+# py2.7 and py3 compatibility imports
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from . import metrics
+
+
+# Create your views here.
+
+def metrics_view(request):
+    """
+    The Prometheus text exposition of the metrics, for the staff users and the scrapers from METRICS_ALLOWED_IPS.
+    """
+    user = getattr(request, 'user', None)
+    if not (user and user.is_staff) and request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
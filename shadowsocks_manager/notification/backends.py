@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from email.utils import parseaddr
+from django.core.mail.backends.base import BaseEmailBackend
+
+from .models import Notify
+
+
+logger = logging.getLogger(__name__)
+
+
+class SendmailBackend(BaseEmailBackend):
+    """
+    The Email backend sending each message with the local `sendmail` command, see Notify.sendmail().
+    Use the SMTP backend to send the messages in bulk over one connection:
+        django.core.mail.backends.smtp.EmailBackend
+    """
+
+    def send_messages(self, email_messages):
+        sent = 0
+        for message in email_messages:
+            # the recipients are passed explicitly, the Bcc header is left out of the message by Django
+            recipients = message.recipients()
+            if not recipients:
+                continue
+            # the sender of the caller, see Notify.build_message()
+            (sender, email) = getattr(message, 'notify_sender', None) or parseaddr(message.from_email)
+            try:
+                if Notify.sendmail(message.message().as_bytes(), sender, email, recipients=recipients):
+                    sent += 1
+            except Exception as e:
+                logger.error('sendmail: %s' % e)
+                if not self.fail_silently:
+                    raise
+        return sent
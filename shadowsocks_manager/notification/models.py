@@ -5,8 +5,11 @@ from builtins import bytes
 import logging
 import subprocess
 from subprocess import PIPE
+from email import message_from_string
+from email.utils import formataddr, getaddresses
 from django.db import models
 from django.template import engines
+from django.core.mail import EmailMessage, get_connection
 
 
 logger = logging.getLogger(__name__)
@@ -25,9 +28,21 @@ class Template(models.Model):
         verbose_name = 'Notification Template'
         unique_together = ('type', 'is_active')
 
+    # the compiled templates by content, shared in the process
+    _compiled = {}
+    _compiled_max = 32
+
     @property
     def template(self):
-        return engines['django'].from_string(self.content)
+        """
+        The compiled template, compiled once for the same content.
+        """
+        template = Template._compiled.get(self.content)
+        if template is None:
+            if len(Template._compiled) >= Template._compiled_max:
+                Template._compiled.clear()
+            template = Template._compiled[self.content] = engines['django'].from_string(self.content)
+        return template
 
     def __str__(self):
         return self.type
@@ -42,11 +57,18 @@ class Template(models.Model):
 class Notify(models.Model):
 
     @classmethod
-    def sendmail(cls, message, sender, email):
+    def sendmail(cls, message, sender, email, recipients=None):
+        """
+        Send the message with the local `sendmail` command.
+        The recipients are read from the headers of the message if not given, the Bcc header included.
+        """
         command = ["sendmail",
                        "-F", sender,
-                       "-f", email,
-                       "-t"]
+                       "-f", email]
+        if recipients:
+            command += ["--"] + list(recipients)
+        else:
+            command += ["-t"]
 
         if isinstance(message, str):
             message = bytes(message, 'utf-8')
@@ -61,3 +83,43 @@ class Notify(models.Model):
             return False
         else:
             return True
+
+    @classmethod
+    def build_message(cls, message, sender, email):
+        """
+        Build an EmailMessage from the rendered message in the format read by `sendmail -t`:
+        the headers Subject, To, Cc and Bcc, followed by the body.
+        The sender and the email are kept as given for the envelope of `sendmail`, see SendmailBackend.
+        """
+        msg = message_from_string(message)
+        addresses = lambda header: [addr for (name, addr) in getaddresses(msg.get_all(header, [])) if addr]
+        email_message = EmailMessage(
+            subject=msg.get('Subject', ''),
+            body=msg.get_payload(),
+            from_email=formataddr((sender, email)),
+            to=addresses('To'),
+            cc=addresses('Cc'),
+            bcc=addresses('Bcc'))
+        email_message.notify_sender = (sender, email)
+        return email_message
+
+    @classmethod
+    def send_messages(cls, messages, connection=None):
+        """
+        Send the EmailMessages in bulk over one connection of the Email backend, which is set by
+        settings.EMAIL_BACKEND. Return the number of the messages sent.
+        """
+        if not messages:
+            return 0
+        connection = connection or get_connection()
+        return connection.send_messages(messages) or 0
+
+    @classmethod
+    def close_connection(cls, connection):
+        """
+        Close the connection of the Email backend, the errors on closing a broken connection are ignored.
+        """
+        try:
+            connection.close()
+        except Exception as e:
+            logger.warning('%s: failed to close the Email connection: %s' % (cls.__name__, e))
@@ -6,10 +6,11 @@ from __future__ import absolute_import
 
 import json
 from abc import abstractmethod
+from django.core import mail
 from django.test import TestCase
 from unittest.mock import patch, MagicMock, PropertyMock
 
-from notification import models, serializers
+from notification import models, serializers, backends
 
 
 import logging
@@ -118,3 +119,48 @@ class NotificationTestCase(AppTestCase):
         with patch('notification.models.subprocess.Popen', return_value=mock_proc):
             result = models.Notify.sendmail('Subject: test\r\n', 'No Reply', 'noreply@localhost')
         self.assertFalse(result)
+
+    def test_template_compiled_once(self):
+        obj = models.Template.objects.first()
+        self.assertIs(obj.template, models.Template.objects.first().template)
+        obj.content = 'Subject: changed'
+        self.assertIsNot(obj.template, models.Template.objects.first().template)
+
+    def test_notify_build_message(self):
+        message = 'Subject: test\r\nTo: a@localhost, B <b@localhost>\r\nBcc: c@localhost\r\n\r\nhello'
+        msg = models.Notify.build_message(message, 'No Reply', 'noreply@localhost')
+        self.assertEqual(msg.subject, 'test')
+        self.assertEqual(msg.to, ['a@localhost', 'b@localhost'])
+        self.assertEqual(msg.bcc, ['c@localhost'])
+        self.assertEqual(msg.from_email, 'No Reply <noreply@localhost>')
+        self.assertEqual(msg.body.strip(), 'hello')
+
+    def test_notify_send_messages(self):
+        messages = [models.Notify.build_message('Subject: test %s\r\nTo: nobody@localhost\r\n\r\nbody' % i,
+            'No Reply', 'noreply@localhost') for i in range(3)]
+        self.assertEqual(models.Notify.send_messages([]), 0)
+        self.assertEqual(models.Notify.send_messages(messages), 3)
+        self.assertEqual([m.subject for m in mail.outbox], ['test 0', 'test 1', 'test 2'])
+
+    def test_sendmail_backend(self):
+        messages = [models.Notify.build_message('Subject: test\r\nTo: nobody@localhost\r\n\r\nbody',
+            'No Reply', 'noreply@localhost') for i in range(2)]
+        with patch.object(models.Notify, 'sendmail', side_effect=[True, False]) as mock_sendmail:
+            self.assertEqual(backends.SendmailBackend().send_messages(messages), 1)
+        self.assertEqual(mock_sendmail.call_count, 2)
+        (message, sender, email) = mock_sendmail.call_args[0]
+        self.assertIn(b'Subject: test', message)
+        self.assertEqual((sender, email), ('No Reply', 'noreply@localhost'))
+        self.assertEqual(mock_sendmail.call_args[1], {'recipients': ['nobody@localhost']})
+
+    def test_sendmail_backend_bcc(self):
+        # the sender without email, e.g. an unsaved User()
+        message = models.Notify.build_message('Subject: test\r\nTo: a@localhost\r\nBcc: c@localhost\r\n\r\nbody', '', '')
+        mock_proc = MagicMock()
+        mock_proc.communicate.return_value = (b'', b'')
+        mock_proc.wait.return_value = 0
+        with patch('notification.models.subprocess.Popen', return_value=mock_proc) as mock_popen:
+            self.assertEqual(backends.SendmailBackend().send_messages([message]), 1)
+        command = mock_popen.call_args[0][0]
+        self.assertEqual(command, ['sendmail', '-F', '', '-f', '', '--', 'a@localhost', 'c@localhost'])
+        self.assertNotIn(b'c@localhost', mock_proc.communicate.call_args[0][0])
@@ -4,16 +4,41 @@
 from __future__ import unicode_literals
 
 from django.contrib import admin, messages
+from django.core.cache import cache
 from django.template.defaultfilters import filesizeformat
+from django.urls import reverse
+from django.utils.html import format_html, format_html_join
 from import_export import resources
 from import_export.admin import ImportExportModelAdmin
 from admin_lazy_load import LazyLoadAdminMixin
 
-from .models import Config, Node, Account, NodeAccount, SSManager
+from utils.admin import BatchLazyLoadAdminMixin
+
+from .models import Config, Node, Account, NodeAccount, SSManager, Job, JobStatusList
+from .tasks import job_run
 
 
 # Register your models here.
 
+def dispatch_job(request, action, queryset):
+    """
+    Run the bulk action on the selected objects as a background job, instead of in the request.
+    """
+    job = Job.create(action, queryset, user=request.user)
+    try:
+        job_run.delay(job.pk)
+    except Exception as e:
+        job.status = JobStatusList.ABORTED
+        job.error = str(e)
+        job.save()
+        messages.error(request, '{}: not queued: {}'.format(job, e))
+        return
+
+    url = reverse('admin:shadowsocks_job_change', args=(job.pk,))
+    messages.info(request, format_html('<a href="{}">{}</a>: queued for {} object(s), check the progress on the job.',
+        url, job, job.total))
+
+
 class HiddenModelAdmin(admin.ModelAdmin):
     def get_model_perms(self, request):
         """
@@ -36,15 +61,25 @@ class ConfigAdmin(admin.ModelAdmin):
         return None
 
 
-class NodeAccountLazyMixin(LazyLoadAdminMixin):
+class NodeAccountLazyMixin(BatchLazyLoadAdminMixin):
     lazy_loaded_fields = ('is_created', 'is_accessible_ex',)
 
+    def get_queryset(self, request):
+        return super(NodeAccountLazyMixin, self).get_queryset(request).select_related('node', 'account')
+
+    def lazy_batch(self, objs):
+        return NodeAccount.resolve_many(objs)
+
     def is_created(self, obj):
         return obj.is_created()
 
     is_created.boolean = True
 
     def is_accessible_ex(self, obj):
+        # on a cache miss, the first of the lazy requests tests all the ports on the node in one scan
+        lock = '{0}:scan'.format(obj.node.public_ip)
+        if obj.cache_key not in cache and cache.add(lock, True, timeout=int(Config.load().timeout_remote) + 1):
+            NodeAccount.scan_accessible(obj.node.accounts_ref.select_related('node', 'account'))
         return obj.is_accessible_ex()
 
     is_accessible_ex.boolean = True
@@ -58,6 +93,9 @@ class ReadonlyNodeAccountInline(NodeAccountLazyMixin, admin.TabularInline):
                        'dt_collected', 'dt_created', 'dt_updated')
     fields = ('node', 'account',) + readonly_fields + ('is_active',)
 
+    def get_queryset(self, request):
+        return super(ReadonlyNodeAccountInline, self).get_queryset(request).with_totals()
+
     def transferred_totally(self, obj):
         return filesizeformat(obj.transferred_totally)
 
@@ -107,13 +145,19 @@ class SSManagerAdmin(SSManagerLazyMixin, HiddenModelAdmin):
 
 
 @admin.register(Node)
-class NodeAdmin(LazyLoadAdminMixin, admin.ModelAdmin):
+class NodeAdmin(BatchLazyLoadAdminMixin, admin.ModelAdmin):
     readonly_fields = ('transferred_totally', 'dt_collected', 'dt_created', 'dt_updated')
     fields = ('name', 'record', 'public_ip', 'private_ip', 'is_active', 'location',)
     list_display = fields + ('is_matching_dns_query_lazy',) + readonly_fields
     fields = fields + ('sns_endpoint', 'sns_access_key', 'sns_secret_key',) + readonly_fields
     lazy_loaded_fields = ('is_matching_dns_query',)
 
+    def get_queryset(self, request):
+        return super(NodeAdmin, self).get_queryset(request).with_totals().select_related('record')
+
+    def lazy_batch(self, objs):
+        return Node.match_dns_query_many(objs)
+
     def is_matching_dns_query(self, obj):
         return obj.is_matching_dns_query
 
@@ -138,22 +182,12 @@ class NodeAdmin(LazyLoadAdminMixin, admin.ModelAdmin):
     exclude = ('node',)
 
     def toggle_active(self, request, queryset):
-        for obj in queryset:
-            obj.toggle_active()
-            messages.info(request, '{}: now is {}'.format(obj, 'Active' if obj.is_active else 'Inactive'))
+        dispatch_job(request, Job.NODE_TOGGLE_ACTIVE, queryset)
 
     toggle_active.short_description = 'Toggle Active/Inactive for Selected Shadowsocks Nodes'
 
     def change_ip(self, request, queryset):
-        for obj in queryset:
-            try:
-                obj.change_ip()
-            except Exception as e:
-                messages.error(request, '{}: {}'.format(obj, e))
-                return
-
-            message = 'The message is sent to the SNS topic to request a new IP address.'
-            messages.info(request, '{}: {}'.format(obj, message))
+        dispatch_job(request, Job.NODE_CHANGE_IP, queryset)
 
     change_ip.short_description = 'Replace the IP address with a new one for Selected Shadowsocks Nodes'
 
@@ -176,6 +210,9 @@ class AccountAdmin(ImportExportModelAdmin):
     fields = ('username', 'password',) + fields
     readonly_fields = ('groups',) + readonly_fields
 
+    def get_queryset(self, request):
+        return super(AccountAdmin, self).get_queryset(request).with_totals()
+
     def transferred_totally(self, obj):
         return filesizeformat(obj.transferred_totally)
 
@@ -193,31 +230,45 @@ class AccountAdmin(ImportExportModelAdmin):
     exclude = ('account',)
 
     def notify(self, request, queryset):
-        for obj in queryset:
-            try:
-                to = '{}<{}>'.format(obj.get_full_name(), obj.email)
-                if obj.notify(sender=request.user):
-                    messages.info(request, '{}: Message queued for {}.'.format(obj, to))
-                else:
-                    messages.error(request, '{}: Message not queued for {}.'.format(obj, to))
-            except Exception as e:
-                messages.error(request, '{}: {}'.format(obj, e))
+        dispatch_job(request, Job.ACCOUNT_NOTIFY, queryset)
 
     notify.short_description = 'Send Notification Email to Selected Shadowsocks Accounts'
 
     def toggle_active(self, request, queryset):
-        for obj in queryset:
-            obj.toggle_active()
-            messages.info(request, '{}: now is {}'.format(obj, 'Active' if obj.is_active else 'Inactive'))
+        dispatch_job(request, Job.ACCOUNT_TOGGLE_ACTIVE, queryset)
 
     toggle_active.short_description = 'Toggle Active/Inactive for Selected Shadowsocks Accounts'
 
     def add_all_nodes(self, request, queryset):
-        for obj in queryset:
-            nodes = obj.add_all_nodes()
-            messages.info(request, '{}: Added {}'.format(obj, nodes))
+        dispatch_job(request, Job.ACCOUNT_ADD_ALL_NODES, queryset)
 
     add_all_nodes.short_description = 'Add All Nodes to Selected Shadowsocks Accounts'
 
     actions = (toggle_active, notify, add_all_nodes,)
     resource_class = AccountResource
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    """
+    The jobs are created by the bulk actions of the nodes and accounts, and are read only.
+    Reload the page to poll the progress of a running job.
+    """
+    actions = None
+    fields = ('action', 'status', 'progress', 'total', 'done', 'failed', 'user', 'dt_created', 'dt_updated')
+    list_display = ('__str__',) + fields
+    list_filter = ('action', 'status')
+    fields = fields + ('error', 'results_display')
+    readonly_fields = fields
+
+    def results_display(self, obj):
+        return format_html('<ul>{}</ul>', format_html_join('', '<li>{}: {}: {}</li>',
+            ((result['object'], 'OK' if result['ok'] else 'FAILED', result['message']) for result in obj.results)))
+
+    results_display.short_description = 'Results'
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+# py2.7 and py3 compatibility imports
+from __future__ import unicode_literals
+
+from .models import PortSync
+
+
+class PortSyncMiddleware(object):
+    """
+    Run each request in a PortSync.deferred() block, so the port changes made by the request
+    are reconciled once for each node after the request, instead of one by one.
+    The reconcile is handed to the celery worker by default, see PortSync.flush().
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with PortSync.deferred(request=True):
+            return self.get_response(request)
@@ -4,27 +4,34 @@ from builtins import bytes
 from builtins import str
 from builtins import range
 
-import sys, os, socket, time, json
+import sys, os, socket, time, json, uuid, errno
+import selectors
 import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
 import subprocess, psutil
 from subprocess import PIPE
 from ipaddress import ip_address
-from django.db import models
+from django.conf import settings
+from django.db import models, connection, transaction
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from django.contrib.auth.models import User, Group
+from django.contrib.auth.models import User, Group, UserManager
 from django.contrib.contenttypes.fields import GenericRelation
 from django.core.exceptions import ValidationError
 from django.core.cache import cache
+from django.core.mail import get_connection
 from django.utils.translation import gettext_lazy as _
 from django_enumfield import enum
 import boto3
 
 from retry import retry
+from metrics import metrics
 from singleton.models import SingletonModel
 from dynamicmethod.models import DynamicMethodModel
 from notification.models import Template, Notify
-from domain.models import Record
+from domain.models import Record, DnsQuery
 
 
 logger = logging.getLogger(__name__)
@@ -54,6 +61,34 @@ class Config(SingletonModel):
         verbose_name = 'Shadowsocks Configuration'
 
 
+class StatisticMethodQuerySet(models.QuerySet):
+
+    def with_totals(self):
+        """
+        Annotate the Total statistic on the objects with a single join, the StatisticMethod
+        properties use the annotated values instead of querying the statistic for each object.
+        The Total period is matched by a subquery, FilteredRelation doesn't support nested relations.
+        """
+        from statistic.models import Period
+        period = Period.objects.filter(year=None, month=None).order_by('pk').values('pk')[:1]
+        return self.annotate(
+            total_statistic=models.FilteredRelation('statistic', condition=models.Q(
+                statistic__period=models.Subquery(period))),
+        ).annotate(
+            total_transferred_past=models.F('total_statistic__transferred_past'),
+            total_transferred_live=models.F('total_statistic__transferred_live'),
+            total_transferred=models.F('total_statistic__transferred_past') + models.F('total_statistic__transferred_live'),
+            total_dt_collected=models.F('total_statistic__dt_collected'),
+        )
+
+
+class AccountManager(UserManager.from_queryset(StatisticMethodQuerySet)):
+    """
+    A named class is required by the migrations since UserManager is used in migrations.
+    """
+    pass
+
+
 class StatisticMethod(models.Model, DynamicMethodModel):
 
     ## each '%s' within <template> will be replaced with the value of <variables> ##
@@ -61,16 +96,7 @@ class StatisticMethod(models.Model, DynamicMethodModel):
         'template': '''
 
 def dynamic_method_template(self):
-    from statistic.models import Statistic, Period
-    period = Period.objects.filter(year=None, month=None).first()
-    kwargs = {
-        self.__class__.__name__.lower(): self,
-        "period": period
-    }
-    try:
-        return Statistic.objects.get(**kwargs).%s
-    except Statistic.DoesNotExist: pass
-    except Statistic.MultipleObjectsReturned: pass
+    return self.get_total_statistic('%s')
 
 ''',
 
@@ -94,12 +120,35 @@ def dynamic_method_template(self):
         }
     }]
 
+    objects = models.Manager.from_queryset(StatisticMethodQuerySet)()
+
     class Meta:
         abstract = True
 
+    def get_total_statistic(self, name):
+        """
+        Return the attribute of the Total statistic of the object, or None if there's no statistic.
+        The value annotated by StatisticMethodQuerySet.with_totals() is used if present.
+        """
+        key = 'total_%s' % name
+        if key in self.__dict__:
+            return self.__dict__[key]
+
+        from statistic.models import Statistic, Period
+        period = Period.objects.filter(year=None, month=None).first()
+        kwargs = {
+            self.__class__.__name__.lower(): self,
+            "period": period
+        }
+        try:
+            return getattr(Statistic.objects.get(**kwargs), name)
+        except Statistic.DoesNotExist: pass
+        except Statistic.MultipleObjectsReturned: pass
+
 
 class Account(User, StatisticMethod):
     statistic = GenericRelation('statistic.Statistic', related_query_name='account')
+    objects = AccountManager()
     dt_updated = models.DateTimeField('Updated', auto_now=True)
 
     class Meta:
@@ -130,9 +179,10 @@ class Account(User, StatisticMethod):
 
         return ret
 
-    def notify(self, sender=User()):
+    def render_notification(self, template, sender, nas=None):
         """
-        Send account owner the account information by email.
+        Validate and render the notification Email to the account owner with the template.
+        The active nodeaccounts of the account are looked up if not given.
         """
         if not self.email:
             raise ValidationError({'email': ["There's no Email address configured for %s." % self.get_full_name()]})
@@ -141,13 +191,12 @@ class Account(User, StatisticMethod):
             raise ValidationError({'is_active': ["Skipped sending account Email to %s(%s), beacause the user is "
                 "inactive." % (self.email, self.get_full_name)]})
 
-        nas = self.nodes_ref.filter(is_active=True)
+        if nas is None:
+            nas = self.nodes_ref.filter(is_active=True)
         if not nas:
             raise ValidationError("Skipped sending account Email to %s(%s), there's no active node "
                 "assigned." % (self.email, self.get_full_name()))
 
-        template = Template.objects.get(type='account_created')
-
         kwargs = {'account': self, 'node_accounts': []}
         for na in nas:
             d = {}
@@ -156,20 +205,81 @@ class Account(User, StatisticMethod):
             d['account'] = na.account
         kwargs['sender'] = sender
 
-        message = template.render(kwargs)
+        return template.render(kwargs)
+
+    def notify(self, sender=User()):
+        """
+        Send account owner the account information by email.
+        """
+        template = Template.objects.get(type='account_created')
+        message = self.render_notification(template, sender)
 
         logger.info("Sending VPN account Email to %s(%s) on port %s" % (self.email,
             self.get_full_name(), self.username))
-        return Notify.sendmail(message, sender.get_full_name(), sender.email)
+        return Notify.send_messages([Notify.build_message(message, sender.get_full_name(), sender.email)]) == 1
+
+    @classmethod
+    def notify_many(cls, accounts, sender=User()):
+        """
+        Send the account owners the account information by email in a batch:
+        * the nodeaccounts with the data used by the template are fetched in one go.
+        * the template is compiled once, and all the messages are rendered before sending.
+        * the messages are sent one by one over one connection of the Email backend, so the result of
+          each account is known, see Notify.send_messages().
+        Return a report: {'sent': <n>, 'failed': <n>, 'errors': {<account>: <error>, ...}}
+        The accounts failed to render or to send are in 'errors', the ones failed to send are counted in 'failed'.
+        """
+        accounts = list(accounts)
+        template = Template.objects.get(type='account_created')
+
+        groups = {}
+        nas = NodeAccount.objects.filter(account__in=[account.pk for account in accounts], is_active=True).select_related(
+            'node__record__domain', 'account').prefetch_related(
+            models.Prefetch('node__ssmanagers', queryset=SSManager.objects.order_by('pk')))
+        for na in nas:
+            groups.setdefault(na.account_id, []).append(na)
+
+        messages, errors = [], {}
+        for account in accounts:
+            try:
+                message = account.render_notification(template, sender, nas=groups.get(account.pk, []))
+            except ValidationError as e:
+                logger.error('%s: %s' % (account, e))
+                errors[str(account)] = str(e)
+                continue
+            messages.append((account, Notify.build_message(message, sender.get_full_name(), sender.email)))
+
+        logger.info("Sending VPN account Email to %s account(s)" % len(messages))
+        (sent, failed) = (0, 0)
+        connection = get_connection()
+        for (account, message) in messages:
+            try:
+                # the connection is opened once, and reopened only if it's dropped by a failure
+                connection.open()
+                ok = Notify.send_messages([message], connection=connection)
+                error = None if ok else 'The Email is not accepted by the Email backend.'
+            except Exception as e:
+                error = 'Failed to send the Email: %s' % e
+                Notify.close_connection(connection)
+            if error:
+                logger.error('%s: %s' % (account, error))
+                errors[str(account)] = error
+                failed += 1
+            else:
+                sent += 1
+        Notify.close_connection(connection)
+        return {'sent': sent, 'failed': failed, 'errors': errors}
 
     def on_update(self):
         for na in self.nodes_ref.all():
             if self._original_username != self.username: # port is changed
-                na.on_delete(original=True)
-                na.on_update()
+                if not PortSync.add(na.node_id, removed=[self._original_username]):
+                    na.on_delete(original=True)
+                    na.on_update()
             elif self._original_password != self.password: # password is changed
-                na.on_delete()
-                na.on_update()
+                if not PortSync.add(na.node_id, removed=[self.username]):
+                    na.on_delete()
+                    na.on_update()
             if self._original_is_active != self.is_active: # activity is changed
                 new = (self.is_active and na.node.is_active)
                 if na.is_active != new:
@@ -181,13 +291,10 @@ class Account(User, StatisticMethod):
         self.save()
 
     def add_all_nodes(self):
-        nodes = []
-        for node in Node.objects.all():
-            if NodeAccount.objects.filter(node=node, account=self).count() == 0:
-                na = NodeAccount(node=node, account=self, is_active=(self.is_active and node.is_active))
-                na.save()
-                nodes.append(node)
-        return nodes
+        """
+        Assign all the nodes to the account, return the newly assigned nodes.
+        """
+        return [na.node for na in NodeAccount.assign([self], Node.objects.all())]
 
 
 class Node(StatisticMethod):
@@ -238,6 +345,7 @@ class Node(StatisticMethod):
         """
         self._original_is_active = self.is_active
         self._original_public_ip = self.public_ip
+        self._original_private_ip = self.private_ip
 
     def save(self, *args, **kwargs):
         super(Node, self).save(*args, **kwargs)
@@ -265,6 +373,10 @@ class Node(StatisticMethod):
 
     @property
     def ssmanager(self):
+        # use the ssmanagers prefetched in the order of pk if there are, see Account.notify_many()
+        prefetched = getattr(self, '_prefetched_objects_cache', {}).get('ssmanagers')
+        if prefetched is not None:
+            return next(iter(prefetched), None)
         return self.ssmanagers.first()
 
     @classmethod
@@ -274,6 +386,7 @@ class Node(StatisticMethod):
         """
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # TCP
 
+        start, result = (time.time(), False)
         try:
             if ip_address(ip).is_private:
                 s.settimeout(Config.load().timeout_local) # seconds
@@ -281,11 +394,15 @@ class Node(StatisticMethod):
                 s.settimeout(Config.load().timeout_remote) # seconds
             s.connect((ip, int(port)))
             s.shutdown(socket.SHUT_RDWR)
-            return True
+            result = True
         except Exception:
-            return False
+            pass
         finally:
             s.close()
+            metrics.observe('ssm_port_probe_seconds', time.time() - start, ip=ip,
+                result='open' if result else 'closed')
+
+        return result
 
     @property
     def is_matching_dns_query(self):
@@ -293,7 +410,25 @@ class Node(StatisticMethod):
         Test if the the node.public_ip matches the DNS query.
         """
         if self.record:
-            return self.public_ip in self.record.answer_from_dns_query
+            answers = self.record.answer_from_dns_query
+            return None if answers is None else self.public_ip in answers
+
+    @classmethod
+    def match_dns_query_many(cls, nodes, from_cache=True):
+        """
+        Test is_matching_dns_query of many nodes in one concurrent sweep of the DNS queries, see DnsQuery.
+        The nodes should come with the record loaded.
+        Return the values by node pk: {<pk>: {'is_matching_dns_query': <value>}, ...}
+        """
+        nodes = list(nodes)
+        queried = DnsQuery.resolve_many([(node.record.fqdn, node.record.type) for node in nodes if node.record],
+            from_cache=from_cache)
+
+        results = {}
+        for node in nodes:
+            answers = queried[(node.record.fqdn, node.record.type)] if node.record else None
+            results[node.pk] = {'is_matching_dns_query': None if answers is None else node.public_ip in answers}
+        return results
 
     @property
     def is_matching_record(self):
@@ -326,14 +461,15 @@ class Node(StatisticMethod):
     def get_ip_field_by_interface(self, interface):
         return '{}_ip'.format(InterfaceList.name(interface).lower())
 
-    def get_ip_by_interface(self, interface):
+    def get_ip_by_interface(self, interface, original=False):
         """
-        Return the node's IP address for a network interface.
+        Return the node's IP address for a network interface, or the one before the changes if `original`.
         """
         if interface == InterfaceList.LOCALHOST:
             return '127.0.0.1'
         else:
-            return getattr(self, self.get_ip_field_by_interface(interface))
+            field = self.get_ip_field_by_interface(interface)
+            return getattr(self, '_original_' + field if original else field)
 
     def is_port_accessible(self, port):
         """
@@ -341,13 +477,51 @@ class Node(StatisticMethod):
         """
         return Node.is_port_open(self.public_ip, port)
 
+    @staticmethod
+    def get_cache_version_key(pk):
+        return 'node-{0}-version'.format(pk)
+
+    @classmethod
+    def get_cache_versions(cls, pks):
+        """
+        Return the cache versions of the nodes by pk: {<pk>: <version>}, with one read from cache.
+
+        The version is included in all the cache keys of a node: the port accessibility of its
+        nodeaccounts, and the ping and list of its ssmanager. So all of them are invalidated at once
+        by a new version, see clear_caches().
+        """
+        keys = {cls.get_cache_version_key(pk): pk for pk in pks}
+        versions = cache.get_many(list(keys))
+        for key in keys:
+            if key not in versions:
+                version = uuid.uuid4().hex[:8]
+                versions[key] = version if cache.add(key, version, timeout=None) else cache.get(key, version)
+        return {pk: versions[key] for (key, pk) in keys.items()}
+
+    def get_cache_version(self):
+        return Node.get_cache_versions([self.pk])[self.pk]
+
+    @classmethod
+    def clear_caches(cls, pks):
+        """
+        Clear all the cache of the nodes by a new version for each, with one write to cache and no query.
+        """
+        logger.debug('clearing caches of nodes: %s' % pks)
+        cache.set_many({cls.get_cache_version_key(pk): uuid.uuid4().hex[:8] for pk in pks}, timeout=None)
+
     def clear_cache(self):
-        pass
+        """
+        Clear all the cache of the node, see clear_caches().
+        """
+        Node.clear_caches([self.pk])
 
     def on_update(self):
         # changes on public_ip or private_ip need to restart ssmanager
-        if self.ssmanager:
-            self.ssmanager.on_update()
+        ssmanager = self.ssmanager
+        if ssmanager:
+            # share this instance, the ssmanager needs the original IP addresses
+            ssmanager.node = self
+            ssmanager.on_update()
 
         for na in self.accounts_ref.all():
             if self._original_is_active != self.is_active: # activity is changed
@@ -452,16 +626,29 @@ class NodeAccount(StatisticMethod):
         """
         return self.node.is_port_accessible(self.account.username)
 
+    @staticmethod
+    def get_cache_key(ip, port, version):
+        return '{0}:{1}:{2}'.format(ip, port, version)
+
+    @property
+    def cache_key(self):
+        """
+        The cache key of is_accessible_ex(), in the cache version of the node.
+        """
+        return NodeAccount.get_cache_key(self.node.public_ip, self.account.username, self.node.get_cache_version())
+
     def is_accessible_ex(self, from_cache=True):
         """
         The same as is_accessible, but with cache enabled.
         The cache lives for 60 seconds.
         """
-        key, value = ('{0}:{1}'.format(self.node.public_ip, self.account.username), None)
+        key, value = (self.cache_key, None)
         if from_cache and key in cache:
             logger.debug('hitting cache: %s' % key)
+            metrics.inc('ssm_cache_requests_total', method='is_accessible_ex', result='hit')
             value = cache.get(key)
         else:
+            metrics.inc('ssm_cache_requests_total', method='is_accessible_ex', result='miss' if from_cache else 'bypass')
             value = self.is_accessible
             cache.set(key, '' if value is None else value, timeout=Config.load().cache_timeout)
 
@@ -472,59 +659,151 @@ class NodeAccount(StatisticMethod):
         Clear all the cache made by this instance:
         * is_accessible_ex()
         """
-        key = '{0}:{1}'.format(self.node.public_ip, self.account.username)
+        key = self.cache_key
         logger.debug('clearing cache: %s' % key)
         cache.delete(key)
 
+    @classmethod
+    def scan_accessible(cls, nodeaccounts):
+        """
+        Test the TCP ports of the nodeaccounts concurrently with PortScanner, and cache all the
+        results with one set_many() for is_accessible_ex().
+        The nodeaccounts should come with the node and account loaded.
+        Return the results by nodeaccount pk: {<pk>: True|False, ...}
+        """
+        nas = list(nodeaccounts)
+        results = PortScanner().scan([(na.node.public_ip, na.account.username) for na in nas])
+        results = {na: results[(na.node.public_ip, na.account.username)] for na in nas}
+        versions = Node.get_cache_versions({na.node_id for na in nas})
+        cache.set_many({cls.get_cache_key(na.node.public_ip, na.account.username, versions[na.node_id]): value
+            for (na, value) in results.items()}, timeout=Config.load().cache_timeout)
+        return {na.pk: value for (na, value) in results.items()}
+
+    @classmethod
+    def resolve_many(cls, nodeaccounts):
+        """
+        Resolve is_created() and is_accessible_ex() of many nodeaccounts at once:
+        * is_created:       a single port_index() (with the cached list_ex()) for each ssmanager.
+        * is_accessible_ex: a single cache.get_many() for all, and the misses are tested concurrently
+                            in one scan, see scan_accessible().
+        The nodeaccounts should come with the node and account loaded.
+        Return the values by nodeaccount pk: {<pk>: {'is_created': <value>, 'is_accessible_ex': <value>}, ...}
+        """
+        nas = list(nodeaccounts)
+        nodes = {na.node_id: na.node for na in nas}
+
+        indexes = {}
+        for ssmanager in SSManager.objects.filter(node_id__in=list(nodes)).order_by('pk'):
+            if ssmanager.node_id not in indexes:
+                ssmanager.node = nodes[ssmanager.node_id]
+                indexes[ssmanager.node_id] = ssmanager.port_index()
+
+        versions = Node.get_cache_versions(list(nodes))
+        keys = {na.pk: cls.get_cache_key(na.node.public_ip, na.account.username, versions[na.node_id]) for na in nas}
+        cached = cache.get_many(list(keys.values()))
+        missing = [na for na in nas if keys[na.pk] not in cached]
+        scanned = cls.scan_accessible(missing) if missing else {}
+
+        results = {}
+        for na in nas:
+            index = indexes.get(na.node_id)
+            results[na.pk] = {
+                'is_created': None if index is None else str(na.account.username) in index,
+                'is_accessible_ex': cached[keys[na.pk]] if keys[na.pk] in cached else scanned[na.pk],
+            }
+        return results
+
     @classmethod
     def clear_caches(cls, node=None, account=None):
         """
         Clear all the cache made by this class by filters:
-        * node
-        * account
-        """
-        objs = cls.objects.all()
-        if node: objs = objs.filter(node=node)
-        if account: objs = objs.filter(account=account)
-        keys = ['{0}:{1}'.format(obj.node.public_ip, obj.account.username) for obj in objs]
-        logger.debug('clearing caches: %s' % keys)
-        cache.delete_many(keys)
+        * node:    no query, the cache of the node is cleared by a new version, see Node.clear_caches().
+        * account: the cache of all the nodes of the account are cleared.
+        The cache of all the nodes are cleared without any filter.
+        """
+        if node:
+            pks = [node.pk]
+        elif account:
+            pks = list(cls.objects.filter(account=account).values_list('node_id', flat=True))
+        else:
+            pks = list(Node.objects.values_list('pk', flat=True))
+        Node.clear_caches(pks)
 
-    def on_update(self):
-        if not self.node.ssmanager:
+    def on_update(self, ssmanager=None):
+        """
+        Create the port on the node if active, otherwise delete it.
+        The ssmanager of the node is looked up if not given.
+        """
+        ssmanager = ssmanager or self.node.ssmanager
+        if not ssmanager:
             return
 
         if self.is_active:
-            if self.node.ssmanager.is_accessible:
-                self.node.ssmanager.add(port=self.account.username, password=self.account.password)
+            if ssmanager.is_accessible:
+                ssmanager.add(port=self.account.username, password=self.account.password)
                 self.clear_cache()
             else:
                 logger.error('%s: creation eror: ssmanager %s currently is not available.'
-                    % (self, self.node.ssmanager))
+                    % (self, ssmanager))
         else:
-            self.on_delete()
+            self.on_delete(ssmanager=ssmanager)
 
-    def on_delete(self, original=False):
-        if not self.node.ssmanager:
+    def on_delete(self, original=False, ssmanager=None):
+        """
+        Delete the port on the node.
+        The ssmanager of the node is looked up if not given.
+        """
+        ssmanager = ssmanager or self.node.ssmanager
+        if not ssmanager:
             return
 
         port = '_original_username' if original else 'username'
-        if self.node.ssmanager.is_accessible:
-            self.node.ssmanager.remove(port=getattr(self.account, port))
+        if ssmanager.is_accessible:
+            ssmanager.remove(port=getattr(self.account, port))
             self.clear_cache()
         else:
             logger.error('%s: deletion eror: ssmanager %s currently is not available.' % (self,
-                self.node.ssmanager))
+                ssmanager))
+
+    @classmethod
+    def assign(cls, accounts, nodes):
+        """
+        Assign the nodes to the accounts in bulk, return the created nodeaccounts.
+        * the missing (node, account) pairs are found with a single query.
+        * the nodeaccounts are created with bulk_create(), no signal is sent for each of them.
+        * the ports are created by reconciling each node once on commit, see PortSync.
+        * the pairs assigned concurrently in the meantime are not created twice, the conflicts are ignored.
+        """
+        accounts, nodes = list(accounts), list(nodes)
+        pairs = cls.objects.filter(account__in=accounts, node__in=nodes).values_list('node_id', 'account_id', 'pk')
+        existing = set((node_id, account_id) for (node_id, account_id, pk) in pairs)
+
+        nas = [cls(node=node, account=account, is_active=(account.is_active and node.is_active))
+            for account in accounts for node in nodes if (node.pk, account.pk) not in existing]
+        if not nas:
+            return []
+        cls.objects.bulk_create(nas, ignore_conflicts=True)
+
+        # the pks are not returned with the conflicts ignored, re-read them
+        pks = dict(((node_id, account_id), pk) for (node_id, account_id, pk) in pairs.all())
+        nas = [na for na in nas if (na.node_id, na.account_id) in pks]
+        for na in nas:
+            na.pk = pks[(na.node_id, na.account_id)]
+
+        with PortSync.deferred():
+            for node_id in sorted({na.node_id for na in nas if na.is_active}):
+                PortSync.add(node_id)
+        return nas
 
     @classmethod
-    def heartbeat(cls):
+    def heartbeat(cls, max_workers=None, timeout=None):
         """
         Heartbeat once on all the nodeaccounts.
         Create the active ones and delete the inactive ones on the corresponding nodes.
+        The nodes are reconciled concurrently, return a report for each node, see Heartbeat.
         This method usually is used to run as the scheduled job.
         """
-        for na in cls.objects.all():
-            na.on_update()
+        return Heartbeat(max_workers=max_workers, timeout=timeout).run()
 
 
 class InterfaceList(enum.Enum):
@@ -549,6 +828,274 @@ class ServerEditionList(enum.Enum):
     }
 
 
+class JobStatusList(enum.Enum):
+    PENDING = 1
+    RUNNING = 2
+    FINISHED = 3
+    ABORTED = 4
+
+    __labels__ = {
+        PENDING: "Pending",
+        RUNNING: "Running",
+        FINISHED: "Finished",
+        ABORTED: "Aborted",
+    }
+
+
+class PortScanner(object):
+    """
+    Test if the TCP ports are listening on many (ip, port) pairs concurrently.
+
+    The connects are non-blocking and multiplexed with selectors (epoll, kqueue or select,
+    whichever is the best available), so all the pairs are tested within one timeout window
+    instead of one after another. At most max_sockets connects are in flight at once.
+
+    The timeout of each pair is Config.timeout_local for the private IPs, otherwise
+    Config.timeout_remote, the same as Node.is_port_open().
+    """
+
+    max_sockets = 256
+
+    def __init__(self, max_sockets=None, *args, **kwargs):
+        super(PortScanner, self).__init__(*args, **kwargs)
+        self.max_sockets = max_sockets or self.max_sockets
+
+    @staticmethod
+    def connect(ip, port):
+        """
+        Start a non-blocking connect, return the socket, or None if it failed immediately.
+        """
+        family = socket.AF_INET6 if ip_address(ip).version == 6 else socket.AF_INET
+        s = socket.socket(family, socket.SOCK_STREAM) # TCP
+        s.setblocking(False)
+        if s.connect_ex((ip, int(port))) in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            return s
+        s.close()
+        return None
+
+    @staticmethod
+    def close(selector, s):
+        selector.unregister(s)
+        try:
+            s.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        s.close()
+
+    def scan(self, targets):
+        """
+        Test the targets: a list of (ip, port), return the results: {(ip, port): True|False, ...}.
+        """
+        config = Config.load()
+        results, pending = {}, []
+        for target in dict.fromkeys(targets):
+            try:
+                is_private = ip_address(target[0]).is_private
+            except ValueError:
+                results[target] = False
+                continue
+            pending.append((target, config.timeout_local if is_private else config.timeout_remote))
+        pending.reverse()
+
+        selector = selectors.DefaultSelector()
+        try:
+            while pending or selector.get_map():
+                # keep the connects in flight up to the limit
+                while pending and len(selector.get_map()) < self.max_sockets:
+                    (target, timeout) = pending.pop()
+                    try:
+                        s = self.connect(*target)
+                    except (OSError, ValueError):
+                        s = None
+                    if s is None:
+                        results[target] = False
+                    else:
+                        selector.register(s, selectors.EVENT_WRITE, (target, time.time() + timeout))
+
+                keys = list(selector.get_map().values())
+                if not keys:
+                    continue
+                for (key, events) in selector.select(max(0, min(key.data[1] for key in keys) - time.time())):
+                    # the connect is done, successfully or not
+                    results[key.data[0]] = key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+                    self.close(selector, key.fileobj)
+
+                now = time.time()
+                for key in list(selector.get_map().values()):
+                    if key.data[1] <= now:
+                        results[key.data[0]] = False
+                        self.close(selector, key.fileobj)
+        finally:
+            for key in list(selector.get_map().values()):
+                self.close(selector, key.fileobj)
+            selector.close()
+
+        return results
+
+
+class ManagerTransport(object):
+    """
+    A long-lived UDP transport to a Shadowsocks Manager API endpoint.
+
+    One transport exists per (ip, port) in each process, shared by all the SSManager
+    instances and threads talking to that endpoint. See get().
+
+    The Manager API carries no request id, so the request/response correlation is done by:
+    * serializing the request/response exchanges on the socket with a lock.
+    * draining the stale datagrams (e.g. the late reply of a timed out request) before sending.
+    * dropping the datagrams not looking like a reply to the command being sent.
+
+    The socket is dropped on any error, and reconnected lazily by the next call.
+    """
+
+    # UDP datagram size limit, the reply of `list` can be large for a node with many ports
+    bufsize = 65535
+
+    # the leading bytes of the expected reply for each command
+    replies = {
+        'ping': (b'stat:', b'pong'),
+        'list': (b'[',),
+        'add': (b'ok',),
+        'remove': (b'ok',),
+    }
+
+    _transports = {}
+    _transports_lock = threading.Lock()
+
+    def __init__(self, ip, port, *args, **kwargs):
+        super(ManagerTransport, self).__init__(*args, **kwargs)
+        self.address = (ip, int(port))
+        self.socket = None
+        self.pid = None
+        self.lock = threading.RLock()
+
+    def __str__(self):
+        return '%s:%s' % self.address
+
+    @classmethod
+    def get(cls, ip, port):
+        """
+        Return the shared transport for the (ip, port), create it if not exists.
+        """
+        key = (ip, int(port))
+        with cls._transports_lock:
+            transport = cls._transports.get(key)
+            if transport is None:
+                transport = cls._transports[key] = cls(ip, port)
+            return transport
+
+    @classmethod
+    def discard(cls, ip, port):
+        """
+        Close and drop the shared transport for the (ip, port) if exists, never create one.
+        """
+        if not ip:
+            return
+        with cls._transports_lock:
+            transport = cls._transports.pop((ip, int(port)), None)
+        if transport is not None:
+            transport.close()
+
+    @classmethod
+    def close_all(cls):
+        """
+        Close all the shared transports in this process.
+        """
+        with cls._transports_lock:
+            transports = list(cls._transports.values())
+            cls._transports.clear()
+        for transport in transports:
+            transport.close()
+
+    @property
+    def is_connected(self):
+        # a socket inherited from the parent process (celery prefork, uwsgi) is not reusable
+        return self.socket is not None and self.pid == os.getpid()
+
+    def connect(self, timeout=None):
+        """
+        Open the UDP socket if not opened yet, and set the timeout.
+        """
+        with self.lock:
+            if not self.is_connected:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # UDP
+                self.pid = os.getpid()
+                try:
+                    self.socket.connect(self.address)
+                except Exception:
+                    self.close()
+                    raise
+            self.socket.settimeout(timeout)
+
+    def close(self):
+        """
+        Close the UDP socket.
+        """
+        with self.lock:
+            if self.socket is not None:
+                try:
+                    self.socket.close()
+                except Exception as e:
+                    logger.debug('%s: error on closing the socket: %s' % (self, e))
+            self.socket = None
+            self.pid = None
+
+    def drain(self):
+        """
+        Discard all the datagrams waiting in the socket receive buffer.
+        """
+        self.socket.setblocking(False)
+        try:
+            while True:
+                data = self.socket.recv(self.bufsize)
+                logger.debug('%s: discarded stale datagram: %s' % (self, data[:64]))
+        except (BlockingIOError, InterruptedError):
+            pass
+        except socket.error as e:
+            # e.g.: ECONNREFUSED reported by an ICMP message for an earlier request
+            logger.debug('%s: discarded pending socket error: %s' % (self, e))
+
+    def is_reply(self, command, data):
+        """
+        Test if the datagram looks like a reply to the command.
+        """
+        name = command.split(b':', 1)[0].strip().decode('utf-8', 'replace')
+        prefixes = self.replies.get(name)
+        return not prefixes or data.lstrip().startswith(prefixes)
+
+    def call(self, command, read=False, timeout=None):
+        """
+        Send a command to the Manager API, return the reply in bytes if read is True.
+        Raise socket.timeout if no reply is received in time, and socket.error for other errors.
+        """
+        with self.lock:
+            try:
+                self.connect(timeout)
+                self.drain()
+                self.socket.settimeout(timeout)
+                self.socket.send(command)
+                if not read:
+                    return None
+
+                deadline = None if timeout is None else time.time() + timeout
+                while True:
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise socket.timeout('timed out')
+                        self.socket.settimeout(remaining)
+                    data = self.socket.recv(self.bufsize)
+                    if self.is_reply(command, data):
+                        return data
+                    logger.debug('%s: %s: discarded unmatched datagram: %s' % (self, command, data[:64]))
+            except socket.timeout:
+                # the socket is still good, a late reply will be drained by the next call
+                raise
+            except Exception:
+                self.close()
+                raise
+
+
 class SSManager(models.Model):
     node = models.ForeignKey(Node, on_delete=models.CASCADE, related_name='ssmanagers')
     interface = enum.EnumField(InterfaceList, default=InterfaceList.PRIVATE,
@@ -578,9 +1125,20 @@ class SSManager(models.Model):
 
     def __init__(self, *args, **kwargs):
         super(SSManager, self).__init__(*args, **kwargs)
+        self._snapshot_original()
+
+    def _snapshot_original(self):
+        """
+        Capture the current field values as the original state, see Node._snapshot_original().
+        """
+        self._original_interface = self.interface
         self._original_port = self.port
         self._original_server_edition = self.server_edition
 
+    def save(self, *args, **kwargs):
+        super(SSManager, self).save(*args, **kwargs)
+        self._snapshot_original()
+
     def clean(self):
         if not self._ip:
             raise ValidationError({
@@ -594,23 +1152,42 @@ class SSManager(models.Model):
         """
         return self.node.get_ip_by_interface(self.interface)
 
-    def connect(self):
+    @property
+    def _original_ip(self):
         """
-        Open a connection to the Manager API by UDP.
+        Return the IP address that the Manager API was listening on before the changes.
+        """
+        return self.node.get_ip_by_interface(self._original_interface, original=True)
+
+    @property
+    def transport(self):
+        """
+        Return the shared ManagerTransport to the Manager API.
+        """
+        return ManagerTransport.get(self._ip, self.port)
+
+    @property
+    def timeout(self):
+        """
+        Return the network timeout in seconds for the Manager API.
         """
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # UDP
         if ip_address(self._ip).is_private:
-            self.socket.settimeout(Config.load().timeout_local) # seconds
+            return Config.load().timeout_local
         else:
-            self.socket.settimeout(Config.load().timeout_remote) # seconds
-        self.socket.connect((self._ip, self.port))
+            return Config.load().timeout_remote
+
+    def connect(self):
+        """
+        Open a connection to the Manager API by UDP.
+        The connection is kept open and shared, see ManagerTransport.
+        """
+        self.transport.connect(self.timeout)
 
     def close(self):
         """
         Close the connection to the Manager API.
         """
-        self.socket.shutdown(socket.SHUT_RDWR)
-        self.socket.close()
+        self.transport.close()
 
     def call(self, command, read=False):
         """
@@ -620,18 +1197,21 @@ class SSManager(models.Model):
         if isinstance(command, str):
             command = bytes(command, 'utf-8')
 
-        self.connect()
+        timeout = self.timeout
+        labels = dict(command=str(command.split(b':')[0].strip(), 'utf-8'), node=self.node.name)
+        start = time.time()
         try:
-            self.socket.send(command)
-            if read:
-                ret = self.socket.recv(4096)
+            ret = self.transport.call(command, read=read, timeout=timeout)
+            if ret is not None:
                 ret = str(ret, 'utf-8')
         except socket.timeout:
-            logger.error('%s: %s: timed out in %s seconds' % (self, command, self.socket.gettimeout()))
+            logger.error('%s: %s: timed out in %s seconds' % (self, command, timeout))
+            metrics.inc('ssm_manager_call_failures_total', reason='timeout', **labels)
         except Exception as e:
             logger.error('%s: %s: unexpected error: %s' % (self, command, e))
+            metrics.inc('ssm_manager_call_failures_total', reason='error', **labels)
         finally:
-            self.close()
+            metrics.observe('ssm_manager_call_seconds', time.time() - start, **labels)
 
         return ret
 
@@ -682,7 +1262,7 @@ class SSManager(models.Model):
         if not exists:
             self._add(port, password)
             self.clear_cache()
-            self.get_nodeaccount(port, create=True).clear_cache()
+            self._nodeaccount(port).clear_cache()
             exists = self.is_port_created_or_accessible(port)
         return exists
 
@@ -697,7 +1277,7 @@ class SSManager(models.Model):
         if exists:
             self._remove(port)
             self.clear_cache()
-            self.get_nodeaccount(port, create=True).clear_cache()
+            self._nodeaccount(port).clear_cache()
             exists = self.is_port_created_or_accessible(port)
         return not exists
 
@@ -732,13 +1312,20 @@ class SSManager(models.Model):
         else:
             return None
 
+    def get_cache_key(self, name):
+        """
+        The cache key of ping_ex(), list_ex() and so on, in the cache version of the node.
+        """
+        return '{0}-{1}-{2}'.format(self, self.node.get_cache_version(), name)
+
     def clear_cache(self):
         """
         Clear all the cache made by this instance:
         * ping_ex()
         * list_ex()
         """
-        keys = ['{0}-{1}'.format(self, str) for str in ['ping', 'list']]
+        key = self.get_cache_key('list')
+        keys = [self.get_cache_key('ping'), key, key + '-stamp']
         logger.debug('clearing cache: %s' % keys)
         cache.delete_many(keys)
 
@@ -747,11 +1334,13 @@ class SSManager(models.Model):
         The same as ping(), but with cache enabled.
         The cache lives for 60 seconds.
         """
-        key, value = ('{0}-{1}'.format(self, 'ping'), None)
+        key, value = (self.get_cache_key('ping'), None)
         if from_cache and key in cache:
             logger.debug('hitting cache: %s' % key)
+            metrics.inc('ssm_cache_requests_total', method='ping_ex', result='hit')
             value = cache.get(key)
         else:
+            metrics.inc('ssm_cache_requests_total', method='ping_ex', result='miss' if from_cache else 'bypass')
             value = self.ping()
             cache.set(key, '' if value is None else value, timeout=Config.load().cache_timeout)
 
@@ -762,35 +1351,141 @@ class SSManager(models.Model):
         The same as list(), but with cache enabled.
         The cache lives for 60 seconds.
         """
-        key, value = ('{0}-{1}'.format(self, 'list'), None)
+        key, value = (self.get_cache_key('list'), None)
         if from_cache and key in cache:
             logger.debug('hitting cache: %s' % key)
+            metrics.inc('ssm_cache_requests_total', method='list_ex', result='hit')
             value = cache.get(key)
         else:
+            metrics.inc('ssm_cache_requests_total', method='list_ex', result='miss' if from_cache else 'bypass')
             value = self.list()
-            cache.set(key, '' if value is None else value, timeout=Config.load().cache_timeout)
+            # the stamp identifies this fetch, see port_index()
+            stamp = uuid.uuid4().hex
+            cache.set_many({key: '' if value is None else value, key + '-stamp': stamp},
+                timeout=Config.load().cache_timeout)
+            self._set_port_index(stamp, value)
 
         return value
 
+    # {<ssmanager>: (<stamp>, <port index>)}, shared in the process
+    _port_indexes = {}
+
+    def _set_port_index(self, stamp, items):
+        if isinstance(items, list):
+            index = {item['server_port']: item.get('password') for item in items}
+        else:
+            index = None
+        SSManager._port_indexes[str(self)] = (stamp, index)
+        return index
+
+    def port_index(self, from_cache=True):
+        """
+        Return the ports created with Manager API as a dict: {<port>: <password>}, the port is in string.
+        Return None if the ports are not available.
+        Internally using list_ex().
+
+        The index is built once per fetch of list_ex(), and kept in the process. The lookups against
+        the same fetch only read the stamp of the fetch from cache, instead of the whole list.
+        """
+        key = self.get_cache_key('list')
+        if from_cache:
+            stamp = cache.get(key + '-stamp')
+            (memo_stamp, index) = SSManager._port_indexes.get(str(self), (None, None))
+            if stamp is not None and stamp == memo_stamp:
+                return index
+
+        items = self.list_ex(from_cache=from_cache)
+        (memo_stamp, index) = SSManager._port_indexes.get(str(self), (None, None))
+        stamp = cache.get(key + '-stamp')
+        if stamp is not None and stamp == memo_stamp:
+            # list_ex() has just fetched the list and built the index
+            return index
+        return self._set_port_index(stamp, items)
+
+    def reconcile(self, nodeaccounts=None, deadline=None):
+        """
+        Reconcile the ports on the node with its nodeaccounts in one pass:
+        * fetch the live ports with a single `list`.
+        * fetch the nodeaccounts of the node with a single query, if not given.
+        * remove the unwanted ports and the ports with a changed password, add the missing ports.
+        * verify the result with a single `list`.
+        The ports to remove are limited to the ones managed by this node: the ports of its nodeaccounts
+        and the ports in the range of Config, other ports on the node are left untouched.
+        Stop sending commands once the deadline (a timestamp) is reached.
+
+        Return None if the live ports are not available, e.g. the Manager API is not accessible or the
+        server is not the libev edition, the caller should fall back to the port-by-port way.
+        Otherwise return a dict of port lists: {'added': [], 'removed': [], 'failed': [], 'pending': []}.
+        """
+        live = self.port_index(from_cache=False)
+        if live is None:
+            return None
+
+        if nodeaccounts is None:
+            nodeaccounts = self.node.accounts_ref.select_related('account')
+
+        config = Config.load()
+        wanted = {}
+        managed = {str(port) for port in range(config.port_begin, config.port_end + 1)}
+        for na in nodeaccounts:
+            port = str(na.account.username)
+            managed.add(port)
+            if na.is_active:
+                wanted[port] = na.account.password
+
+        to_remove = sorted(port for port in live if port in managed and live[port] != wanted.get(port))
+        to_add = sorted(port for port in wanted if live.get(port) != wanted[port])
+
+        ret = {'added': [], 'removed': [], 'failed': [], 'pending': []}
+        for (command, ports) in [('removed', to_remove), ('added', to_add)]:
+            for port in ports:
+                if deadline and time.time() > deadline:
+                    ret['pending'].append(port)
+                    continue
+                if command == 'added':
+                    self._add(port, wanted[port])
+                else:
+                    self._remove(port)
+                ret[command].append(port)
+
+        if ret['added'] or ret['removed']:
+            for port in set(ret['added'] + ret['removed']):
+                self._nodeaccount(port).clear_cache()
+            self.clear_cache()
+            live = self.port_index(from_cache=False) or {}
+            ret['failed'] = sorted(
+                [port for port in ret['added'] if port not in live] +
+                [port for port in ret['removed'] if port in live and port not in ret['added']])
+            if ret['failed']:
+                logger.error('%s: reconcile: failed ports: %s' % (self, ret['failed']))
+
+        return ret
+
     def is_port_created(self, port):
         """
         Test if a port is created with Manager API.
-        Internally using list_ex().
+        Internally using port_index().
         """
-        items = self.list_ex()
-        if isinstance(items, list):
-            return any(item['server_port'] == str(port) for item in items)
-        else:
+        index = self.port_index()
+        if index is None:
             return None
+        return str(port) in index
 
     def is_port_created_or_accessible(self, port):
         """
         Test if a port is created with Manager API.
-        Internally using list_ex().
+        Internally using port_index().
         If the Manager API is not available or not accessible, then test the port accessibility directly.
         """
         ret = self.is_port_created(port)
-        return self.get_nodeaccount(port, create=True).is_accessible_ex() if ret is None else ret
+        return self._nodeaccount(port).is_accessible_ex() if ret is None else ret
+
+    def _nodeaccount(self, port):
+        """
+        Return an unsaved NodeAccount for the port on this node.
+        It's enough for the port accessibility test and its cache, without touching the database.
+        """
+        return NodeAccount(node=self.node, account=Account(username=port))
 
     def get_nodeaccount(self, port, create=False):
         try:
@@ -811,12 +1506,426 @@ class SSManager(models.Model):
         return self.ping_ex() is not None
 
     def on_update(self):
-        self.clear_cache()
-        NodeAccount.clear_caches(node=self.node)
+        # drop the transports to both the previous and the new endpoint, the port, interface or IP may be changed
+        ManagerTransport.discard(self._original_ip, self._original_port)
+        ManagerTransport.discard(self._ip, self.port)
+        self.node.clear_cache()
 
     def on_delete(self):
-        self.clear_cache()
-        NodeAccount.clear_caches(node=self.node)
+        ManagerTransport.discard(self._ip, self.port)
+        self.node.clear_cache()
+
+
+class Heartbeat(object):
+    """
+    Heartbeat once on all the nodeaccounts, reconciling the nodes concurrently.
+
+    The nodeaccounts are grouped by node, and each node is reconciled by a worker in a
+    bounded thread pool. All the database reads are done upfront in the calling thread,
+    the workers only talk to the Manager API and the cache.
+
+    One deadline is computed for the whole cycle and shared by all the workers. A worker stops at the
+    deadline, a node not started by the deadline (e.g. queued behind the other nodes) is not reconciled,
+    and a node still not finished is left behind. So the cycle time is bounded by the timeout, no matter
+    how many nodes there are.
+
+    Each node is reconciled with SSManager.reconcile() if possible, otherwise port by port.
+
+    After a node is reconciled, the accessibility of all its ports is tested in one scan to warm up
+    the cache of NodeAccount.is_accessible_ex(), see NodeAccount.scan_accessible().
+
+    run() returns a report for each node:
+        [{'node': <name>, 'status': <status>, 'ports': <n>, 'done': <n>, 'elapsed': <seconds>}, ...]
+    The report from SSManager.reconcile() also counts the ports: 'added', 'removed', 'failed' and 'pending'.
+    The report of an ok node also counts the accessible ports: 'accessible', unless the scan is disabled.
+    The status is one of:
+        * ok:          all the ports are reconciled.
+        * unavailable: the ssmanager is not accessible.
+        * skipped:     no ssmanager is configured for the node.
+        * timeout:     the deadline is reached before all the ports are reconciled, or before the node is started.
+        * error:       unexpected error, the message is in the report key 'error'.
+    """
+
+    max_workers = 8
+    # seconds, keep it shorter than the schedule interval of the heartbeat task
+    timeout = 45
+
+    def __init__(self, max_workers=None, timeout=None, node_ids=None, removed=None, scan=True, *args, **kwargs):
+        super(Heartbeat, self).__init__(*args, **kwargs)
+        self.max_workers = max_workers or self.max_workers
+        self.timeout = timeout or self.timeout
+        self.node_ids = node_ids
+        # {node_id: [port, ...]}, the ports to remove before the port-by-port way, see PortSync
+        self.removed = removed or {}
+        # whether to test the accessibility of the ports after the reconcile
+        self.is_scan_enabled = scan
+
+    def group(self):
+        """
+        Return the nodeaccounts grouped by node, in the order of node: [(node, [nodeaccount, ...]), ...]
+        Only the nodes in node_ids are included if it's given, including the ones without nodeaccounts.
+        """
+        groups = {}
+        nas = NodeAccount.objects.select_related('node', 'account').order_by('node_id', 'pk')
+        if self.node_ids is not None:
+            nas = nas.filter(node_id__in=self.node_ids)
+            for node in Node.objects.filter(pk__in=self.node_ids).order_by('pk'):
+                groups[node.pk] = (node, [])
+        for na in nas:
+            (node, group) = groups.setdefault(na.node_id, (na.node, []))
+            # share the node instance in the group
+            na.node = node
+            group.append(na)
+        return list(groups.values())
+
+    def reconcile(self, ssmanager, nas, deadline):
+        """
+        Create the active ports and delete the inactive ports on a node, until the deadline (a timestamp) of the cycle.
+        Run in a worker thread.
+        """
+        report = {'ports': len(nas), 'done': 0}
+        start = time.time()
+        if start >= deadline:
+            logger.error('%s: heartbeat: not started before the deadline.' % ssmanager.node)
+            report.update(status='timeout', elapsed=0)
+            return report
+
+        try:
+            if not ssmanager.is_accessible:
+                logger.error('%s: heartbeat: ssmanager %s currently is not available.' % (ssmanager.node, ssmanager))
+                report['status'] = 'unavailable'
+                return report
+
+            ret = ssmanager.reconcile(nodeaccounts=nas, deadline=deadline)
+            if ret is not None:
+                undone = set(ret['failed'] + ret['pending'])
+                report['done'] = len([na for na in nas if str(na.account.username) not in undone])
+                report.update((key, len(value)) for (key, value) in ret.items())
+                report['status'] = 'timeout' if ret['pending'] else 'ok'
+                if report['status'] == 'ok':
+                    self.scan(nas, report)
+                return report
+
+            # fall back to the port-by-port way if the live ports are not available
+            for port in self.removed.get(ssmanager.node_id, []):
+                ssmanager.remove(port=port)
+            for na in nas:
+                if time.time() > deadline:
+                    logger.error('%s: heartbeat: timed out in %s seconds.' % (ssmanager.node, self.timeout))
+                    report['status'] = 'timeout'
+                    return report
+                na.on_update(ssmanager=ssmanager)
+                report['done'] += 1
+
+            report['status'] = 'ok'
+            self.scan(nas, report)
+        except Exception as e:
+            logger.error('%s: heartbeat: unexpected error: %s' % (ssmanager.node, e))
+            report.update(status='error', error=str(e))
+        finally:
+            report['elapsed'] = round(time.time() - start, 3)
+            # the thread may have opened a database connection by accident
+            connection.close()
+
+        return report
+
+    def scan(self, nas, report):
+        """
+        Warm up the cache of NodeAccount.is_accessible_ex() for all the ports on a node at once.
+        Run in a worker thread.
+        """
+        if not self.is_scan_enabled:
+            return
+        results = NodeAccount.scan_accessible(nas)
+        report['accessible'] = len([value for value in results.values() if value])
+
+    def run(self):
+        # warm up the cached config in the calling thread for the workers
+        Config.load()
+
+        reports, jobs = [], []
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='heartbeat')
+        try:
+            groups = self.group()
+            # one deadline for the whole cycle, shared by all the workers
+            deadline = time.time() + self.timeout
+            for (node, nas) in groups:
+                ssmanager = node.ssmanager
+                future = executor.submit(self.reconcile, ssmanager, nas, deadline) if ssmanager else None
+                jobs.append((node, nas, future))
+
+            futures = [future for (node, nas, future) in jobs if future]
+            done, not_done = wait(futures, timeout=max(0, deadline - time.time()))
+
+            for (node, nas, future) in jobs:
+                if future is None:
+                    report = {'status': 'skipped', 'ports': len(nas), 'done': 0}
+                elif future in done:
+                    report = future.result()
+                elif future.cancel():
+                    logger.error('%s: heartbeat: not started before the deadline.' % node)
+                    report = {'status': 'timeout', 'ports': len(nas), 'done': 0}
+                else:
+                    logger.error('%s: heartbeat: left behind after the deadline.' % node)
+                    report = {'status': 'timeout', 'ports': len(nas), 'done': None}
+                report['node'] = node.name
+                reports.append(report)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        return reports
+
+
+class PortSync(object):
+    """
+    Coalesce the port changes made by the post_save/post_delete cascades into one reconcile per node.
+
+    Within a deferred() block, the changes on the nodeaccounts are queued by node instead of calling
+    the Manager API for each of them, e.g. a node toggled active saves all its nodeaccounts, and
+    each of them used to add or remove its port with separate API calls. At the exit of the outermost
+    block, the queued nodes are reconciled once each with Heartbeat, on commit if in a transaction.
+
+    Each request is run in a deferred(request=True) block by PortSyncMiddleware, and so is each chunk
+    of a Job in a deferred() block. Outside of any block, the changes are made inline as before.
+
+    The reconcile of a request is handed to the task port_sync by default, see settings.SHADOWSOCKS_PORT_SYNC_ASYNC.
+    If it's disabled, or the task can't be queued, the reconcile is run in the request, bounded by one
+    Config.timeout_remote and without the accessibility scan. The errors are logged, never raised after the commit.
+
+    The queue is per thread: {node_id: set(<port to remove>)}, the ports to remove are only needed by
+    the port-by-port way, SSManager.reconcile() finds them by itself.
+    """
+
+    _local = threading.local()
+
+    @classmethod
+    def queue(cls):
+        if not hasattr(cls._local, 'queue'):
+            cls._local.depth = 0
+            cls._local.queue = {}
+        return cls._local.queue
+
+    @classmethod
+    def is_deferred(cls):
+        cls.queue()
+        return cls._local.depth > 0
+
+    @classmethod
+    @contextmanager
+    def deferred(cls, request=False):
+        """
+        Defer the port changes to the exit of the outermost block, which tells if it's in a request.
+        """
+        cls.queue()
+        if cls._local.depth == 0:
+            cls._local.request = request
+        cls._local.depth += 1
+        try:
+            yield
+        finally:
+            cls._local.depth -= 1
+            if cls._local.depth == 0:
+                (queue, cls._local.queue) = (cls._local.queue, {})
+                if queue:
+                    request = cls._local.request
+                    transaction.on_commit(lambda: cls.flush(queue, request=request))
+
+    @classmethod
+    def add(cls, node_id, removed=()):
+        """
+        Queue the node for the reconcile if deferred, return False otherwise.
+        """
+        if not cls.is_deferred():
+            return False
+        cls.queue().setdefault(node_id, set()).update(str(port) for port in removed)
+        return True
+
+    @classmethod
+    def flush(cls, queue, request=False):
+        node_ids = sorted(queue)
+        removed = {str(node_id): sorted(ports) for (node_id, ports) in queue.items() if ports}
+        if not request:
+            cls.sync(node_ids, removed)
+            return
+
+        if getattr(settings, 'SHADOWSOCKS_PORT_SYNC_ASYNC', True):
+            try:
+                from .tasks import port_sync
+                port_sync.delay(node_ids, removed)
+                return
+            except Exception as e:
+                logger.error('port sync: failed to queue the task, reconciling in the request: %s' % e)
+
+        # the changes are committed, the request must not fail after all
+        try:
+            cls.sync(node_ids, removed, inline=True)
+        except Exception as e:
+            logger.error('port sync: unexpected error: %s' % e)
+
+    @classmethod
+    def sync(cls, node_ids, removed=None, inline=False):
+        """
+        Reconcile the nodes, return the reports of Heartbeat.
+        The keys of removed are strings as it's passed to the task in JSON.
+        If inline, the reconcile is bounded by one Config.timeout_remote and the accessibility scan is skipped,
+        it's left to the next heartbeat.
+        """
+        removed = {int(node_id): ports for (node_id, ports) in (removed or {}).items()}
+        if inline:
+            heartbeat = Heartbeat(node_ids=node_ids, removed=removed, timeout=Config.load().timeout_remote, scan=False)
+        else:
+            heartbeat = Heartbeat(node_ids=node_ids, removed=removed)
+        reports = heartbeat.run()
+        for report in reports:
+            if report['status'] != 'ok':
+                logger.error('%s: port sync: the ports are not reconciled: %s' % (report['node'], report))
+        return reports
+
+
+class Job(models.Model):
+    """
+    A bulk action on the selected nodes or accounts, run in background by the task job_run.
+
+    The objects are processed in chunks of chunk_size, the progress and the results of each
+    object are saved after each chunk, so the admin can poll the job while it is running.
+
+    Each result is a dict: {'object': <str>, 'ok': <bool>, 'message': <str>}.
+    A failed object doesn't stop the job, the job is aborted only on an unexpected error
+    which is saved in the field error.
+    """
+    NODE_TOGGLE_ACTIVE = 'node_toggle_active'
+    NODE_CHANGE_IP = 'node_change_ip'
+    ACCOUNT_TOGGLE_ACTIVE = 'account_toggle_active'
+    ACCOUNT_NOTIFY = 'account_notify'
+    ACCOUNT_ADD_ALL_NODES = 'account_add_all_nodes'
+    ACTION_CHOICES = (
+        (NODE_TOGGLE_ACTIVE, 'Toggle Active/Inactive for Nodes'),
+        (NODE_CHANGE_IP, 'Replace the IP address for Nodes'),
+        (ACCOUNT_TOGGLE_ACTIVE, 'Toggle Active/Inactive for Accounts'),
+        (ACCOUNT_NOTIFY, 'Send Notification Email to Accounts'),
+        (ACCOUNT_ADD_ALL_NODES, 'Add All Nodes to Accounts'),
+    )
+
+    action = models.CharField(max_length=32, choices=ACTION_CHOICES)
+    object_ids = models.JSONField(default=list, help_text='IDs of the selected objects.')
+    user = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, related_name='+',
+        help_text='The user started the job.')
+    status = enum.EnumField(JobStatusList, default=JobStatusList.PENDING)
+    total = models.PositiveIntegerField(default=0)
+    done = models.PositiveIntegerField(default=0, help_text='Number of the processed objects.')
+    failed = models.PositiveIntegerField(default=0, help_text='Number of the failed objects.')
+    results = models.JSONField(default=list, blank=True)
+    error = models.TextField(null=True, blank=True)
+    dt_created = models.DateTimeField('Created', auto_now_add=True)
+    dt_updated = models.DateTimeField('Updated', auto_now=True)
+
+    # number of the objects processed between the progress updates
+    chunk_size = 50
+
+    class Meta:
+        verbose_name = 'Shadowsocks Job'
+
+    def __str__(self):
+        return '#%s %s' % (self.pk, self.get_action_display())
+
+    @property
+    def progress(self):
+        return '%s%%' % (self.done * 100 // self.total if self.total else 100)
+
+    @classmethod
+    def create(cls, action, queryset, user=None):
+        ids = list(queryset.order_by('pk').values_list('pk', flat=True))
+        return cls.objects.create(action=action, object_ids=ids, total=len(ids),
+            user=user if user and user.pk else None)
+
+    @property
+    def model(self):
+        return Node if self.action.startswith('node_') else Account
+
+    def save_progress(self, results):
+        self.results.extend(results)
+        self.done += len(results)
+        self.failed += len([result for result in results if not result['ok']])
+        self.save(update_fields=['status', 'done', 'failed', 'results', 'error', 'dt_updated'])
+
+    def run(self):
+        """
+        Run the action on the objects chunk by chunk, return a summary of the job.
+        """
+        self.status = JobStatusList.RUNNING
+        self.save(update_fields=['status', 'dt_updated'])
+
+        method = getattr(self, 'run_%s' % self.action)
+        try:
+            for i in range(self.done, len(self.object_ids), self.chunk_size):
+                ids = self.object_ids[i:i + self.chunk_size]
+                objs = list(self.model.objects.filter(pk__in=ids).order_by('pk'))
+                with PortSync.deferred():
+                    results = dict(zip([obj.pk for obj in objs], method(objs)))
+                # the objects may be deleted after the job is created
+                self.save_progress([results.get(pk) or self.result(pk, False, 'Not found.') for pk in ids])
+        except Exception as e:
+            logger.error('%s: unexpected error: %s' % (self, e))
+            self.status = JobStatusList.ABORTED
+            self.error = str(e)
+            self.save(update_fields=['status', 'error', 'dt_updated'])
+            raise
+
+        self.status = JobStatusList.FINISHED
+        self.save(update_fields=['status', 'dt_updated'])
+        return {'job': self.pk, 'total': self.total, 'done': self.done, 'failed': self.failed}
+
+    @staticmethod
+    def result(obj, ok, message):
+        return {'object': str(obj), 'ok': ok, 'message': message}
+
+    def run_each(self, objs, func):
+        """
+        Run the func on each object, and return the results in the order of the objects.
+        The func returns the message for the object.
+        """
+        results = []
+        for obj in objs:
+            try:
+                results.append(self.result(obj, True, func(obj)))
+            except Exception as e:
+                logger.error('%s: %s: %s' % (self, obj, e))
+                results.append(self.result(obj, False, str(e)))
+        return results
+
+    @staticmethod
+    def toggle_active(obj):
+        obj.toggle_active()
+        return 'now is %s' % ('Active' if obj.is_active else 'Inactive')
+
+    def run_node_toggle_active(self, objs):
+        return self.run_each(objs, self.toggle_active)
+
+    def run_node_change_ip(self, objs):
+        def change_ip(obj):
+            obj.change_ip()
+            return 'The message is sent to the SNS topic to request a new IP address.'
+        return self.run_each(objs, change_ip)
+
+    def run_account_toggle_active(self, objs):
+        return self.run_each(objs, self.toggle_active)
+
+    def run_account_add_all_nodes(self, objs):
+        nodes = {}
+        for na in NodeAccount.assign(objs, Node.objects.all()):
+            nodes.setdefault(na.account_id, []).append(na.node)
+        return [self.result(obj, True, 'Added %s' % nodes.get(obj.pk, [])) for obj in objs]
+
+    def run_account_notify(self, objs):
+        report = Account.notify_many(objs, sender=self.user or User())
+        results = []
+        for obj in objs:
+            error = report['errors'].get(str(obj))
+            if error:
+                results.append(self.result(obj, False, error))
+            else:
+                results.append(self.result(obj, True, 'Message sent to %s.' % obj.email))
+        return results
 
 
 class SSServer(object):  # pragma: no cover
@@ -1003,12 +2112,14 @@ class SSServer(object):  # pragma: no cover
 
 @receiver(post_save, sender=NodeAccount)
 def update_account_on_node(sender, instance, **kwargs):
-    instance.on_update()
+    if not PortSync.add(instance.node_id):
+        instance.on_update()
 
 
 @receiver(post_delete, sender=NodeAccount)
 def delete_account_on_node(sender, instance, **kwargs):
-    instance.on_delete()
+    if not PortSync.add(instance.node_id, removed=[instance.account.username]):
+        instance.on_delete()
 
 
 @receiver(post_save, sender=Account)
@@ -5,7 +5,7 @@ from __future__ import absolute_import, unicode_literals
 
 from celery import shared_task
 
-from .models import Node, NodeAccount
+from .models import Node, NodeAccount, Job, PortSync
 
 
 @shared_task
@@ -19,3 +19,11 @@ def node_change_ips():
 @shared_task
 def node_change_ips_softly():
     return Node.change_ips_softly()
+
+@shared_task
+def job_run(job_id):
+    return Job.objects.get(pk=job_id).run()
+
+@shared_task
+def port_sync(node_ids, removed=None):
+    return PortSync.sync(node_ids, removed)
@@ -7,16 +7,19 @@ from __future__ import absolute_import
 import json
 import os
 import time
+import smtplib
 import botocore
 from abc import abstractmethod
+from unittest.mock import patch
+from django.core import mail
 from django.test import TestCase
 from django.core.exceptions import ValidationError
 from django.core.management import call_command
 
-from domain.models import Record
+from domain.models import Record, Domain
 from domain.tests import AppTestCase as DomainAppTestCase
 from notification.tests import AppTestCase as NotificationAppTestCase
-from shadowsocks import models, serializers
+from shadowsocks import models, serializers, tasks
 
 
 import logging
@@ -41,6 +44,70 @@ def get_private_ip():
     return IP
 
 
+import threading
+class MockManagerServer(object):
+    """
+    A minimal in-process Shadowsocks Manager API (libev edition) over UDP on localhost.
+    It keeps the ports in memory and answers the commands: ping, list, add and remove.
+    Set `delay` to postpone the replies, set `silent` to stop replying.
+    """
+
+    def __init__(self, ports=None, delay=0, silent=False):
+        self.ports = dict(ports or {})
+        self.delay = delay
+        self.silent = silent
+        self.commands = []
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.settimeout(0.05)
+        self.port = self.socket.getsockname()[1]
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join(1)
+        self.socket.close()
+
+    def reply(self, data):
+        command, _, payload = data.decode('utf-8').partition(':')
+        command = command.strip()
+        self.commands.append(command)
+        if command == 'ping':
+            return 'stat: ' + json.dumps({port: 0 for port in self.ports})
+        elif command == 'list':
+            return json.dumps([{'server_port': port, 'password': password} for port, password in self.ports.items()])
+        elif command == 'add':
+            payload = json.loads(payload)
+            self.ports[str(payload['server_port'])] = payload['password']
+            return 'ok'
+        elif command == 'remove':
+            self.ports.pop(str(json.loads(payload)['server_port']), None)
+            return 'ok'
+
+    def serve(self):
+        while not self.stopped.is_set():
+            try:
+                data, address = self.socket.recvfrom(65535)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            reply = self.reply(data)
+            if self.silent or reply is None:
+                continue
+            if self.delay:
+                time.sleep(self.delay)
+            try:
+                self.socket.sendto(reply.encode('utf-8'), address)
+            except OSError:
+                return
+
+
 """
 The following environment variables are required to run some of the tests:
 
@@ -189,6 +256,48 @@ class ConfigTestCase(AppTestCase):
         obj = serializers.ConfigSerializer()
         json.loads(json.dumps(obj.to_representation(models.Config.objects.first())))
 
+    def test_config_load_memoized(self):
+        expected = models.Config.load()
+        with patch.object(models.cache, 'get') as get:
+            with self.assertNumQueries(0):
+                self.assertEqual(models.Config.load(), expected)
+        get.assert_not_called()
+
+    def test_config_load_copy(self):
+        models.Config.load().timeout_remote = 100
+        self.assertNotEqual(models.Config.load().timeout_remote, 100)
+
+    def test_config_load_invalidated(self):
+        timeout_local = models.Config.load().timeout_local
+
+        # the changes in this process show up at once
+        models.Config.objects.update(timeout_local=timeout_local + 1)
+        self.assertEqual(models.Config.load().timeout_local, timeout_local + 1)
+
+        config = models.Config.load()
+        config.timeout_local = timeout_local + 2
+        config.save()
+        self.assertEqual(models.Config.load().timeout_local, timeout_local + 2)
+
+    def test_config_load_version(self):
+        models.Config.load()
+        key = models.Config.get_cache_key()
+        (version, expiry, obj) = models.Config._memos[key]
+
+        # the memo expired, kept with the version unchanged
+        models.Config._memos[key] = (version, 0, obj)
+        with patch.object(models.Config.objects, 'get_or_create') as get_or_create:
+            models.Config.load()
+        get_or_create.assert_not_called()
+
+        # the version changed by another process
+        models.Config.objects.filter(pk=1).update(timeout_local=9)
+        models.cache.set(key, models.Config.objects.get(pk=1))
+        models.cache.set(models.Config.get_version_key(), 'changed-by-others')
+        self.assertNotEqual(models.Config.load().timeout_local, 9)
+        models.Config._memos[key] = (version, 0, obj)
+        self.assertEqual(models.Config.load().timeout_local, 9)
+
 
 class AccountTestCase(AppTestCase):
     @classmethod
@@ -541,9 +650,10 @@ class NodeAccountTestCase(AppTestCase):
         obj = models.NodeAccount.objects.first()
         if obj.node.ssmanager:
             obj.is_accessible_ex()
-            self.assertTrue(models.cache.get('{}:{}'.format(obj.node.public_ip, obj.account.username)))
+            key = obj.cache_key
+            self.assertTrue(models.cache.get(key))
             obj.delete()
-            self.assertFalse(models.cache.get('{}:{}'.format(obj.node.public_ip, obj.account.username)))
+            self.assertFalse(models.cache.get(key))
 
     def test_nodeaccount_is_created_positive(self):
         models.NodeAccount.heartbeat()
@@ -663,9 +773,9 @@ class SSManagerTestCase(AppTestCase):
         obj = models.SSManager.objects.first()
         if obj:
             obj.list_ex()
-            self.assertTrue(models.cache.get('{}-{}'.format(obj, 'list')))
+            self.assertTrue(models.cache.get(obj.get_cache_key('list')))
             obj.delete()
-            self.assertFalse(models.cache.get('{}-{}'.format(obj, 'list')))
+            self.assertFalse(models.cache.get(obj.get_cache_key('list')))
 
     def test_ssmanager_serializer(self):
         serializer = serializers.SSManagerSerializer()
@@ -816,3 +926,953 @@ class NodeOriginalSnapshotTestCase(AppTestCase):
         na.refresh_from_db()
         self.assertTrue(na.is_active,
             'a save that does not flip is_active should leave NodeAccount untouched')
+
+
+class ManagerTransportTestCase(AppTestCase):
+
+    def setUp(self):
+        models.ManagerTransport.close_all()
+
+    def tearDown(self):
+        models.ManagerTransport.close_all()
+
+    def get_ssmanager(self, server):
+        return models.SSManager(node=models.Node(private_ip='127.0.0.1', public_ip='127.0.0.1'),
+            interface=models.InterfaceList.LOCALHOST, port=server.port)
+
+    def test_transport_shared_per_endpoint(self):
+        self.assertIs(models.ManagerTransport.get('127.0.0.1', 6001), models.ManagerTransport.get('127.0.0.1', '6001'))
+        self.assertIsNot(models.ManagerTransport.get('127.0.0.1', 6001), models.ManagerTransport.get('127.0.0.1', 6002))
+
+    def test_transport_socket_reused(self):
+        with MockManagerServer(ports={'8381': 'mock-password'}) as server:
+            obj = self.get_ssmanager(server)
+            self.assertEqual(obj.ping(), {'8381': 0})
+            sock = obj.transport.socket
+            self.assertEqual(obj.list(), [{'server_port': '8381', 'password': 'mock-password'}])
+            self.assertIs(obj.transport.socket, sock)
+            # another instance of the same manager shares the transport
+            self.assertIs(self.get_ssmanager(server).transport, obj.transport)
+
+    def test_transport_unread_reply_not_mismatched(self):
+        with MockManagerServer() as server:
+            obj = self.get_ssmanager(server)
+            # the 'ok' reply of add is not read, it must not be taken as the reply of ping or list
+            obj._add(8381, 'mock-password')
+            time.sleep(0.1)
+            self.assertEqual(obj.ping(), {'8381': 0})
+            obj._remove(8381)
+            self.assertEqual(obj.list(), [])
+
+    def test_transport_late_reply_discarded(self):
+        with MockManagerServer(ports={'8381': 'mock-password'}, delay=0.3) as server:
+            obj = self.get_ssmanager(server)
+            config = models.Config.load()
+            config.timeout_local = 0.2
+            config.save()
+            self.assertIsNone(obj._list())  # timed out
+            server.delay = 0
+            time.sleep(0.2)
+            # the late reply of list must not be taken as the reply of ping
+            self.assertEqual(obj.ping(), {'8381': 0})
+
+    def test_transport_reconnect_after_error(self):
+        with MockManagerServer() as server:
+            obj = self.get_ssmanager(server)
+            self.assertEqual(obj.ping(), {})
+            obj.transport.socket.close()  # break the socket under the transport
+            self.assertIsNone(obj.ping())
+            self.assertIsNone(obj.transport.socket)
+            self.assertEqual(obj.ping(), {})
+
+    def test_transport_thread_safe(self):
+        with MockManagerServer(ports={'8381': 'mock-password'}) as server:
+            results = []
+
+            def worker():
+                for _ in range(5):
+                    results.append(self.get_ssmanager(server).ping())
+
+            threads = [threading.Thread(target=worker) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(results, [{'8381': 0}] * 40)
+
+    def test_transport_discard(self):
+        models.ManagerTransport.discard('127.0.0.1', 6001)
+        self.assertEqual(models.ManagerTransport._transports, {})
+
+        transport = models.ManagerTransport.get('127.0.0.1', 6001)
+        transport.connect()
+        models.ManagerTransport.discard('127.0.0.1', '6001')
+        self.assertIsNone(transport.socket)
+        self.assertEqual(models.ManagerTransport._transports, {})
+
+    def test_transport_discarded_on_ssmanager_changes(self):
+        with MockManagerServer() as server:
+            node = models.Node.objects.create(name='mock-node', public_ip='127.0.0.2', private_ip='127.0.0.3')
+            obj = models.SSManager.objects.create(node=node, interface=models.InterfaceList.PRIVATE, port=server.port)
+            old = models.ManagerTransport.get('127.0.0.3', server.port)
+
+            # the port and the interface are changed
+            obj.port = 6002
+            obj.interface = models.InterfaceList.PUBLIC
+            obj.save()
+            self.assertNotIn(old, models.ManagerTransport._transports.values())
+
+            # the IP of the node is changed
+            old = models.ManagerTransport.get('127.0.0.2', 6002)
+            node = models.Node.objects.get(pk=node.pk)
+            node.public_ip = '127.0.0.4'
+            node.save()
+            self.assertNotIn(old, models.ManagerTransport._transports.values())
+
+            # the deletion never creates a transport
+            models.SSManager.objects.get(pk=obj.pk).delete()
+            self.assertEqual(models.ManagerTransport._transports, {})
+
+
+class MockNodeTestCase(AppTestCase):
+    """
+    A base test case with the nodes served by MockManagerServer.
+    """
+
+    def setUp(self):
+        models.ManagerTransport.close_all()
+
+    def tearDown(self):
+        models.ManagerTransport.close_all()
+
+    def add_node(self, name, server, ports):
+        node = models.Node.objects.create(name=name, public_ip='127.0.0.1', private_ip='127.0.0.1')
+        models.SSManager.objects.create(node=node, interface=models.InterfaceList.LOCALHOST, port=server.port)
+        for port in ports:
+            account, created = models.Account.objects.get_or_create(username=str(port),
+                defaults={'password': 'mock-password', 'is_active': True})
+            models.NodeAccount.objects.create(node=node, account=account, is_active=True)
+        return node
+
+
+class HeartbeatTestCase(MockNodeTestCase):
+
+    def test_heartbeat_recreate_ports(self):
+        with MockManagerServer() as server1, MockManagerServer() as server2:
+            self.add_node('mock-node-1', server1, [8381, 8382])
+            self.add_node('mock-node-2', server2, [8381])
+            # ports lost on the nodes, e.g.: the ss-manager restarted
+            server1.ports.clear()
+            server2.ports.clear()
+            models.SSManager.objects.first().clear_cache()
+            models.SSManager.objects.last().clear_cache()
+
+            reports = models.NodeAccount.heartbeat()
+
+            self.assertEqual([(r['node'], r['status'], r['ports'], r['done']) for r in reports],
+                [('mock-node-1', 'ok', 2, 2), ('mock-node-2', 'ok', 1, 1)])
+            self.assertEqual(set(server1.ports), {'8381', '8382'})
+            self.assertEqual(set(server2.ports), {'8381'})
+
+    def test_heartbeat_remove_inactive_ports(self):
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [8381, 8382])
+            models.NodeAccount.objects.filter(node=node, account__username='8382').update(is_active=False)
+
+            reports = models.NodeAccount.heartbeat()
+
+            self.assertEqual(reports[0]['status'], 'ok')
+            self.assertEqual(set(server.ports), {'8381'})
+
+    def test_heartbeat_skipped_without_ssmanager(self):
+        node = models.Node.objects.create(name='no-ssmgr-heartbeat')
+        account = models.Account.objects.create(username='8381', password='mock-password')
+        models.NodeAccount.objects.create(node=node, account=account)
+        self.assertEqual(models.NodeAccount.heartbeat(),
+            [{'node': 'no-ssmgr-heartbeat', 'status': 'skipped', 'ports': 1, 'done': 0}])
+
+    def test_heartbeat_unavailable_nodes_in_parallel(self):
+        config = models.Config.load()
+        config.timeout_local = 0.5
+        config.save()
+        with MockManagerServer(silent=True) as server1, MockManagerServer(silent=True) as server2:
+            self.add_node('mock-node-1', server1, [8381])
+            self.add_node('mock-node-2', server2, [8382])
+            models.SSManager.objects.first().clear_cache()
+            models.SSManager.objects.last().clear_cache()
+
+            start_time = time.time()
+            reports = models.NodeAccount.heartbeat()
+            elapsed_time = time.time() - start_time
+
+            self.assertEqual([r['status'] for r in reports], ['unavailable', 'unavailable'])
+            # both nodes timed out at the same time rather than one after another
+            self.assertLess(elapsed_time, config.timeout_local * 2)
+
+    def test_heartbeat_deadline(self):
+        with MockManagerServer() as server:
+            self.add_node('mock-node', server, [8381, 8382, 8383])
+            server.ports.clear()
+            models.SSManager.objects.first().clear_cache()
+            server.delay = 0.1
+
+            start_time = time.time()
+            reports = models.NodeAccount.heartbeat(timeout=0.05)
+            elapsed_time = time.time() - start_time
+
+            # still in progress at the deadline
+            self.assertEqual((reports[0]['status'], reports[0]['done']), ('timeout', None))
+            self.assertLess(elapsed_time, server.delay)
+
+    def test_heartbeat_one_deadline_for_cycle(self):
+        config = models.Config.load()
+        config.timeout_local = 0.5
+        config.save()
+        with MockManagerServer(silent=True) as server1, MockManagerServer(silent=True) as server2:
+            self.add_node('mock-node-1', server1, [8381])
+            self.add_node('mock-node-2', server2, [8382])
+            models.SSManager.objects.first().clear_cache()
+            models.SSManager.objects.last().clear_cache()
+
+            start_time = time.time()
+            reports = models.Heartbeat(max_workers=1, timeout=0.2).run()
+            elapsed_time = time.time() - start_time
+
+            # the first node is left behind, the second node is never started
+            self.assertEqual([(r['status'], r['done']) for r in reports], [('timeout', None), ('timeout', 0)])
+            # the batches of the workers share the deadline
+            self.assertLess(elapsed_time, config.timeout_local)
+
+    def test_heartbeat_not_started_after_deadline(self):
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [8381])
+            with patch.object(models.SSManager, 'reconcile') as mock_reconcile:
+                report = models.Heartbeat().reconcile(node.ssmanager, list(node.accounts_ref.all()), time.time())
+            self.assertEqual(report, {'status': 'timeout', 'ports': 1, 'done': 0, 'elapsed': 0})
+            mock_reconcile.assert_not_called()
+
+
+class PortScannerTestCase(MockNodeTestCase):
+
+    def listen(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        s.listen(16)
+        self.addCleanup(s.close)
+        return s.getsockname()[1]
+
+    def closed_port(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        return port
+
+    def test_scan(self):
+        (open_port, closed_port) = (self.listen(), self.closed_port())
+        results = models.PortScanner().scan([('127.0.0.1', open_port), ('127.0.0.1', closed_port), (None, 8381)])
+        self.assertEqual(results, {('127.0.0.1', open_port): True, ('127.0.0.1', closed_port): False, (None, 8381): False})
+
+    def saturated_port(self):
+        """
+        Return a port with the accept queue full, connecting to it hangs.
+        """
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        s.listen(0)
+        c = socket.create_connection(s.getsockname())
+        self.addCleanup(s.close)
+        self.addCleanup(c.close)
+        return s.getsockname()[1]
+
+    def test_scan_concurrently(self):
+        config = models.Config.load()
+        config.timeout_local = 0.3
+        config.save()
+        targets = [('127.0.0.1', self.saturated_port()) for i in range(10)] + [('127.0.0.1', self.listen())]
+
+        start_time = time.time()
+        results = models.PortScanner(max_sockets=4).scan(targets)
+        elapsed_time = time.time() - start_time
+
+        self.assertEqual([results[target] for target in targets], [False] * 10 + [True])
+        # 3 rounds of 4 sockets at most, rather than one after another
+        self.assertLess(elapsed_time, config.timeout_local * 4)
+
+    def test_scan_accessible(self):
+        node = models.Node.objects.create(name='mock-node', public_ip='127.0.0.1', private_ip='127.0.0.1')
+        ports = [self.listen(), self.closed_port()]
+        for port in ports:
+            account = models.Account.objects.create(username=str(port), password='mock-password')
+            # skip the signals to keep away from the Manager API
+            models.NodeAccount.objects.bulk_create([models.NodeAccount(node=node, account=account)])
+        nas = models.NodeAccount.objects.filter(node=node).select_related('node', 'account').order_by('account__username')
+
+        results = models.NodeAccount.scan_accessible(nas)
+        self.assertEqual(results, {na.pk: str(ports[0]) == na.account.username for na in nas})
+
+        # the results are cached
+        with patch.object(models.Node, 'is_port_open') as is_port_open:
+            self.assertEqual([na.is_accessible_ex() for na in nas], [results[na.pk] for na in nas])
+        is_port_open.assert_not_called()
+
+    def test_heartbeat_warms_accessible_cache(self):
+        with MockManagerServer() as server:
+            self.add_node('mock-node', server, [8381, 8382])
+            models.SSManager.objects.first().clear_cache()
+
+            with patch.object(models.NodeAccount, 'scan_accessible', wraps=models.NodeAccount.scan_accessible) as scan:
+                reports = models.NodeAccount.heartbeat()
+
+            self.assertEqual(scan.call_count, 1)
+            self.assertEqual(reports[0]['accessible'], 0)
+
+
+class AccountNotifyTestCase(MockNodeTestCase):
+
+    def setUp(self):
+        super(AccountNotifyTestCase, self).setUp()
+        mail.outbox = []
+
+    def add_nodes(self, server1, server2):
+        self.add_node('mock-node-1', server1, [8381, 8382, 8383])
+        self.add_node('mock-node-2', server2, [8381, 8382])
+        for account in models.Account.objects.all():
+            account.email = '%s@mock-example.com' % account.username
+            account.save()
+        return list(models.Account.objects.order_by('pk'))
+
+    def test_account_notify_many(self):
+        with MockManagerServer() as server1, MockManagerServer() as server2:
+            accounts = self.add_nodes(server1, server2)
+            mail.outbox = []
+
+            # template, nodeaccounts and ssmanagers, regardless of the number of the accounts
+            with self.assertNumQueries(3):
+                report = models.Account.notify_many(accounts, sender=accounts[0])
+
+            self.assertEqual(report, {'sent': 3, 'failed': 0, 'errors': {}})
+            self.assertEqual([m.to for m in mail.outbox], [[a.email] for a in accounts])
+
+            # the same messages as sent one by one
+            bodies = [m.body for m in mail.outbox]
+            mail.outbox = []
+            for account in accounts:
+                self.assertTrue(account.notify(sender=accounts[0]))
+            self.assertEqual([m.body for m in mail.outbox], bodies)
+
+    def test_account_notify_many_errors(self):
+        with MockManagerServer() as server1, MockManagerServer() as server2:
+            accounts = self.add_nodes(server1, server2)
+            accounts[0].email = ''
+            mail.outbox = []
+
+            report = models.Account.notify_many(accounts, sender=accounts[1])
+
+            self.assertEqual((report['sent'], report['failed']), (2, 0))
+            self.assertEqual(list(report['errors']), [str(accounts[0])])
+            self.assertIn('email', report['errors'][str(accounts[0])])
+            self.assertEqual(len(mail.outbox), 2)
+
+    def test_account_notify_many_send_failed(self):
+        from django.core.mail.backends.locmem import EmailBackend
+        send_messages = EmailBackend.send_messages
+
+        def side_effect(backend, messages):
+            if messages[0].to == [accounts[1].email]:
+                raise smtplib.SMTPRecipientsRefused({accounts[1].email: (550, b'mock refused')})
+            return send_messages(backend, messages)
+
+        with MockManagerServer() as server1, MockManagerServer() as server2:
+            accounts = self.add_nodes(server1, server2)
+            mail.outbox = []
+            with patch.object(EmailBackend, 'send_messages', autospec=True, side_effect=side_effect):
+                report = models.Account.notify_many(accounts, sender=accounts[0])
+
+            # only the account failed to send is recorded as failed
+            self.assertEqual((report['sent'], report['failed']), (2, 1))
+            self.assertEqual(list(report['errors']), [str(accounts[1])])
+            self.assertEqual([m.to for m in mail.outbox], [[accounts[0].email], [accounts[2].email]])
+
+            job = models.Job.create(models.Job.ACCOUNT_NOTIFY, models.Account.objects.all(), user=accounts[0])
+            with patch.object(EmailBackend, 'send_messages', autospec=True, side_effect=side_effect):
+                tasks.job_run(job.pk)
+            self.assertEqual([r['ok'] for r in models.Job.objects.get(pk=job.pk).results], [True, False, True])
+
+    def test_account_notify_job(self):
+        with MockManagerServer() as server1, MockManagerServer() as server2:
+            accounts = self.add_nodes(server1, server2)
+            accounts[2].email = ''
+            accounts[2].save()
+            mail.outbox = []
+
+            job = models.Job.create(models.Job.ACCOUNT_NOTIFY, models.Account.objects.all(), user=accounts[0])
+            report = tasks.job_run(job.pk)
+
+            self.assertEqual(report, {'job': job.pk, 'total': 3, 'done': 3, 'failed': 1})
+            self.assertEqual([r['ok'] for r in models.Job.objects.get(pk=job.pk).results], [True, True, False])
+            self.assertEqual(len(mail.outbox), 2)
+
+
+class JobTestCase(MockNodeTestCase):
+
+    def test_job_node_toggle_active(self):
+        with MockManagerServer() as server1, MockManagerServer() as server2:
+            self.add_node('mock-node-1', server1, [8381, 8382])
+            self.add_node('mock-node-2', server2, [8381])
+            job = models.Job.create(models.Job.NODE_TOGGLE_ACTIVE, models.Node.objects.all())
+            self.assertEqual((job.status, job.total, job.progress), (models.JobStatusList.PENDING, 2, '0%'))
+
+            # the progress is saved after each chunk
+            job.chunk_size = 1
+            save_progress = models.Job.save_progress
+            with patch.object(models.Job, 'save_progress', autospec=True, side_effect=save_progress) as mock_save_progress, \
+                    self.captureOnCommitCallbacks(execute=True):
+                job.run()
+            self.assertEqual([len(c[0][1]) for c in mock_save_progress.call_args_list], [1, 1])
+
+            job = models.Job.objects.get(pk=job.pk)
+            self.assertEqual((job.status, job.done, job.failed, job.progress), (models.JobStatusList.FINISHED, 2, 0, '100%'))
+            self.assertEqual([r['message'] for r in job.results], ['now is Inactive', 'now is Inactive'])
+            self.assertFalse(models.NodeAccount.objects.filter(is_active=True).exists())
+            self.assertEqual(set(server1.ports), set())
+
+    def test_job_failed_and_deleted_objects(self):
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [8381])
+            models.Node.objects.create(name='mock-node-deleted', public_ip='127.0.0.1')
+            job = models.Job.create(models.Job.NODE_CHANGE_IP, models.Node.objects.all())
+            models.Node.objects.filter(name='mock-node-deleted').delete()
+
+            report = job.run()
+
+            self.assertEqual(report, {'job': job.pk, 'total': 2, 'done': 2, 'failed': 2})
+            # no SNS topic is configured for the node
+            self.assertEqual([(r['object'], r['ok']) for r in job.results], [(str(node), False), (str(node.pk + 1), False)])
+            self.assertEqual(job.results[1]['message'], 'Not found.')
+            self.assertEqual(job.status, models.JobStatusList.FINISHED)
+
+    def test_job_aborted(self):
+        with MockManagerServer() as server:
+            self.add_node('mock-node', server, [8381])
+            job = models.Job.create(models.Job.ACCOUNT_TOGGLE_ACTIVE, models.Account.objects.all())
+            with patch.object(models.Job, 'run_each', side_effect=RuntimeError('mock error')):
+                self.assertRaises(RuntimeError, job.run)
+
+            job = models.Job.objects.get(pk=job.pk)
+            self.assertEqual((job.status, job.error, job.done), (models.JobStatusList.ABORTED, 'mock error', 0))
+
+    def test_job_admin_action(self):
+        from django.contrib.auth.models import User
+        user = User.objects.create_superuser('mock-admin', 'admin@mock-example.com', 'mock-password')
+        self.client.force_login(user)
+        with MockManagerServer() as server:
+            self.add_node('mock-node', server, [8381, 8382])
+            ids = [str(pk) for pk in models.Account.objects.values_list('pk', flat=True)]
+            with patch('shadowsocks.admin.job_run.delay') as mock_delay:
+                response = self.client.post('/admin/shadowsocks/account/',
+                    {'action': 'add_all_nodes', '_selected_action': ids}, follow=True)
+
+            job = models.Job.objects.get()
+            mock_delay.assert_called_once_with(job.pk)
+            self.assertEqual((job.action, job.total, job.user), (models.Job.ACCOUNT_ADD_ALL_NODES, 2, user))
+            self.assertContains(response, 'queued for 2 object(s)')
+            self.assertEqual(self.client.get('/admin/shadowsocks/job/%s/change/' % job.pk).status_code, 200)
+
+
+class NodeAccountAssignTestCase(MockNodeTestCase):
+
+    def add_accounts(self, ports):
+        return [models.Account.objects.create(username=str(port), password='mock-password', is_active=True)
+            for port in ports]
+
+    def test_assign(self):
+        with MockManagerServer() as server1, MockManagerServer() as server2:
+            node1 = self.add_node('mock-node-1', server1, [8381])
+            node2 = self.add_node('mock-node-2', server2, [])
+            accounts = [models.Account.objects.get(username='8381')] + self.add_accounts([8382, 8383])
+
+            reconcile = models.SSManager.reconcile
+            with patch.object(models.NodeAccount, 'on_update') as mock_on_update, \
+                    patch.object(models.SSManager, 'reconcile', autospec=True, side_effect=reconcile) as mock_reconcile:
+                with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                    nas = models.NodeAccount.assign(accounts, models.Node.objects.all())
+                    # the ports are created on commit
+                    mock_reconcile.assert_not_called()
+
+            self.assertEqual(len(callbacks), 1)
+            # 8381 is already on node1
+            self.assertEqual(sorted((na.node.name, na.account.username) for na in nas), [
+                ('mock-node-1', '8382'), ('mock-node-1', '8383'),
+                ('mock-node-2', '8381'), ('mock-node-2', '8382'), ('mock-node-2', '8383')])
+            self.assertEqual(models.NodeAccount.objects.count(), 6)
+            # no signal for each nodeaccount, each node is reconciled once
+            mock_on_update.assert_not_called()
+            self.assertEqual(sorted(c[0][0].node.name for c in mock_reconcile.call_args_list), ['mock-node-1', 'mock-node-2'])
+            self.assertEqual(set(server1.ports), {'8381', '8382', '8383'})
+            self.assertEqual(set(server2.ports), {'8381', '8382', '8383'})
+
+            # nothing is missing now
+            self.assertEqual(models.NodeAccount.assign(accounts, [node1, node2]), [])
+
+    def test_assign_inactive(self):
+        with MockManagerServer() as server1, MockManagerServer() as server2:
+            self.add_node('mock-node-1', server1, [])
+            node2 = self.add_node('mock-node-2', server2, [])
+            node2.toggle_active()
+            (active, inactive) = self.add_accounts([8381, 8382])
+            inactive.toggle_active()
+
+            with self.captureOnCommitCallbacks(execute=True):
+                nas = models.NodeAccount.assign([active, inactive], models.Node.objects.all())
+
+            self.assertEqual(sorted((na.node.name, na.account.username, na.is_active) for na in nas), [
+                ('mock-node-1', '8381', True), ('mock-node-1', '8382', False),
+                ('mock-node-2', '8381', False), ('mock-node-2', '8382', False)])
+            self.assertEqual(set(server1.ports), {'8381'})
+            self.assertEqual(set(server2.ports), set())
+
+    def test_account_add_all_nodes(self):
+        with MockManagerServer() as server1, MockManagerServer() as server2:
+            self.add_node('mock-node-1', server1, [8381])
+            node2 = self.add_node('mock-node-2', server2, [])
+            account = models.Account.objects.get(username='8381')
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(account.add_all_nodes(), [node2])
+            self.assertEqual(account.add_all_nodes(), [])
+            self.assertEqual(set(server2.ports), {'8381'})
+
+    def test_assign_concurrently(self):
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [])
+            (account1, account2) = self.add_accounts([8381, 8382])
+            bulk_create = models.NodeAccount.objects.bulk_create
+
+            def side_effect(objs, **kwargs):
+                # account1 is assigned by another request in the meantime
+                bulk_create([models.NodeAccount(node=node, account=account1)])
+                return bulk_create(objs, **kwargs)
+
+            with patch.object(models.NodeAccount.objects, 'bulk_create', side_effect=side_effect):
+                nas = models.NodeAccount.assign([account1, account2], [node])
+
+            # no IntegrityError on the unique (node, account)
+            self.assertEqual([na.pk for na in nas],
+                [models.NodeAccount.objects.get(node=node, account=account).pk for account in (account1, account2)])
+            self.assertEqual(models.NodeAccount.objects.filter(node=node).count(), 2)
+
+    def test_job_account_add_all_nodes(self):
+        with MockManagerServer() as server:
+            self.add_node('mock-node', server, [8381])
+            self.add_accounts([8382])
+            job = models.Job.create(models.Job.ACCOUNT_ADD_ALL_NODES, models.Account.objects.all())
+
+            with self.captureOnCommitCallbacks(execute=True):
+                job.run()
+
+            self.assertEqual([r['message'] for r in job.results], ['Added []', 'Added [<Node: mock-node>]'])
+            self.assertEqual(set(server.ports), {'8381', '8382'})
+
+
+class PortSyncTestCase(MockNodeTestCase):
+
+    def test_port_sync_node_toggle_active(self):
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [8381, 8382, 8383])
+            reconcile = models.SSManager.reconcile
+            with patch.object(models.NodeAccount, 'on_update') as mock_on_update, \
+                    patch.object(models.SSManager, 'reconcile', autospec=True, side_effect=reconcile) as mock_reconcile:
+                with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                    with models.PortSync.deferred():
+                        with models.PortSync.deferred():
+                            node.toggle_active()
+                        # flushed only at the exit of the outermost block
+                        self.assertEqual(models.PortSync.queue(), {node.pk: set()})
+                    self.assertEqual(models.PortSync.queue(), {})
+
+            self.assertEqual(len(callbacks), 1)
+            mock_on_update.assert_not_called()
+            mock_reconcile.assert_called_once()
+            self.assertEqual(server.ports, {})
+
+    def test_port_sync_account_changed(self):
+        with MockManagerServer() as server:
+            self.add_node('mock-node', server, [8381, 8382])
+            with self.captureOnCommitCallbacks(execute=True):
+                with models.PortSync.deferred():
+                    account = models.Account.objects.get(username='8381')
+                    account.password = 'new-password'
+                    account.save()
+                    account = models.Account.objects.get(username='8382')
+                    account.username = '8383'
+                    account.save()
+
+            self.assertEqual(server.ports, {'8381': 'new-password', '8383': 'mock-password'})
+
+    def test_port_sync_nodeaccount_deleted(self):
+        with MockManagerServer() as server:
+            self.add_node('mock-node', server, [8381])
+            with self.captureOnCommitCallbacks(execute=True):
+                with models.PortSync.deferred():
+                    models.NodeAccount.objects.get().delete()
+
+            # the node without any nodeaccount is reconciled too
+            self.assertEqual(server.ports, {})
+
+    def test_port_sync_port_by_port(self):
+        with MockManagerServer() as server:
+            self.add_node('mock-node', server, [8381, 8382])
+            # the live ports are not available, e.g. the python edition
+            with patch.object(models.SSManager, 'reconcile', return_value=None):
+                with self.captureOnCommitCallbacks(execute=True):
+                    with models.PortSync.deferred():
+                        account = models.Account.objects.get(username='8382')
+                        account.username = '8383'
+                        account.save()
+
+            self.assertEqual(set(server.ports), {'8381', '8383'})
+
+    def test_port_sync_inline(self):
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [8381])
+            with patch.object(models.NodeAccount, 'on_update') as mock_on_update:
+                node.toggle_active()
+            mock_on_update.assert_called_once()
+
+    def test_port_sync_async(self):
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [8381])
+            with patch.object(tasks.port_sync, 'delay') as mock_delay:
+                with self.captureOnCommitCallbacks(execute=True):
+                    with models.PortSync.deferred(request=True):
+                        models.NodeAccount.objects.get().delete()
+
+            mock_delay.assert_called_once_with([node.pk], {str(node.pk): ['8381']})
+            self.assertEqual(set(server.ports), {'8381'})
+            tasks.port_sync([node.pk], {str(node.pk): ['8381']})
+            self.assertEqual(server.ports, {})
+
+    def call_middleware(self, node):
+        from django.test import RequestFactory
+        from shadowsocks.middleware import PortSyncMiddleware
+
+        def get_response(request):
+            self.assertTrue(models.PortSync.is_deferred())
+            node.toggle_active()
+            return 'response'
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(PortSyncMiddleware(get_response)(RequestFactory().get('/')), 'response')
+        self.assertFalse(models.PortSync.is_deferred())
+
+    def test_port_sync_middleware(self):
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [8381, 8382])
+            with patch.object(tasks.port_sync, 'delay') as mock_delay:
+                self.call_middleware(node)
+
+            # handed to the celery worker by default
+            mock_delay.assert_called_once_with([node.pk], {})
+            self.assertEqual(set(server.ports), {'8381', '8382'})
+
+    def test_port_sync_middleware_inline(self):
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [8381, 8382])
+            run = models.Heartbeat.run
+            with self.settings(SHADOWSOCKS_PORT_SYNC_ASYNC=False), \
+                    patch.object(models.Heartbeat, 'run', autospec=True, side_effect=run) as mock_run, \
+                    patch.object(models.NodeAccount, 'scan_accessible') as mock_scan_accessible:
+                self.call_middleware(node)
+
+            # bounded by one network timeout, without the accessibility scan
+            heartbeat = mock_run.call_args[0][0]
+            self.assertEqual((heartbeat.timeout, heartbeat.is_scan_enabled), (models.Config.load().timeout_remote, False))
+            mock_scan_accessible.assert_not_called()
+            self.assertEqual(server.ports, {})
+
+    def test_port_sync_middleware_queue_failed(self):
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [8381, 8382])
+            with patch.object(tasks.port_sync, 'delay', side_effect=RuntimeError('mock broker down')):
+                self.call_middleware(node)
+
+            # falls back to the inline reconcile
+            self.assertEqual(server.ports, {})
+
+    def test_port_sync_middleware_error_not_raised(self):
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [8381, 8382])
+            with self.settings(SHADOWSOCKS_PORT_SYNC_ASYNC=False), \
+                    patch.object(models.Heartbeat, 'run', side_effect=RuntimeError('mock error')):
+                self.call_middleware(node)
+
+            self.assertFalse(models.Node.objects.get(pk=node.pk).is_active)
+
+
+class NodeAccountResolveTestCase(MockNodeTestCase):
+
+    def test_resolve_many(self):
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [8381, 8382, 8383])
+            server.ports.pop('8383')
+            node.ssmanager.clear_cache()
+            nas = list(node.accounts_ref.select_related('node', 'account').order_by('pk'))
+            models.cache.set(nas[0].cache_key, True)
+
+            scan_accessible = models.NodeAccount.scan_accessible
+            with patch.object(models.NodeAccount, 'scan_accessible', side_effect=scan_accessible) as mock_scan, \
+                    patch.object(models.SSManager, 'list', wraps=node.ssmanager.list) as mock_list:
+                results = models.NodeAccount.resolve_many(nas)
+
+            # only the cache misses are scanned, in one go
+            mock_scan.assert_called_once_with(nas[1:])
+            self.assertLessEqual(mock_list.call_count, 1)
+            self.assertEqual({pk: value['is_created'] for (pk, value) in results.items()},
+                {nas[0].pk: True, nas[1].pk: True, nas[2].pk: False})
+            self.assertTrue(results[nas[0].pk]['is_accessible_ex'])
+            # the ports are not listening in the tests
+            self.assertFalse(results[nas[1].pk]['is_accessible_ex'])
+            self.assertEqual(results[nas[1].pk]['is_accessible_ex'], nas[1].is_accessible_ex())
+
+    def test_resolve_many_without_ssmanager(self):
+        node = models.Node.objects.create(name='mock-node', public_ip='127.0.0.1')
+        account = models.Account.objects.create(username='8381', password='mock-password')
+        na = models.NodeAccount.objects.create(node=node, account=account)
+        results = models.NodeAccount.resolve_many([na])
+        self.assertEqual(results[na.pk]['is_created'], None)
+        self.assertEqual(results[na.pk]['is_created'], na.is_created())
+
+    def test_admin_lazy_batch(self):
+        from django.contrib.auth.models import User
+        self.client.force_login(User.objects.create_superuser('mock-admin', 'admin@mock-example.com', 'mock-password'))
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [8381, 8382])
+            ids = list(node.accounts_ref.order_by('pk').values_list('pk', flat=True))
+
+            response = self.client.get('/admin/shadowsocks/node/%s/change/' % node.pk)
+            # 2 fields for each nodeaccount, and the ones for the blank forms
+            self.assertContains(response, 'lazy_batch="yes"', count=8)
+            self.assertContains(response, 'utils/js/lazy_batch.js')
+
+            response = self.client.get('/admin/shadowsocks/nodeaccount/easy/lazy_batch/',
+                {'ids': ','.join(str(pk) for pk in ids + ['x'])})
+            data = response.json()
+            self.assertEqual(sorted(data), sorted(str(pk) for pk in ids))
+            self.assertIn('icon-yes.svg', data[str(ids[0])]['is_created'])
+            self.assertIn('icon-no.svg', data[str(ids[0])]['is_accessible_ex'])
+
+
+class SSManagerReconcileTestCase(MockNodeTestCase):
+
+    def test_reconcile_only_changed_ports(self):
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [8381, 8382, 8383, 8384])
+            models.NodeAccount.objects.filter(node=node, account__username='8383').update(is_active=False)
+            models.Account.objects.filter(username='8384').update(password='new-password')
+            server.ports = {
+                '8381': 'mock-password',    # in sync
+                '8383': 'mock-password',    # inactive
+                '8384': 'mock-password',    # password changed
+                '8385': 'mock-password',    # orphan in the port range
+                '65500': 'mock-password',   # out of the port range, not managed
+            }
+            server.commands.clear()
+
+            ret = node.ssmanager.reconcile()
+
+            self.assertEqual(ret, {'added': ['8382', '8384'], 'removed': ['8383', '8384', '8385'], 'failed': [], 'pending': []})
+            self.assertEqual(server.ports, {'8381': 'mock-password', '8382': 'mock-password',
+                '8384': 'new-password', '65500': 'mock-password'})
+            self.assertEqual(server.commands, ['list'] + ['remove'] * 3 + ['add'] * 2 + ['list'])
+
+    def test_reconcile_in_sync(self):
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [8381, 8382])
+            server.commands.clear()
+            ssmanager = node.ssmanager
+            # a single query for the nodeaccounts
+            with self.assertNumQueries(1):
+                ret = ssmanager.reconcile()
+            self.assertEqual(ret, {'added': [], 'removed': [], 'failed': [], 'pending': []})
+            self.assertEqual(server.commands, ['list'])
+
+    def test_reconcile_unavailable(self):
+        with MockManagerServer(silent=True) as server:
+            node = self.add_node('mock-node', server, [8381])
+            self.assertIsNone(node.ssmanager.reconcile())
+
+    def test_reconcile_deadline(self):
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [8381, 8382])
+            server.ports.clear()
+            ret = node.ssmanager.reconcile(deadline=time.time())
+            self.assertEqual(ret['pending'], ['8381', '8382'])
+            self.assertEqual(server.ports, {})
+
+
+class SSManagerPortIndexTestCase(MockNodeTestCase):
+
+    def test_port_index(self):
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [8381, 8382])
+            ssmanager = node.ssmanager
+            self.assertEqual(ssmanager.port_index(), {'8381': 'mock-password', '8382': 'mock-password'})
+            self.assertTrue(ssmanager.is_port_created(8381))
+            self.assertFalse(ssmanager.is_port_created(8383))
+
+    def test_port_index_shared_by_lookups(self):
+        with MockManagerServer() as server:
+            ssmanager = self.add_node('mock-node', server, [8381, 8382]).ssmanager
+            ssmanager.port_index()
+            with patch.object(models.SSManager, 'list_ex') as list_ex:
+                for port in range(8381, 8480):
+                    ssmanager.is_port_created(port)
+                list_ex.assert_not_called()
+
+    def test_port_index_rebuilt_on_new_fetch(self):
+        with MockManagerServer() as server:
+            ssmanager = self.add_node('mock-node', server, [8381]).ssmanager
+            self.assertTrue(ssmanager.is_port_created(8381))
+            server.ports.clear()
+            # a fetch by other process replaces the list and the stamp
+            models.cache.set(ssmanager.get_cache_key('list'), [])
+            models.cache.set(ssmanager.get_cache_key('list') + '-stamp', 'other-process')
+            self.assertFalse(ssmanager.is_port_created(8381))
+
+    def test_port_index_cleared_with_cache(self):
+        with MockManagerServer() as server:
+            ssmanager = self.add_node('mock-node', server, [8381]).ssmanager
+            self.assertTrue(ssmanager.is_port_created(8381))
+            server.ports.clear()
+            ssmanager.clear_cache()
+            self.assertFalse(ssmanager.is_port_created(8381))
+
+    def test_node_clear_cache(self):
+        with MockManagerServer() as server:
+            node = self.add_node('mock-node', server, [8381, 8382])
+            ssmanager = node.ssmanager
+            ssmanager.ping_ex()
+            ssmanager.list_ex()
+            models.NodeAccount.scan_accessible(node.accounts_ref.select_related('node', 'account'))
+            keys = [ssmanager.get_cache_key('ping'), ssmanager.get_cache_key('list')] + \
+                [na.cache_key for na in node.accounts_ref.all()]
+            self.assertEqual(len(models.cache.get_many(keys)), 4)
+
+            # a single write to cache without any query
+            with self.assertNumQueries(0), patch.object(models.cache, 'delete_many') as delete_many, \
+                    patch.object(models.cache, 'set_many', wraps=models.cache.set_many) as set_many:
+                models.NodeAccount.clear_caches(node=node)
+            delete_many.assert_not_called()
+            set_many.assert_called_once()
+
+            # the old entries are left to expire, the new keys miss them
+            new_keys = [ssmanager.get_cache_key('ping'), ssmanager.get_cache_key('list')] + \
+                [na.cache_key for na in node.accounts_ref.all()]
+            self.assertFalse(set(new_keys) & set(keys))
+            self.assertEqual(models.cache.get_many(new_keys), {})
+            self.assertTrue(ssmanager.is_port_created(8381))
+
+    def test_node_cache_versions(self):
+        with MockManagerServer() as server1, MockManagerServer() as server2:
+            node1 = self.add_node('mock-node-1', server1, [8381])
+            node2 = self.add_node('mock-node-2', server2, [8381])
+            versions = models.Node.get_cache_versions([node1.pk, node2.pk])
+            self.assertEqual(versions, {node1.pk: node1.get_cache_version(), node2.pk: node2.get_cache_version()})
+
+            node1.clear_cache()
+            self.assertNotEqual(node1.get_cache_version(), versions[node1.pk])
+            self.assertEqual(node2.get_cache_version(), versions[node2.pk])
+
+    def test_port_index_unavailable(self):
+        with MockManagerServer(silent=True) as server:
+            ssmanager = self.add_node('mock-node', server, []).ssmanager
+            self.assertIsNone(ssmanager.port_index())
+            self.assertIsNone(ssmanager.is_port_created(8381))
+
+
+
+class SSManagerMetricsTestCase(MockNodeTestCase):
+
+    def setUp(self):
+        super(SSManagerMetricsTestCase, self).setUp()
+        models.metrics.clear()
+
+    def test_call_metrics(self):
+        with MockManagerServer() as server:
+            ssmanager = self.add_node('mock-node', server, [8381]).ssmanager
+            ssmanager.clear_cache()
+            models.metrics.clear()
+            ssmanager.ping_ex()
+            ssmanager.ping_ex()
+            ssmanager.list_ex(from_cache=False)
+            text = models.metrics.render()
+            self.assertIn('ssm_manager_call_seconds_count{command="ping",node="mock-node"} 1\n', text)
+            self.assertIn('ssm_manager_call_seconds_count{command="list",node="mock-node"} 1\n', text)
+            self.assertIn('ssm_cache_requests_total{method="ping_ex",result="miss"} 1\n', text)
+            self.assertIn('ssm_cache_requests_total{method="ping_ex",result="hit"} 1\n', text)
+            self.assertIn('ssm_cache_requests_total{method="list_ex",result="bypass"} 1\n', text)
+            self.assertNotIn('ssm_manager_call_failures_total', text)
+
+    def test_call_timeout_metrics(self):
+        with MockManagerServer(silent=True) as server:
+            ssmanager = self.add_node('mock-node', server, []).ssmanager
+            models.metrics.clear()
+            ssmanager.ping()
+            self.assertIn('ssm_manager_call_failures_total{command="ping",node="mock-node",reason="timeout"} 1\n',
+                models.metrics.render())
+
+
+
+class NodeDnsQueryTestCase(AppTestCase):
+
+    def test_match_dns_query_many(self):
+        domain = Domain.objects.create(name='mock-example.net')
+        record = Record.objects.create(host='vpn', domain=domain, type='A', answer='10.0.0.1,10.0.0.2')
+        nodes = [
+            models.Node.objects.create(name='mock-node-1', public_ip='10.0.0.1', record=record),
+            models.Node.objects.create(name='mock-node-2', public_ip='10.0.0.3', record=record),
+            models.Node.objects.create(name='mock-node-3', public_ip='10.0.0.4'),
+        ]
+        models.cache.delete(models.DnsQuery.get_cache_key(record.fqdn, record.type))
+        with patch.object(models.DnsQuery, 'query', return_value=({'10.0.0.1', '10.0.0.2'}, 60)) as query:
+            results = models.Node.match_dns_query_many(models.Node.objects.filter(
+                pk__in=[node.pk for node in nodes]).select_related('record'))
+            # one query for the shared record
+            query.assert_called_once_with(record.fqdn, record.type)
+            self.assertTrue(nodes[0].is_matching_dns_query)
+            query.assert_called_once()
+        self.assertEqual(results, {
+            nodes[0].pk: {'is_matching_dns_query': True},
+            nodes[1].pk: {'is_matching_dns_query': False},
+            nodes[2].pk: {'is_matching_dns_query': None},
+        })
+
+
+class StatisticMethodTestCase(AppTestCase):
+
+    def setUp(self):
+        from statistic.models import Statistic, Period
+        total = Period.objects.create(year=None, month=None)
+        yearly = Period.objects.create(year=2024, month=None)
+        self.accounts = [models.Account.objects.create(username=str(8381 + i), password='mock-password') for i in range(5)]
+        for (i, account) in enumerate(self.accounts[:4]):
+            for period in (total, yearly):
+                Statistic.objects.create(period=period, content_object=account,
+                    transferred_past=i * 10 + period.pk, transferred_live=i)
+
+    def test_with_totals(self):
+        names = ['transferred_past', 'transferred_live', 'transferred_totally', 'dt_collected']
+        expected = [[getattr(account, name) for name in names] for account in self.accounts]
+        self.assertIsNone(expected[-1][0])
+
+        with self.assertNumQueries(1):
+            accounts = list(models.Account.objects.with_totals().order_by('pk'))
+            self.assertEqual([[getattr(account, name) for name in names] for account in accounts], expected)
+
+    def test_with_totals_without_period(self):
+        from statistic.models import Statistic, Period
+        Statistic.objects.all().delete()
+        Period.objects.all().delete()
+        account = models.Account.objects.with_totals().get(pk=self.accounts[0].pk)
+        self.assertIsNone(account.transferred_totally)
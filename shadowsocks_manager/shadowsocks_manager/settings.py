@@ -158,6 +158,7 @@ INSTALLED_APPS = [
     'dynamicmethod',
     'retry',
     'singleton',
+    'metrics',
     'shadowsocks',
     'statistic',
     'notification',
@@ -174,6 +175,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'shadowsocks.middleware.PortSyncMiddleware',
 ]
 
 # prefix package name to allow being called outside of django environment
@@ -331,6 +333,38 @@ if CACHES_BACKEND.startswith('memcached.'):
     CACHES['default']['LOCATION'] = '{}:{}'.format(MEMCACHED_HOST, MEMCACHED_PORT)
 
 
+# Email
+
+# the Email backend for the notifications, the default sends each Email with the local `sendmail` command.
+# set to django.core.mail.backends.smtp.EmailBackend to send the Emails in bulk over one SMTP connection.
+EMAIL_BACKEND = config('SSM_EMAIL_BACKEND', default='notification.backends.SendmailBackend')
+EMAIL_HOST = config('SSM_EMAIL_HOST', default='localhost')
+EMAIL_PORT = config('SSM_EMAIL_PORT', default=25, cast=int)
+EMAIL_HOST_USER = config('SSM_EMAIL_HOST_USER', default='')
+EMAIL_HOST_PASSWORD = config('SSM_EMAIL_HOST_PASSWORD', default='')
+EMAIL_USE_TLS = config('SSM_EMAIL_USE_TLS', default=False, cast=bool)
+
+
+# Shadowsocks
+
+# hand the reconcile of the port changes made in a request to the celery task, see shadowsocks.models.PortSync
+SHADOWSOCKS_PORT_SYNC_ASYNC = config('SSM_SHADOWSOCKS_PORT_SYNC_ASYNC', default=True, cast=bool)
+
+
+# Metrics
+
+# the client IPs allowed to scrape /metrics without logging in, the staff users are always allowed
+METRICS_ALLOWED_IPS = config('SSM_METRICS_ALLOWED_IPS', default='127.0.0.1,::1')
+METRICS_ALLOWED_IPS = [item.strip() for item in METRICS_ALLOWED_IPS.split(',') if item.strip()]
+
+
+# Statistic
+
+# the retention in days of the traffic samples, for the resolutions: raw, 5-minute, hourly and daily
+STATISTIC_SAMPLE_RETENTION = config('SSM_STATISTIC_SAMPLE_RETENTION', default='1,7,90,730')
+STATISTIC_SAMPLE_RETENTION = [float(item) for item in STATISTIC_SAMPLE_RETENTION.split(',') if item]
+
+
 # Celery
 
 RABBITMQ_HOST = config('SSM_RABBITMQ_HOST', default='localhost')
@@ -34,4 +34,5 @@ urlpatterns = [
     re_path(r'^', include('shadowsocks.urls')),
     re_path(r'^', include('statistic.urls')),
     re_path(r'^', include('domain.urls')),
+    re_path(r'^', include('metrics.urls')),
 ]
@@ -3,6 +3,9 @@
 # py2.7 and py3 compatibility imports
 from __future__ import unicode_literals
 
+import copy
+import time
+import uuid
 import logging
 from django.db import models
 from django.core.cache import cache
@@ -18,8 +21,22 @@ class CustomManager(models.Manager):
 
 
 class SingletonModel(models.Model):
+    """
+    The singleton object is cached in the Django cache, and memoized in each process for
+    memo_ttl seconds to save the cache round-trip on the hot paths.
+
+    A version key in the Django cache is changed on every save() and update(). An expired memo is
+    kept as long as the version is unchanged, otherwise it's reloaded. So the changes from other
+    processes show up within memo_ttl seconds, and the changes in this process show up at once.
+    """
     objects = CustomManager()
 
+    # seconds
+    memo_ttl = 5
+
+    # {<cache key>: (<version>, <expiry>, <object>)}
+    _memos = {}
+
     class Meta:
         abstract = True
 
@@ -34,22 +51,59 @@ class SingletonModel(models.Model):
         super(SingletonModel, self).save(*args, **kwargs)
 
         self.set_cache()
+        cls = self.__class__
+        cls.set_memo(cls.new_version(), copy.copy(self))
 
     @classmethod
     def clear_cache(cls):
         cache.delete(cls.get_cache_key())
+        cls.new_version()
+        cls._memos.pop(cls.get_cache_key(), None)
 
     @classmethod
     def get_cache_key(cls):
         return cls.__module__
 
+    @classmethod
+    def get_version_key(cls):
+        return '%s-version' % cls.get_cache_key()
+
+    @classmethod
+    def new_version(cls):
+        version = uuid.uuid4().hex
+        cache.set(cls.get_version_key(), version, timeout=None)
+        return version
+
+    @classmethod
+    def get_version(cls):
+        version = cache.get(cls.get_version_key())
+        if version is None:
+            # keep the version set by others if any
+            cache.add(cls.get_version_key(), uuid.uuid4().hex, timeout=None)
+            version = cache.get(cls.get_version_key())
+        return version
+
+    @classmethod
+    def set_memo(cls, version, obj):
+        cls._memos[cls.get_cache_key()] = (version, time.time() + cls.memo_ttl, obj)
+
     @classmethod
     def load(cls):
+        memo = cls._memos.get(cls.get_cache_key())
+        if memo and time.time() < memo[1]:
+            return copy.copy(memo[2])
+
+        version = cls.get_version()
+        if memo and memo[0] == version:
+            cls.set_memo(version, memo[2])
+            return copy.copy(memo[2])
+
         obj = cache.get(cls.get_cache_key())
         if obj is None:
             logger.debug("No cached Singleton object: %s, trying to fetch it beyond cache." % cls.__name__)
             obj, created = cls.objects.get_or_create(pk=1)
             if not created:
                 obj.set_cache()
-                
+
+        cls.set_memo(version, copy.copy(obj))
         return obj
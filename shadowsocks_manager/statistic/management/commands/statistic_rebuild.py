@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from statistic.models import Statistic
+
+class Command(BaseCommand):
+    help = 'Rebuild the consolidated statistic.models.Statistic from the NodeAccount Monthly statistic'
+
+    def handle(self, *args, **options):
+        Statistic.rebuild()
+        self.stdout.write(self.style.SUCCESS('Successfully rebuilt statistic.models.Statistic'))
@@ -5,13 +5,17 @@ from __future__ import unicode_literals
 from builtins import str
 
 import logging
-from django.db import models
+import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
+from django.conf import settings
+from django.db import models, transaction, connection
+from django.db.models import Sum, Max
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.utils import timezone
 from django_lock import lock
 
-from shadowsocks.models import Node, Account, NodeAccount
+from shadowsocks.models import Config, Node, Account, NodeAccount, SSManager
 
 
 logger = logging.getLogger(__name__)
@@ -178,26 +182,35 @@ class Statistic(models.Model):
             else:
                 kwargs['%s__%s' % (lower_cls_name, self.content_type.model)] = self.content_object
 
-        if depend[1] == 'Monthly':
-            kwargs['period__year'] = self.period.year
-            if self.period.term == depend[1]:
-                kwargs['period__month'] = self.period.month
+        kwargs.update(Statistic.depend_period_filter(self.period, depend[1]))
+
+        if kwargs:
+            return kwargs
+        else:
+            raise Exception('%s: failed to get consolidate filter: %s' % (self, depend))
+
+    @staticmethod
+    def depend_period_filter(period, depend_term):
+        """
+        Return the filter kwargs on the periods of the statistic that the statistic of the period depends on.
+        """
+        kwargs = {}
+        if depend_term == 'Monthly':
+            kwargs['period__year'] = period.year
+            if period.term == depend_term:
+                kwargs['period__month'] = period.month
             else:
                 kwargs['period__month__isnull'] = False
-        elif depend[1] == 'Yearly':
-            if self.period.term == depend[1]:
-                kwargs['period__year'] = self.period.year
+        elif depend_term == 'Yearly':
+            if period.term == depend_term:
+                kwargs['period__year'] = period.year
             else:
                 kwargs['period__year__isnull'] = False
             kwargs['period__month__isnull'] = True
-        elif depend[1] == 'Total':
+        elif depend_term == 'Total':
             kwargs['period__year__isnull'] = True
             kwargs['period__month__isnull'] = True
-
-        if kwargs:
-            return kwargs
-        else:
-            raise Exception('%s: failed to get consolidate filter: %s' % (self, depend))
+        return kwargs
 
     def consolidate(self):
         transferred_past = 0
@@ -216,56 +229,284 @@ class Statistic(models.Model):
         self.transferred_live = transferred_live
         self.save()
 
+    @classmethod
+    def consolidate_period(cls, step_cls, period, ids=None):
+        """
+        Consolidate the statistic of the objects for the period in bulk, the same as consolidate() on each:
+        * sum up the depended statistic by object with a single GROUP BY query.
+        * fetch the existing statistic with a single query.
+        * write back with bulk_create() and bulk_update().
+        The step_cls is one of the Statistic.valid_cls, the ids are the primary keys of the objects.
+        Pass None as the step_cls for the global statistic.
+        """
+        (depend_cls, depend_term) = cls.depends[period.term][step_cls.__name__ if step_cls else 'None']
+        lower_cls_name = depend_cls.__name__.lower()
+
+        kwargs = {'content_type__model': lower_cls_name}
+        kwargs.update(cls.depend_period_filter(period, depend_term))
+        stats = cls.objects.filter(**kwargs)
+        aggregates = {'past': Sum('transferred_past'), 'live': Sum('transferred_live'), 'dt': Max('dt_collected')}
+
+        if step_cls:
+            if depend_cls == step_cls:
+                group = 'object_id'
+            else:
+                group = '%s__%s' % (lower_cls_name, step_cls.__name__.lower())
+            sums = {row[group]: row for row in stats.values(group).annotate(**aggregates).order_by()}
+            content_type = ContentType.objects.get_for_model(step_cls)
+            existing = cls.objects.filter(period=period, content_type=content_type)
+        else:
+            sums = {None: stats.aggregate(**aggregates)}
+            content_type = None
+            existing = cls.objects.filter(period=period, content_type=None, object_id=None)
+            ids = [None]
+        existing = {stat.object_id: stat for stat in existing}
+
+        ts = timezone.now()
+        created, updated = [], []
+        for pk in ids:
+            stat = existing.get(pk)
+            if stat is None:
+                stat = cls(period=period, content_type=content_type, object_id=pk)
+                created.append(stat)
+            else:
+                updated.append(stat)
+
+            row = sums.get(pk) or {}
+            stat.transferred_past = row.get('past') or 0
+            stat.transferred_live = row.get('live') or 0
+            if stat.dt_collected is None or (row.get('dt') and row['dt'] > stat.dt_collected):
+                stat.dt_collected = row.get('dt')
+            # bulk_update() skips the auto_now
+            stat.dt_updated = ts
+
+        with transaction.atomic():
+            cls.objects.bulk_create(created)
+            cls.objects.bulk_update(updated, ['transferred_past', 'transferred_live', 'dt_collected', 'dt_updated'])
+
+    # the workers to ping the Manager API concurrently
+    max_workers = 16
+
     @classmethod
     @lock('statistic.collect', blocking=False)
-    def collect(cls):
-        # Collect the base statistic data depended by all other statistic
-        for node in Node.objects.filter(is_active=True):
-            ts = timezone.now()
-            ss_stat = node.ssmanager.ping_ex() if node.ssmanager else None
-            if ss_stat:
-                # NodeAccount Monthly
-                for na in node.accounts_ref.filter(is_active=True):
-                    (period, created) = Period.objects.get_or_create(
-                        year=ts.year,
-                        month=ts.month)
-
-                    (stat, created) = Statistic.objects.get_or_create(
-                        period=period,
-                        content_type=ContentType.objects.get_for_model(na),
-                        object_id=na.pk)
-
-                    transferred_live = ss_stat.get(stat.content_object.account.username, 0)
-                    if transferred_live < stat.transferred_live:
-                        # changing active/inactive status or restarting server clears the statistic
-                        stat.transferred_past += stat.transferred_live
-                    else:
-                        pass
-
-                    stat.transferred_live = transferred_live
-                    stat.dt_collected = ts
-                    stat.save()
+    def collect(cls, max_workers=None, timeout=None):
+        """
+        Collect the base statistic data depended by all other statistic, and roll the traffic
+        deltas up to the consolidated statistic incrementally, see roll_up().
+        The Manager API of all the active nodes are pinged concurrently, see ping(), then the
+        statistic of all the nodes are written in one batch, see collect_nodes().
+        """
+        ss_stats = cls.ping(max_workers=max_workers, timeout=timeout)
+        if not ss_stats:
+            # do nothing if no stat data returned
+            return
+
+        ts = timezone.now()
+        periods = (
+            Period.objects.get_or_create(year=ts.year, month=ts.month)[0],
+            Period.objects.get_or_create(year=ts.year, month=None)[0],
+            Period.objects.get_or_create(year=None, month=None)[0],
+        )
+        cls.collect_nodes(ss_stats, periods, ts)
+
+    @classmethod
+    def ping(cls, max_workers=None, timeout=None):
+        """
+        Ping the Manager API of all the active nodes concurrently, return the stat data by node:
+            {<node>: {<port>: <transferred>, ...}, ...}
+
+        All the database reads are done upfront in the calling thread, the workers only talk
+        to the Manager API and the cache. The nodes not responding within the timeout in seconds,
+        defaults to twice the Config.timeout_remote, are left behind, so a down node no longer
+        delays the others.
+        """
+        ssmanagers = {}
+        for ssmanager in SSManager.objects.filter(node__is_active=True).select_related('node').order_by('pk'):
+            ssmanagers.setdefault(ssmanager.node_id, ssmanager)
+        if not ssmanagers:
+            return {}
+
+        # warm up the cached config in the calling thread for the workers
+        config = Config.load()
+        timeout = timeout or config.timeout_remote * 2
+        max_workers = min(max_workers or cls.max_workers, len(ssmanagers))
+
+        ss_stats = {}
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='statistic')
+        try:
+            futures = {executor.submit(cls.ping_ssmanager, ssmanager): ssmanager for ssmanager in ssmanagers.values()}
+            done, not_done = wait(futures, timeout=timeout)
+            for (future, ssmanager) in futures.items():
+                if future in done:
+                    ss_stat = future.result()
+                    if ss_stat:
+                        ss_stats[ssmanager.node] = ss_stat
+                else:
+                    logger.error('%s: collect: ssmanager %s left behind after the deadline.' % (ssmanager.node, ssmanager))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        return ss_stats
+
+    @staticmethod
+    def ping_ssmanager(ssmanager):
+        """
+        Return the fresh stat data of the ssmanager, the cache is refreshed as well.
+        Run in a worker thread.
+        """
+        try:
+            return ssmanager.ping_ex(from_cache=False)
+        except Exception as e:
+            logger.error('%s: collect: unexpected error: %s' % (ssmanager.node, e))
+        finally:
+            # the thread may have opened a database connection by accident
+            connection.close()
+
+    @classmethod
+    def collect_nodes(cls, ss_stats, periods, ts):
+        """
+        Save the NodeAccount Monthly statistic of the nodes from the Manager API stat data by node.
+        The existing statistic of the nodes are fetched in one query, and written back in bulk,
+        together with the roll-up of the deltas and the raw samples in the same transaction.
+        The periods is a tuple of the Monthly, Yearly and Total Period.
+        """
+        content_type = ContentType.objects.get_for_model(NodeAccount)
+        ss_stats = {node.pk: ss_stat for (node, ss_stat) in ss_stats.items()}
+        nas = list(NodeAccount.objects.filter(node__in=list(ss_stats), is_active=True).select_related('account'))
+        stats = {
+            stat.object_id: stat
+            for stat in cls.objects.filter(
+                period=periods[0],
+                content_type=content_type,
+                object_id__in=[na.pk for na in nas])
+        }
+
+        created, updated, deltas = [], [], []
+        for na in nas:
+            stat = stats.get(na.pk)
+            if stat is None:
+                stat = cls(period=periods[0], content_type=content_type, object_id=na.pk)
+                created.append(stat)
+            else:
+                updated.append(stat)
+
+            (transferred_past, transferred_live) = (stat.transferred_past, stat.transferred_live)
+            stat.transferred_live = ss_stats[na.node_id].get(na.account.username, 0)
+            if stat.transferred_live < transferred_live:
+                # changing active/inactive status or restarting server clears the statistic
+                stat.transferred_past += transferred_live
             else:
-                # do nothing if no stat data returned
                 pass
 
+            if (stat.transferred_past, stat.transferred_live) != (transferred_past, transferred_live):
+                deltas.append((na, stat.transferred_past - transferred_past, stat.transferred_live - transferred_live))
+
+            stat.dt_collected = ts
+            # bulk_update() skips the auto_now
+            stat.dt_updated = ts
+
+        with transaction.atomic():
+            cls.objects.bulk_create(created)
+            cls.objects.bulk_update(updated, ['transferred_past', 'transferred_live', 'dt_collected', 'dt_updated'])
+            cls.roll_up(list(ss_stats), deltas, periods, ts)
+            Sample.objects.bulk_create([
+                Sample(nodeaccount=na, resolution=Sample.RAW, dt=ts, transferred=past + live)
+                for (na, past, live) in deltas if past + live > 0
+            ])
+
+    @classmethod
+    def roll_up(cls, node_ids, deltas, periods, ts):
+        """
+        Add the deltas of the NodeAccount Monthly statistic of the nodes to the statistic depending on them:
+        * NodeAccount Yearly and Total.
+        * Node, Account and global Monthly, Yearly and Total.
+        The deltas is a list of (nodeaccount, delta of transferred_past, delta of transferred_live),
+        and the periods is a tuple of the Monthly, Yearly and Total Period.
+
+        The cost is proportional to the number of changed ports. The Node and global statistic are
+        always touched to keep their dt_collected up to date, the others only if their deltas are
+        nonzero.
+
+        The result equals to the full consolidation as long as the statistic were consistent
+        before, run rebuild() to repair them otherwise.
+        """
+        (monthly, yearly, total) = periods
+        (ct_na, ct_node, ct_account) = [ContentType.objects.get_for_model(c) for c in (NodeAccount, Node, Account)]
+
+        sums = {}
+        def add(period, content_type, object_id, past, live):
+            key = (period.pk, content_type.pk if content_type else None, object_id)
+            (p, l) = sums.get(key, (0, 0))
+            sums[key] = (p + past, l + live)
+
+        for period in periods:
+            for node_id in node_ids:
+                add(period, ct_node, node_id, 0, 0)
+            add(period, None, None, 0, 0)
+        for (na, past, live) in deltas:
+            for period in periods:
+                if period is not monthly:
+                    add(period, ct_na, na.pk, past, live)
+                add(period, ct_node, na.node_id, past, live)
+                add(period, ct_account, na.account_id, past, live)
+                add(period, None, None, past, live)
+
+        existing = cls.objects.filter(period__in=periods).filter(
+            models.Q(content_type=None, object_id=None) |
+            models.Q(content_type=ct_node, object_id__in=node_ids) |
+            models.Q(content_type=ct_account, object_id__in=[na.account_id for (na, _, _) in deltas]) |
+            models.Q(content_type=ct_na, object_id__in=[na.pk for (na, _, _) in deltas], period__in=periods[1:]))
+        existing = {(stat.period_id, stat.content_type_id, stat.object_id): stat for stat in existing}
+
+        created, updated = [], []
+        for (key, (past, live)) in sums.items():
+            stat = existing.get(key)
+            if stat is None:
+                stat = cls(period_id=key[0], content_type_id=key[1], object_id=key[2])
+                created.append(stat)
+            else:
+                updated.append(stat)
+            stat.transferred_past += past
+            stat.transferred_live += live
+            stat.dt_collected = ts
+            # bulk_update() skips the auto_now
+            stat.dt_updated = ts
+
+        cls.objects.bulk_create(created)
+        cls.objects.bulk_update(updated, ['transferred_past', 'transferred_live', 'dt_collected', 'dt_updated'])
+
     @classmethod
     @lock('statistic.statistic', blocking=False)
-    def statistic(cls):
+    def statistic(cls, rebuild=False):
+        """
+        Collect the statistic, the consolidated statistic are rolled up incrementally by collect().
+        Rebuild them from scratch if rebuild is True, or if there's no global Total statistic yet.
+        """
+        # check before the roll-up creates any
+        rebuild = rebuild or not cls.objects.filter(period__year=None, period__month=None, content_type=None).exists()
+
         cls.collect()
+        Sample.compact()
+
+        if rebuild:
+            cls.rebuild()
 
+    @classmethod
+    @lock('statistic.collect', blocking=300) # wait for 5 minutes
+    def rebuild(cls):
+        """
+        Rebuild the consolidated statistic of the current periods from the NodeAccount Monthly statistic.
+        This repairs the statistic drifted away from the incremental roll-up, e.g. after a NodeAccount
+        is deleted along with its statistic.
+        """
         ts = timezone.now()
         for step in Statistic.steps:
-            kwargs = {}
             step_cls = step.get('cls')
 
             if step_cls:
-                kwargs['content_type'] = ContentType.objects.get_for_model(step_cls)
-                objs = step_cls.objects.filter(**step.get('filter'))
+                ids = list(step_cls.objects.filter(**step.get('filter')).values_list('pk', flat=True))
             else:
-                kwargs['content_type'] = None
-                kwargs['object_id'] = None
-                objs = []
+                ids = None
 
             for period in step.get('periods'):
                 period_kwargs = {}
@@ -282,16 +523,8 @@ class Statistic(models.Model):
                 else:
                     raise Exception('%s: invalid period defined in step: %s\n%s' % (cls, period, step))
 
-                kwargs['period'] = Period.objects.get_or_create(**period_kwargs)[0]
-
-                if objs:
-                    for obj in objs:
-                        kwargs['object_id'] = obj.pk
-                        (stat, created) = Statistic.objects.get_or_create(**kwargs)
-                        stat.consolidate()
-                else:
-                    (stat, created) = Statistic.objects.get_or_create(**kwargs)
-                    stat.consolidate()
+                period = Period.objects.get_or_create(**period_kwargs)[0]
+                cls.consolidate_period(step_cls, period, ids)
 
     @classmethod
     @lock('statistic.collect', blocking=300) # wait for 5 minutes
@@ -306,3 +539,106 @@ class Statistic(models.Model):
         # to wait for the port updating take effect.
         for na in nas:
             na.on_update()
+
+
+class Sample(models.Model):
+    """
+    The bytes transferred by a NodeAccount in a time bucket, appended by Statistic.collect().
+    The raw samples are downsampled into the 5-minute, hourly and daily resolutions, every
+    resolution is kept within its retention in days set by settings.STATISTIC_SAMPLE_RETENTION.
+    The buckets are aligned to UTC.
+    """
+    RAW = 0
+    MINUTELY_5 = 300
+    HOURLY = 3600
+    DAILY = 86400
+    resolutions = [RAW, MINUTELY_5, HOURLY, DAILY]
+
+    nodeaccount = models.ForeignKey(NodeAccount, on_delete=models.CASCADE, related_name='samples')
+    resolution = models.PositiveIntegerField('Resolution in Seconds', default=RAW)
+    dt = models.DateTimeField('Time')
+    transferred = models.PositiveBigIntegerField('Transferred', default=0)
+
+    class Meta:
+        verbose_name = 'Sample'
+        unique_together = ('nodeaccount', 'resolution', 'dt')
+        indexes = [
+            models.Index(fields=['resolution', 'dt']),
+        ]
+
+    def __str__(self):
+        return '%s %s %s' % (self.nodeaccount, self.transferred, self.dt)
+
+    @staticmethod
+    def floor(dt, resolution):
+        """
+        Return the start of the bucket of the resolution that the datetime falls in.
+        """
+        seconds = int(dt.timestamp())
+        return datetime.datetime.fromtimestamp(seconds - seconds % resolution, tz=datetime.timezone.utc)
+
+    @classmethod
+    def retention(cls, resolution):
+        return datetime.timedelta(days=settings.STATISTIC_SAMPLE_RETENTION[cls.resolutions.index(resolution)])
+
+    @classmethod
+    def downsample(cls, now=None):
+        """
+        Sum up the samples of each resolution into the buckets of the next coarser resolution.
+        Only the completed buckets after the latest existing one are created, so the samples
+        are read once.
+        """
+        now = now or timezone.now()
+        for (source, target) in zip(cls.resolutions, cls.resolutions[1:]):
+            samples = cls.objects.filter(resolution=source, dt__lt=cls.floor(now, target))
+            latest = cls.objects.filter(resolution=target).aggregate(dt=Max('dt'))['dt']
+            if latest:
+                samples = samples.filter(dt__gte=latest + datetime.timedelta(seconds=target))
+
+            buckets = {}
+            for (nodeaccount_id, dt, transferred) in samples.values_list('nodeaccount_id', 'dt', 'transferred').iterator():
+                key = (nodeaccount_id, cls.floor(dt, target))
+                buckets[key] = buckets.get(key, 0) + transferred
+
+            cls.objects.bulk_create([
+                cls(nodeaccount_id=nodeaccount_id, resolution=target, dt=dt, transferred=transferred)
+                for ((nodeaccount_id, dt), transferred) in buckets.items()
+            ], batch_size=1000)
+
+    @classmethod
+    def purge(cls, now=None):
+        """
+        Delete the samples out of the retention of their resolutions.
+        """
+        now = now or timezone.now()
+        for resolution in cls.resolutions:
+            cls.objects.filter(resolution=resolution, dt__lt=now - cls.retention(resolution)).delete()
+
+    @classmethod
+    def compact(cls, now=None):
+        cls.downsample(now)
+        cls.purge(now)
+
+    @classmethod
+    def rates(cls, start, end, resolution=None, **kwargs):
+        """
+        Return the traffic in the buckets of the resolution within [start, end), as a list of dict:
+        * dt: the start of the bucket.
+        * transferred: the bytes transferred in the bucket.
+        * rate: the average bytes per second in the bucket.
+        The resolution defaults to the finest one with the retention covering the start.
+        The kwargs are the filters on the samples, such as nodeaccount, nodeaccount__node and
+        nodeaccount__account.
+        """
+        if resolution is None:
+            now = timezone.now()
+            covered = [res for res in cls.resolutions[1:] if start >= now - cls.retention(res)]
+            resolution = covered[0] if covered else cls.resolutions[-1]
+        elif resolution not in cls.resolutions[1:]:
+            raise Exception('%s: invalid resolution: %s, valid resolutions are: %s' % (cls, resolution, cls.resolutions[1:]))
+
+        samples = cls.objects.filter(resolution=resolution, dt__gte=cls.floor(start, resolution), dt__lt=end, **kwargs)
+        return [
+            {'dt': row['dt'], 'transferred': row['transferred'], 'rate': row['transferred'] / resolution}
+            for row in samples.values('dt').annotate(transferred=Sum('transferred')).order_by('dt')
+        ]
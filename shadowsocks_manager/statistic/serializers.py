@@ -17,3 +17,9 @@ class StatisticSerializer(serializers.ModelSerializer):
         model = models.Statistic
         fields = ('id', 'period', 'content_type', 'object_id', 'transferred_past',
             'transferred_live', 'dt_collected', 'dt_created', 'dt_updated')
+
+
+class SampleSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.Sample
+        fields = ('id', 'nodeaccount', 'resolution', 'dt', 'transferred')
@@ -15,3 +15,7 @@ def statistic():
 @shared_task
 def reset():
     return Statistic.reset()
+
+@shared_task
+def rebuild():
+    return Statistic.rebuild()
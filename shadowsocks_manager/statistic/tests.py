@@ -5,10 +5,18 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 
 import json
+import time
+import datetime
 from abc import abstractmethod
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from rest_framework.test import APIClient
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from unittest.mock import patch
 
 from shadowsocks.tests import AppTestCase as shadowsocksAppTestCase
+from shadowsocks.models import Node, Account, NodeAccount, SSManager, InterfaceList
 from statistic import models, serializers
 
 
@@ -135,3 +143,323 @@ class StatisticTestCase(AppTestCase):
         period = models.Period(year=None, month=None)
         stat = models.Statistic(period=period, transferred_past=100, transferred_live=50)
         self.assertEqual(stat.transferred, 150)
+
+
+class StatisticCollectTestCase(AppTestCase):
+
+    def setUp(self):
+        self.node = Node.objects.create(name='mock-node', public_ip='127.0.0.1', private_ip='127.0.0.1')
+        SSManager.objects.create(node=self.node, interface=InterfaceList.LOCALHOST)
+        self.ss_stat = {}
+
+    def add_accounts(self, ports):
+        for port in ports:
+            account = Account.objects.create(username=str(port), password='mock-password')
+            # skip the signals to keep away from the Manager API
+            NodeAccount.objects.bulk_create([NodeAccount(node=self.node, account=account)])
+            self.ss_stat[str(port)] = 100
+
+    def collect(self):
+        with patch.object(SSManager, 'ping_ex', return_value=self.ss_stat):
+            with CaptureQueriesContext(connection) as queries:
+                models.Statistic.collect()
+        return len(queries)
+
+    def get_stat(self, port):
+        na = NodeAccount.objects.get(node=self.node, account__username=str(port))
+        return models.Statistic.objects.get(content_type__model='nodeaccount', object_id=na.pk, period__month__isnull=False)
+
+    def test_collect(self):
+        self.add_accounts([8381, 8382])
+        self.collect()
+        self.assertEqual(self.get_stat(8381).transferred_live, 100)
+
+        # the counter grows
+        self.ss_stat['8381'] = 300
+        self.collect()
+        stat = self.get_stat(8381)
+        self.assertEqual((stat.transferred_past, stat.transferred_live), (0, 300))
+
+        # the counter is reset on the server
+        self.ss_stat['8381'] = 50
+        self.collect()
+        stat = self.get_stat(8381)
+        self.assertEqual((stat.transferred_past, stat.transferred_live), (300, 50))
+        self.assertEqual(self.get_stat(8382).transferred, 100)
+
+    def test_collect_queries_flat(self):
+        self.add_accounts([8381, 8382])
+        self.collect()
+        few = self.collect()
+        self.add_accounts(range(8383, 8393))
+        self.collect()
+        many = self.collect()
+        self.assertEqual(few, many)
+
+    def get_stats(self):
+        return {
+            (stat.period_id, stat.content_type_id, stat.object_id): (stat.transferred_past, stat.transferred_live)
+            for stat in models.Statistic.objects.all()
+        }
+
+    def test_collect_roll_up_matches_rebuild(self):
+        self.add_accounts([8381, 8382, 8383])
+        models.Statistic.rebuild()
+        self.collect()
+        for (port, transferred) in [('8381', 300), ('8382', 20), ('8383', 100)]:
+            self.ss_stat[port] = transferred
+        self.collect()
+        self.add_accounts([8384])
+        self.ss_stat['8381'] = 10
+        self.collect()
+
+        stats = self.get_stats()
+        models.Statistic.rebuild()
+        self.assertEqual(stats, self.get_stats())
+
+        total = models.Statistic.objects.get(period__year=None, period__month=None, content_type=None)
+        self.assertEqual(total.transferred, (300 + 10) + (100 + 20) + 100 + 100)
+
+    def test_collect_roll_up_changed_ports_only(self):
+        self.add_accounts([8381, 8382])
+        models.Statistic.rebuild()
+        self.collect()
+        self.ss_stat['8381'] = 200
+        self.collect()
+
+        account = Account.objects.get(username='8382')
+        stat = models.Statistic.objects.get(content_type__model='account', object_id=account.pk,
+            period__year=None, period__month=None)
+        self.assertEqual(stat.transferred, 100)
+        # the statistic of the unchanged port are left untouched
+        with patch.object(models.Statistic.objects, 'bulk_update', wraps=models.Statistic.objects.bulk_update) as bulk_update:
+            self.collect()
+        stats = [stat for call in bulk_update.call_args_list for stat in call.args[0]]
+        self.assertFalse([stat for stat in stats if stat.content_type and stat.content_type.model == 'account'])
+
+    def test_collect_samples(self):
+        self.add_accounts([8381, 8382])
+        self.collect()
+        self.ss_stat['8381'] = 250
+        self.collect()
+        self.collect()
+
+        samples = models.Sample.objects.filter(resolution=models.Sample.RAW, nodeaccount__account__username='8381')
+        self.assertEqual(sorted(samples.values_list('transferred', flat=True)), [100, 150])
+        self.assertEqual(models.Sample.objects.count(), 3)
+
+    def test_collect_nodes_concurrently(self):
+        self.add_accounts([8381])
+        slow = Node.objects.create(name='mock-node-slow', public_ip='127.0.0.2', private_ip='127.0.0.2')
+        SSManager.objects.create(node=slow, interface=InterfaceList.LOCALHOST)
+        account = Account.objects.create(username='8382', password='mock-password')
+        NodeAccount.objects.bulk_create([NodeAccount(node=slow, account=account)])
+
+        def ping_ex(ssmanager, from_cache=True):
+            if ssmanager.node_id == slow.pk:
+                time.sleep(1)
+            return {'8381': 100, '8382': 100}
+
+        start = time.time()
+        with patch.object(SSManager, 'ping_ex', autospec=True, side_effect=ping_ex):
+            models.Statistic.collect(timeout=0.2)
+        self.assertLess(time.time() - start, 1)
+
+        # the slow node is left behind
+        self.assertEqual(self.get_stat(8381).transferred_live, 100)
+        self.assertFalse(models.Statistic.objects.filter(content_type__model='node', object_id=slow.pk).exists())
+
+    def test_collect_queries_flat_by_nodes(self):
+        self.add_accounts([8381])
+        self.collect()
+        self.ss_stat['8381'] = 200
+        few = self.collect()
+        for i in range(3):
+            node = Node.objects.create(name='mock-node-%s' % i)
+            SSManager.objects.create(node=node, interface=InterfaceList.LOCALHOST)
+            account = Account.objects.create(username=str(8390 + i), password='mock-password')
+            NodeAccount.objects.bulk_create([NodeAccount(node=node, account=account)])
+            self.ss_stat[str(8390 + i)] = 100
+        self.collect()
+        self.ss_stat = {port: 300 for port in self.ss_stat}
+        many = self.collect()
+        self.assertEqual(few, many)
+
+    def test_statistic_rebuild_once(self):
+        self.add_accounts([8381])
+        with patch.object(SSManager, 'ping_ex', return_value=self.ss_stat):
+            with patch.object(models.Statistic, 'rebuild', wraps=models.Statistic.rebuild) as rebuild:
+                models.Statistic.statistic()
+                models.Statistic.statistic()
+                self.assertEqual(rebuild.call_count, 1)
+                models.Statistic.statistic(rebuild=True)
+                self.assertEqual(rebuild.call_count, 2)
+
+
+class StatisticConsolidateTestCase(AppTestCase):
+
+    def setUp(self):
+        now = models.timezone.now()
+        self.year, self.month = now.year, now.month
+        self.monthly = models.Period.objects.create(year=self.year, month=self.month)
+        self.last_year = models.Period.objects.create(year=self.year - 1, month=None)
+        self.ct = models.ContentType.objects.get_for_model(NodeAccount)
+
+        self.nodes = [Node.objects.create(name='mock-node-%s' % i) for i in range(2)]
+        self.accounts = [Account.objects.create(username=str(8381 + i), password='mock-password') for i in range(2)]
+        # skip the signals to keep away from the Manager API
+        self.nas = NodeAccount.objects.bulk_create([
+            NodeAccount(node=self.nodes[0], account=self.accounts[0]),
+            NodeAccount(node=self.nodes[0], account=self.accounts[1]),
+            NodeAccount(node=self.nodes[1], account=self.accounts[0]),
+        ])
+        for (na, past, live) in zip(self.nas, [10, 20, 1], [5, 0, 2]):
+            models.Statistic.objects.create(period=self.monthly, content_type=self.ct, object_id=na.pk,
+                transferred_past=past, transferred_live=live, dt_collected=now)
+        models.Statistic.objects.create(period=self.last_year, content_type=self.ct, object_id=self.nas[0].pk,
+            transferred_past=100)
+
+    def get_stat(self, obj, year, month):
+        kwargs = {'period__year': year, 'period__month': month}
+        if obj is None:
+            kwargs.update(content_type=None, object_id=None)
+        else:
+            kwargs.update(content_type=models.ContentType.objects.get_for_model(obj), object_id=obj.pk)
+        return models.Statistic.objects.get(**kwargs)
+
+    def test_statistic_consolidate(self):
+        models.Statistic.rebuild()
+
+        (y, m) = (self.year, self.month)
+        expected = [
+            (self.nas[0], y, None, 15), (self.nas[0], None, None, 115),
+            (self.nas[1], y, None, 20), (self.nas[2], None, None, 3),
+            (self.nodes[0], y, m, 35), (self.nodes[0], y, None, 35), (self.nodes[0], None, None, 35),
+            (self.nodes[1], y, m, 3), (self.nodes[1], None, None, 3),
+            (self.accounts[0], y, m, 18), (self.accounts[0], y, None, 18), (self.accounts[0], None, None, 18),
+            (self.accounts[1], None, None, 20),
+            (None, y, m, 38), (None, y, None, 38), (None, None, None, 38),
+        ]
+        for (obj, year, month, transferred) in expected:
+            self.assertEqual(self.get_stat(obj, year, month).transferred, transferred, (obj, year, month))
+
+        stat = self.get_stat(self.nas[0], y, None)
+        self.assertEqual((stat.transferred_past, stat.transferred_live), (10, 5))
+        self.assertIsNotNone(self.get_stat(self.nodes[0], y, m).dt_collected)
+
+    def test_statistic_consolidate_matches_consolidate(self):
+        models.Statistic.rebuild()
+
+        # compare all but the seeded statistic
+        seeded = models.Statistic.objects.filter(content_type=self.ct, period__in=[self.monthly, self.last_year])
+        for stat in models.Statistic.objects.exclude(pk__in=seeded):
+            expected = models.Statistic.objects.get(pk=stat.pk)
+            expected.consolidate()
+            self.assertEqual((stat.transferred_past, stat.transferred_live),
+                (expected.transferred_past, expected.transferred_live), stat)
+
+    def test_statistic_consolidate_queries_flat(self):
+        def statistic():
+            with CaptureQueriesContext(connection) as queries:
+                models.Statistic.rebuild()
+            return len(queries)
+
+        statistic()
+        few = statistic()
+        node = Node.objects.create(name='mock-node-more')
+        for port in range(8390, 8400):
+            account = Account.objects.create(username=str(port), password='mock-password')
+            na = NodeAccount.objects.bulk_create([NodeAccount(node=node, account=account)])[0]
+            models.Statistic.objects.create(period=self.monthly, content_type=self.ct, object_id=na.pk, transferred_live=1)
+        statistic()
+        many = statistic()
+        self.assertEqual(few, many)
+
+
+class SampleTestCase(AppTestCase):
+
+    def setUp(self):
+        self.node = Node.objects.create(name='mock-node')
+        self.accounts = [Account.objects.create(username=str(8381 + i), password='mock-password') for i in range(2)]
+        # skip the signals to keep away from the Manager API
+        self.nas = NodeAccount.objects.bulk_create([NodeAccount(node=self.node, account=account) for account in self.accounts])
+        self.t0 = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def add_samples(self, na, minutes, transferred=60):
+        models.Sample.objects.bulk_create([
+            models.Sample(nodeaccount=na, dt=self.t0 + datetime.timedelta(minutes=minute), transferred=transferred)
+            for minute in minutes
+        ])
+
+    def get_transferred(self, resolution, **kwargs):
+        samples = models.Sample.objects.filter(resolution=resolution, **kwargs).order_by('dt')
+        return [(dt - self.t0, transferred) for (dt, transferred) in samples.values_list('dt', 'transferred')]
+
+    def test_sample_floor(self):
+        dt = self.t0 + datetime.timedelta(hours=1, minutes=7, seconds=30)
+        self.assertEqual(models.Sample.floor(dt, models.Sample.MINUTELY_5), self.t0 + datetime.timedelta(hours=1, minutes=5))
+        self.assertEqual(models.Sample.floor(dt, models.Sample.DAILY), self.t0)
+
+    def test_sample_downsample(self):
+        self.add_samples(self.nas[0], range(0, 70))
+        self.add_samples(self.nas[1], [3])
+        now = self.t0 + datetime.timedelta(minutes=62)
+        models.Sample.downsample(now)
+
+        # only the completed buckets are created
+        minutely_5 = self.get_transferred(models.Sample.MINUTELY_5, nodeaccount=self.nas[0])
+        self.assertEqual(len(minutely_5), 12)
+        self.assertEqual(minutely_5[0], (datetime.timedelta(0), 300))
+        self.assertEqual(self.get_transferred(models.Sample.HOURLY, nodeaccount=self.nas[0]),
+            [(datetime.timedelta(0), 3600)])
+        self.assertEqual(self.get_transferred(models.Sample.MINUTELY_5, nodeaccount=self.nas[1]),
+            [(datetime.timedelta(0), 60)])
+        self.assertFalse(models.Sample.objects.filter(resolution=models.Sample.DAILY).exists())
+
+        # the downsampled buckets are not summed up again
+        models.Sample.downsample(now + datetime.timedelta(minutes=5))
+        minutely_5 = self.get_transferred(models.Sample.MINUTELY_5, nodeaccount=self.nas[0])
+        self.assertEqual(len(minutely_5), 13)
+        self.assertEqual(len(self.get_transferred(models.Sample.HOURLY)), 2)
+
+    @override_settings(STATISTIC_SAMPLE_RETENTION=[1, 2, 3, 4])
+    def test_sample_purge(self):
+        self.add_samples(self.nas[0], [0, 60 * 24 + 1])
+        models.Sample.compact(self.t0 + datetime.timedelta(days=2))
+
+        self.assertEqual(self.get_transferred(models.Sample.RAW), [(datetime.timedelta(days=1, minutes=1), 60)])
+        self.assertEqual(len(self.get_transferred(models.Sample.MINUTELY_5)), 2)
+        models.Sample.purge(self.t0 + datetime.timedelta(days=3, minutes=10))
+        self.assertEqual(len(self.get_transferred(models.Sample.MINUTELY_5)), 0)
+        self.assertEqual(self.get_transferred(models.Sample.HOURLY), [(datetime.timedelta(days=1), 60)])
+
+    def test_sample_rates(self):
+        self.add_samples(self.nas[0], range(0, 10))
+        self.add_samples(self.nas[1], range(0, 5), transferred=30)
+        models.Sample.downsample(self.t0 + datetime.timedelta(hours=1))
+
+        rates = models.Sample.rates(self.t0, self.t0 + datetime.timedelta(hours=1), models.Sample.MINUTELY_5)
+        self.assertEqual([rate['transferred'] for rate in rates], [450, 300])
+        self.assertEqual(rates[0]['rate'], 1.5)
+
+        rates = models.Sample.rates(self.t0, self.t0 + datetime.timedelta(hours=1), models.Sample.HOURLY,
+            nodeaccount__account=self.accounts[1])
+        self.assertEqual([rate['transferred'] for rate in rates], [150])
+
+        # the resolution defaults to the coarse one for the old window
+        rates = models.Sample.rates(self.t0, self.t0 + datetime.timedelta(hours=1))
+        self.assertEqual(rates, [])
+
+    def test_sample_rate_api(self):
+        self.add_samples(self.nas[0], range(0, 10))
+        models.Sample.downsample(self.t0 + datetime.timedelta(hours=1))
+
+        client = APIClient()
+        client.force_authenticate(User.objects.create(username='mock-admin'))
+        response = client.get('/statistic/sample/rate/', {'start': self.t0.isoformat(),
+            'end': (self.t0 + datetime.timedelta(hours=1)).isoformat(), 'resolution': 300, 'node': self.node.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([rate['transferred'] for rate in response.json()], [300, 300])
+
+        response = client.get('/statistic/sample/rate/', {'resolution': 60})
+        self.assertEqual(response.status_code, 400)
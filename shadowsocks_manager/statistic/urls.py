@@ -8,6 +8,8 @@ from . import views
 
 
 router = routers.DefaultRouter()
+# register ahead of 'statistic' to keep off its detail route
+router.register(r'statistic/sample', views.SampleViewSet)
 router.register(r'statistic', views.StatisticViewSet)
 router.register(r'statistic/period', views.PeriodViewSet)
 
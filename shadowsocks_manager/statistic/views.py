@@ -3,6 +3,13 @@
 # py2.7 and py3 compatibility imports
 from __future__ import unicode_literals
 
+import datetime
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
 from utils.viewsets import CompatModelViewSet
 
 from . import models, serializers
@@ -24,3 +31,50 @@ class StatisticViewSet(CompatModelViewSet):
     """
     queryset = models.Statistic.objects.all()
     serializer_class = serializers.StatisticSerializer
+
+
+class SampleViewSet(CompatModelViewSet):
+    """
+    This viewset automatically provides `list` and `detail` actions, and the `rate` action:
+    * start, end: the time window in ISO 8601, defaults to the last 24 hours.
+    * resolution: 300, 3600 or 86400 seconds, defaults to the finest one available for the window.
+    * nodeaccount, node, account: the optional object filters.
+    """
+    queryset = models.Sample.objects.all()
+    serializer_class = serializers.SampleSerializer
+    filter_fields = ['nodeaccount', 'resolution']
+
+    rate_filters = {
+        'nodeaccount': 'nodeaccount',
+        'node': 'nodeaccount__node',
+        'account': 'nodeaccount__account',
+    }
+
+    @staticmethod
+    def parse_datetime(value):
+        dt = parse_datetime(value)
+        return timezone.make_aware(dt) if dt and timezone.is_naive(dt) else dt
+
+    def get_param(self, name, parse):
+        value = self.request.query_params.get(name)
+        if value in (None, ''):
+            return None
+        try:
+            ret = parse(value)
+        except ValueError:
+            ret = None
+        if ret is None:
+            raise ValidationError({name: ['Invalid value: %s' % value]})
+        return ret
+
+    @action(detail=False)
+    def rate(self, request):
+        end = self.get_param('end', self.parse_datetime) or timezone.now()
+        start = self.get_param('start', self.parse_datetime) or end - datetime.timedelta(days=1)
+        resolution = self.get_param('resolution', int)
+        if resolution is not None and resolution not in models.Sample.resolutions[1:]:
+            raise ValidationError({'resolution': ['Valid values are: %s' % models.Sample.resolutions[1:]]})
+        kwargs = {lookup: self.get_param(name, int) for (name, lookup) in self.rate_filters.items()}
+        kwargs = {key: value for key, value in kwargs.items() if value is not None}
+
+        return Response(models.Sample.rates(start, end, resolution, **kwargs))
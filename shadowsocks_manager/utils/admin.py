@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+# py2.7 and py3 compatibility imports
+from __future__ import unicode_literals
+
+from django.http import JsonResponse, HttpResponseForbidden
+from django.utils.html import format_html
+from admin_lazy_load import LazyLoadAdminMixin
+
+
+def lazy_html(value):
+    """
+    Render the value of a lazy loaded field in the same way as LazyLoadAdminMixin.
+    """
+    if isinstance(value, bool):
+        return format_html('<img src="/static/admin/img/icon-{}.svg" alt="{}" />', *(('yes', 'Yes') if value else ('no', 'No')))
+    elif value is None:
+        return format_html('<img src="/static/admin/img/icon-unknown.svg" alt="Unknown" />')
+    return str(value)
+
+
+class BatchLazyLoadAdminMixin(LazyLoadAdminMixin):
+    """
+    Load the lazy loaded fields of all the objects on a page in one request, instead of one request
+    for each field of each object. The lazy_batch.js collects the fields on the page and requests:
+        <changelist url>easy/lazy_batch/?ids=<pk>,<pk>,...
+    The response is: {<pk>: {<field>: <html>, ...}, ...}
+
+    The values are resolved in bulk by lazy_batch(), the fields not resolved by it are resolved
+    for each object as LazyLoadAdminMixin does.
+    """
+    # the max number of the objects in one request
+    lazy_batch_size = 1000
+
+    class Media:
+        js = ('utils/js/lazy_batch.js',)
+
+    def __init__(self, *args, **kwargs):
+        super(BatchLazyLoadAdminMixin, self).__init__(*args, **kwargs)
+        # mark the fields for lazy_batch.js
+        for field in self.lazy_loaded_fields:
+            setattr(self, '%s_lazy' % field, self.batch_lazy(getattr(self, '%s_lazy' % field)))
+
+    @staticmethod
+    def batch_lazy(func):
+        def wrapper(obj):
+            return format_html('<div lazy_batch="yes">{}</div>', func(obj))
+        wrapper.short_description = func.short_description
+        return wrapper
+
+    def lazy_batch(self, objs):
+        """
+        Return the values of the lazy loaded fields of the objects: {<pk>: {<field>: <value>, ...}, ...}
+        """
+        return {}
+
+    def easy_view_lazy_batch(self, request):
+        if not self.has_view_permission(request):
+            return HttpResponseForbidden()
+
+        ids = [pk for pk in request.GET.get('ids', '').split(',') if pk.isdigit()][:self.lazy_batch_size]
+        objs = list(self.get_queryset(request).filter(pk__in=ids))
+        values = self.lazy_batch(objs)
+
+        data = {}
+        for obj in objs:
+            row = values.get(obj.pk, {})
+            data[obj.pk] = {field: lazy_html(row[field] if field in row else getattr(self, field)(obj))
+                for field in self.lazy_loaded_fields}
+        return JsonResponse(data)
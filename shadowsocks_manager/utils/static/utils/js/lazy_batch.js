@@ -0,0 +1,54 @@
+/*
+ * Load the lazy loaded fields marked by utils.admin.BatchLazyLoadAdminMixin in batches:
+ * one request for all the fields on the page of the same model admin, instead of one request
+ * for each field of each object by lazyload.js of admin_lazy_load.
+ *
+ * It runs on DOMContentLoaded, before lazyload.js runs on window load. The fields loaded here are
+ * taken out of the reach of lazyload.js, and they are given back to it if the batch request fails.
+ * The script may be included before jquery.init.js, so django.jQuery is only used after the loading.
+ */
+document.addEventListener("DOMContentLoaded", function () {
+  var $ = django.jQuery;
+
+  // <changelist url><pk>/easy/<field>_lazy/
+  var pattern = /^(.*\/)(\d+)\/easy\/(\w+)_lazy\/$/;
+
+  function show(elem, html) {
+    elem.children("#" + elem.attr("id") + "-spinner").hide();
+    elem.children("#" + elem.attr("id") + "-content").html(html);
+  }
+
+  function load(base, batch) {
+    $.ajax({
+      url: base + "easy/lazy_batch/",
+      data: {ids: Object.keys(batch.ids).join(",")},
+      dataType: "json"
+    }).done(function (data) {
+      $.each(batch.fields, function (index, item) {
+        var row = data[item.pk] || {};
+        show(item.elem, item.field in row ? row[item.field] : "-");
+      });
+    }).fail(function () {
+      $.each(batch.fields, function (index, item) {
+        item.elem.attr("lazyload_placeholder", "yes");
+        load_data(item.elem);
+      });
+    });
+  }
+
+  var batches = {};
+  $("div[lazy_batch='yes'] > div[lazyload_placeholder='yes'][loading_type='immediately']").each(function () {
+    var elem = $(this);
+    var match = pattern.exec(elem.attr("url_to_load"));
+    if (!match) {
+      return;
+    }
+    var batch = batches[match[1]] = batches[match[1]] || {ids: {}, fields: []};
+    batch.ids[match[2]] = true;
+    batch.fields.push({elem: elem, pk: match[2], field: match[3]});
+    elem.attr("lazyload_placeholder", "batch");
+    elem.children("#" + elem.attr("id") + "-spinner").show();
+  });
+
+  $.each(batches, load);
+});